@@ -36,3 +36,72 @@ def is_blocking(function):
     Returns true if function is marked as blocking
     """
     return getattr(function, "blocking", False)
+
+
+def cpu_bound(function):
+    """
+    Marks given function as CPU-bound (which'll be executed in process pool)
+    """
+    if not getattr(function, "cpu_bound", False):
+        function.cpu_bound = True
+    return function
+
+
+def is_cpu_bound(function):
+    """
+    Returns true if function is marked as CPU-bound
+    """
+    return getattr(function, "cpu_bound", False)
+
+
+def single_flight(function):
+    """
+    Marks given function as coalescible: concurrent calls with equal
+    arguments share one execution (cacheable functions are coalesced anyway)
+    """
+    if not getattr(function, "single_flight", False):
+        function.single_flight = True
+    return function
+
+
+def is_single_flight(function):
+    """
+    Returns true if function is marked as single-flight
+    """
+    return getattr(function, "single_flight", False)
+
+
+def cacheable(ttl=60, maxsize=1024):
+    """
+    Marks given function as pure: its replies are cached by server for ttl seconds
+    (at most maxsize different arguments) and may be cached by clients too
+    """
+    def decorator(function):
+        function.cacheable = (ttl, maxsize)
+        return function
+    return decorator
+
+
+def get_cache_options(function):
+    """
+    Returns (ttl, maxsize) pair of cacheable function or None
+    """
+    return getattr(function, "cacheable", None)
+
+
+def stream_window(size):
+    """
+    Sets how many streamed request chunks may be queued for given function,
+    before server stops reading from connection
+    """
+    def decorator(function):
+        function.stream_window = size
+        return function
+    return decorator
+
+
+def get_stream_window(function, default=None):
+    """
+    Returns stream window of given function
+    """
+    return getattr(function, "stream_window", default)
@@ -0,0 +1,85 @@
+"""
+Benchmark of server throughput with access logging off, sampled and full
+(records made and written by background thread), against former synchronous
+logging of every request formatted in place.
+
+    $ python -m kyoto.benchmarks.access_log --compare
+"""
+import os
+import time
+import logging
+import argparse
+import beretta
+
+import kyoto.conf
+import kyoto.server
+import kyoto.dispatch
+import kyoto.utils.access
+import kyoto.utils.executor
+import kyoto.tests.dummy
+
+
+def measure(agent, message, count, before=None):
+    """
+    Returns handled requests per second
+    """
+    start = time.time()
+    for _ in range(count):
+        if before is not None:
+            before()
+        for _ in agent.handle(message):
+            pass
+    return count / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--sample-rate", type=float, default=0.01)
+    parser.add_argument("--compare", action="store_true",
+                        help="measure former synchronous logging too")
+    options = parser.parse_args()
+    modules = [kyoto.tests.dummy]
+    address = ("localhost", 1337)
+    agent = kyoto.server.Agent(modules, address, kyoto.dispatch.Table(modules), kyoto.utils.executor.Executor())
+    message = beretta.encode((":call", ":dummy", ":echo", ["hello" * 100]))
+    devnull = open(os.devnull, "w")
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    handler = logging.StreamHandler(devnull)
+    handler.setFormatter(formatter)
+    logger = kyoto.utils.access.access_log.logger
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    sample_rate = kyoto.conf.settings.ACCESS_LOG_SAMPLE_RATE
+    results = []
+    try:
+        for name, rate in (("off", 0), ("sampled {0:g}".format(options.sample_rate), options.sample_rate),
+                           ("full", 1.0)):
+            kyoto.conf.settings.ACCESS_LOG_SAMPLE_RATE = rate
+            results.append((name, measure(agent, message, options.requests)))
+            kyoto.utils.access.access_log.flush()
+        if options.compare:
+            kyoto.conf.settings.ACCESS_LOG_SAMPLE_RATE = 0
+            legacy = logging.getLogger("kyoto.benchmarks.legacy")
+            legacy_handler = logging.StreamHandler(devnull)
+            legacy_handler.setFormatter(formatter)
+            legacy.addHandler(legacy_handler)
+            legacy.setLevel(logging.INFO)
+            legacy.propagate = False
+            request = beretta.decode(message)
+            log = lambda: legacy.info("{1}:{2} ~> {0}".format(request, *address))
+            results.append(("former, synchronous", measure(agent, message, options.requests, log)))
+    finally:
+        kyoto.conf.settings.ACCESS_LOG_SAMPLE_RATE = sample_rate
+        kyoto.utils.access.access_log.close()
+        logger.removeHandler(handler)
+        devnull.close()
+    print("{0:>22} {1:>12}".format("access log", "requests/s"))
+    for name, throughput in results:
+        print("{0:>22} {1:12.0f}".format(name, throughput))
+    print("{0} requests dropped by full queue".format(kyoto.utils.access.access_log.dropped))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark of BERT codecs on typical payloads of requests and replies:
+encoding and decoding by every given codec class, and encoding of replies
+by template prefix against encoding of whole (:reply, Value) tuple,
+decoding of request envelope only and of arguments with zero-copy binaries.
+
+    $ python -m kyoto.benchmarks.codec --codec kyoto.utils.codec.BerettaCodec
+"""
+import time
+import argparse
+import importlib
+
+import kyoto.utils.codec
+
+payloads = [
+    ("echo reply", (":reply", "hello?")),
+    ("noreply", (":noreply",)),
+    ("dict reply", (":reply", {"length": 1024, "checksum": "06aef8bb71e72b2abec01d4bd3aa9dda48fd20e6"})),
+    ("list reply", (":reply", list(range(100)))),
+    ("64 KB reply", (":reply", b"x" * 65536)),
+    ("call request", (":call", ":dummy", ":echo", ["hello"])),
+    ("64 KB request", (":call", ":dummy", ":store", ["key", b"x" * 65536])),
+    ("1 MB request", (":call", ":dummy", ":store", ["key", b"x" * 1048576])),
+]
+
+
+def measure(function, count):
+    start = time.time()
+    for _ in range(count):
+        function()
+    return (time.time() - start) / count * 1e9
+
+
+def load_class(path):
+    module, name = path.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--codec", action="append", default=[],
+                        help="dotted path of codec class, may be repeated")
+    options = parser.parse_args()
+    codecs = [load_class(path)() for path in options.codec or ["kyoto.utils.codec.BerettaCodec"]]
+    print("{0:>28} {1:>16} {2:>12} {3:>12}".format("payload", "codec", "encode ns", "decode ns"))
+    for name, term in payloads:
+        for codec in codecs:
+            encoded = codec.encode(term)
+            encoding = measure(lambda: codec.encode(term), options.requests)
+            decoding = measure(lambda: codec.decode(encoded), options.requests)
+            print("{0:>28} {1:>16} {2:12.1f} {3:12.1f}".format(name, codec.__class__.__name__, encoding, decoding))
+        if term[0] in (":reply", ":noreply"):
+            response = term
+            if term[0] == ":noreply":
+                response = kyoto.utils.codec.NOREPLY
+            templated = measure(lambda: kyoto.utils.codec.encode_response(response), options.requests)
+            print("{0:>28} {1:>16} {2:12.1f}".format(name + ", template", "CODEC_CLASS", templated))
+        elif term[0] in (":call", ":cast"):
+            encoded = kyoto.utils.codec.encode(term)
+            offset = kyoto.utils.codec.decode_header(encoded)[3]
+            header = measure(lambda: kyoto.utils.codec.decode_header(encoded), options.requests)
+            print("{0:>28} {1:>16} {2:>12} {3:12.1f}".format(name + ", header", "", "", header))
+            lazy = measure(lambda: kyoto.utils.codec.decode_args(encoded, offset, 1024), options.requests)
+            print("{0:>28} {1:>16} {2:>12} {3:12.1f}".format(name + ", zero-copy", "", "", lazy))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark of request dispatching: resolving of (module, function)
+atoms through shared dispatch table against former per-request
+getattr/flags lookups, and Dispatcher creation per connection.
+
+    $ python -m kyoto.benchmarks.dispatch --compare
+"""
+import time
+import argparse
+import termformat
+
+import kyoto
+import kyoto.dispatch
+import kyoto.utils.modules
+import kyoto.tests.dummy
+
+
+def resolve_legacy(modules, module, function):
+    """
+    Former implementation: attribute lookup and flags on every request
+    """
+    if module in modules:
+        function = getattr(modules[module], termformat.atom_to_binary(function), None)
+        if function and kyoto.utils.modules.is_callable_object(function):
+            return function, kyoto.is_blocking(function)
+    return None
+
+
+def resolve_table(table, module, function):
+    entry = table.get(module, function)
+    return entry.function, entry.blocking
+
+
+def measure(function, count):
+    start = time.time()
+    for _ in range(count):
+        function()
+    return (time.time() - start) / count * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000000)
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--compare", action="store_true",
+                        help="measure former per-request resolving too")
+    options = parser.parse_args()
+    modules = [kyoto.tests.dummy]
+    address = ("localhost", 1337)
+    table = kyoto.dispatch.Table(modules)
+    legacy_modules = {":dummy": kyoto.tests.dummy}
+    dispatcher = kyoto.dispatch.Dispatcher(modules, address, table)
+    request = (":call", ":dummy", ":echo", ["hello"])
+    results = [
+        ("resolve, table", measure(lambda: resolve_table(table, ":dummy", ":echo"), options.requests)),
+        ("handle :echo", measure(lambda: list(dispatcher.handle(request)), options.requests // 10)),
+        ("dispatcher, shared table", measure(lambda: kyoto.dispatch.Dispatcher(modules, address, table),
+                                             options.connections)),
+    ]
+    if options.compare:
+        results[1:1] = [("resolve, legacy", measure(lambda: resolve_legacy(legacy_modules, ":dummy", ":echo"),
+                                                    options.requests))]
+        results.append(("dispatcher, own table", measure(lambda: kyoto.dispatch.Dispatcher(modules, address),
+                                                         options.connections)))
+    print("{0:>26} {1:>12}".format("operation", "ns/op"))
+    for name, nanoseconds in results:
+        print("{0:>26} {1:12.1f}".format(name, nanoseconds))
+
+
+if __name__ == "__main__":
+    main()
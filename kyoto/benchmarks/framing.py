@@ -0,0 +1,93 @@
+"""
+Micro-benchmark of BERP frame receiving: frames of growing size are
+delivered in READ_CHUNK_SIZE pieces, throughput must stay flat
+(linear receive time) from 1 KB up to MAX_BERP_SIZE.
+
+    $ python -m kyoto.benchmarks.framing --compare
+"""
+import time
+import argparse
+
+import kyoto.conf
+import kyoto.utils.berp
+import kyoto.network.stream
+
+
+class Source(object):
+
+    """
+    Socket-like object, which returns given data by READ_CHUNK_SIZE pieces
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def recv(self, size):
+        chunk = self.data[self.offset:self.offset + size].tobytes()
+        self.offset += len(chunk)
+        return chunk
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), kyoto.conf.settings.READ_CHUNK_SIZE, len(self.data) - self.offset)
+        buffer[:size] = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+
+def receive_legacy(connection):
+    """
+    Former implementation: immutable buffer, concatenation and slicing
+    """
+    receive_buffer = b""
+    while True:
+        message = connection.recv(kyoto.conf.settings.READ_CHUNK_SIZE)
+        if not message:
+            break
+        receive_buffer += message
+        while len(receive_buffer) >= 4:
+            try:
+                _, message, receive_buffer = kyoto.utils.berp.unpack(receive_buffer)
+            except ValueError:
+                break
+            yield message
+
+
+def measure(receive, data):
+    start = time.time()
+    for _ in receive(Source(data)):
+        pass
+    return time.time() - start
+
+
+def sizes(maximum):
+    size = 1024
+    while size < maximum:
+        yield size
+        size *= 4
+    yield maximum
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--max-size", type=int, default=kyoto.conf.settings.MAX_BERP_SIZE)
+    parser.add_argument("--payload", type=int, default=64 * 1024 * 1024,
+                        help="bytes received per measurement")
+    parser.add_argument("--compare", action="store_true",
+                        help="measure former concatenating receiver too")
+    options = parser.parse_args()
+    print("{0:>12} {1:>8} {2:>12} {3:>12}".format("frame size", "frames", "framer MB/s", "legacy MB/s"))
+    for size in sizes(options.max_size):
+        count = max(options.payload // (size + 4), 1)
+        data = kyoto.utils.berp.pack(b"x" * size) * count
+        megabytes = len(data) / 1048576.0
+        framer = megabytes / measure(kyoto.network.stream.receive, data)
+        if options.compare:
+            legacy = "{0:12.1f}".format(megabytes / measure(receive_legacy, data))
+        else:
+            legacy = "{0:>12}".format("-")
+        print("{0:>12} {1:>8} {2:12.1f} {3}".format(size, count, framer, legacy))
+
+
+if __name__ == "__main__":
+    main()
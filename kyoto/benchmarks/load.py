@@ -0,0 +1,186 @@
+"""
+Load generator: starts local BertRPCServer with kyoto.tests.dummy module,
+drives concurrent call, cast, streamed upload and streamed download workloads
+through every connection manager and reports requests/s and p50/p99/p999 latency.
+Results saved as JSON may be compared with later runs:
+
+    $ python -m kyoto.benchmarks.load --duration 5 --output baseline.json
+    $ python -m kyoto.benchmarks.load --duration 5 --baseline baseline.json --tolerance 0.1
+"""
+import sys
+import json
+import time
+import argparse
+
+import gevent
+import gevent.pool
+
+import kyoto.conf
+import kyoto.client
+import kyoto.server
+import kyoto.tests.dummy
+import kyoto.network.connection
+
+managers = {
+    "single": kyoto.network.connection.SingleConnectionManager,
+    "shared": kyoto.network.connection.SharedConnectionManager,
+    "pooled": kyoto.network.connection.PooledConnectionManager,
+}
+
+
+def chunks(count, size):
+    chunk = b"x" * size
+    for _ in range(count):
+        yield chunk
+
+
+def call(service, options):
+    service.call(":echo", ["hello"])
+
+
+def cast(service, options):
+    service.cast(":echo", ["hello"])
+
+
+def upload(service, options):
+    service.call(":streaming_echo_length", [], stream=chunks(options.chunks, options.chunk_size))
+
+
+def download(service, options):
+    reply, response = service.call(":streaming_echo_response", ["hello"], stream_response=True)
+    for chunk in response:
+        pass
+
+
+workloads = {
+    "call": call,
+    "cast": cast,
+    "upload": upload,
+    "download": download,
+}
+
+
+def percentile(latencies, percent):
+    """
+    Returns latency of given percentile from sorted list
+    """
+    if not latencies:
+        return 0.0
+    return latencies[min(int(len(latencies) * percent / 100.0), len(latencies) - 1)]
+
+
+def run(service, workload, options):
+    """
+    Runs workload by given number of concurrent greenlets for given number of seconds
+    """
+    latencies = []
+    errors = []
+    deadline = time.time() + options.duration
+
+    def worker():
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                workload(service, options)
+            except Exception as exception:
+                errors.append(exception)
+            else:
+                latencies.append(time.time() - start)
+
+    start = time.time()
+    workers = gevent.pool.Group()
+    for _ in range(options.concurrency):
+        workers.spawn(worker)
+    workers.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "p999": percentile(latencies, 99.9),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints difference with baseline results, returns list of regressions:
+    throughput dropped or p99 latency grew by more than given share
+    """
+    previous = dict(((result["workload"], result["manager"]), result) for result in baseline["results"])
+    regressions = []
+    print("{0:>10} {1:>8} {2:>10} {3:>10}".format("workload", "manager", "rps", "p99"))
+    for result in results:
+        key = (result["workload"], result["manager"])
+        if key not in previous:
+            continue
+        before = previous[key]
+        rps = (result["rps"] - before["rps"]) / before["rps"] if before["rps"] else 0.0
+        p99 = (result["p99"] - before["p99"]) / before["p99"] if before["p99"] else 0.0
+        print("{0:>10} {1:>8} {2:>+9.1%} {3:>+9.1%}".format(key[0], key[1], rps, p99))
+        if rps < -tolerance or p99 > tolerance:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--duration", type=float, default=3, help="seconds per workload and manager")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workloads", default=",".join(sorted(workloads)))
+    parser.add_argument("--managers", default=",".join(sorted(managers)))
+    parser.add_argument("--chunks", type=int, default=10, help="chunks of streamed upload")
+    parser.add_argument("--chunk-size", type=int, default=4096)
+    parser.add_argument("--port", type=int, default=1437)
+    parser.add_argument("--output", help="save results to JSON file")
+    parser.add_argument("--baseline", help="compare results with JSON file saved by earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed drop of throughput and growth of p99 latency")
+    options = parser.parse_args()
+    address = ("localhost", options.port)
+    server = kyoto.server.BertRPCServer([kyoto.tests.dummy], address)
+    server.start()
+    manager_class = kyoto.conf.settings.CONNECTION_MANAGER_CLASS
+    results = []
+    print("{0:>10} {1:>8} {2:>10} {3:>8} {4:>10} {5:>10} {6:>10} {7:>10}".format(
+        "workload", "manager", "requests", "errors", "rps", "p50, ms", "p99, ms", "p999, ms"))
+    try:
+        for workload in options.workloads.split(","):
+            for manager in options.managers.split(","):
+                kyoto.conf.settings.CONNECTION_MANAGER_CLASS = managers[manager]
+                service = kyoto.client.Service(address, ":dummy")
+                result = run(service, workloads[workload], options)
+                service.connections.clear()
+                result.update(workload=workload, manager=manager)
+                results.append(result)
+                print("{workload:>10} {manager:>8} {requests:>10} {errors:>8} {rps:>10.0f} {0:>10.3f} {1:>10.3f} "
+                      "{2:>10.3f}".format(result["p50"] * 1000, result["p99"] * 1000, result["p999"] * 1000,
+                                          **result))
+    finally:
+        kyoto.conf.settings.CONNECTION_MANAGER_CLASS = manager_class
+        server.stop()
+    report = {
+        "settings": {
+            "duration": options.duration,
+            "concurrency": options.concurrency,
+            "chunks": options.chunks,
+            "chunk_size": options.chunk_size,
+        },
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as source:
+            baseline = json.load(source)
+        regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print("Regressions: {0}".format(", ".join("{0}/{1}".format(*key) for key in regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
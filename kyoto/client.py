@@ -1,16 +1,39 @@
+import time
+import random
 import beretta
 import termformat
+import gevent.socket
 
 
 import kyoto.conf
 import kyoto.utils.berp
+import kyoto.utils.cache
+import kyoto.utils.codec
+import kyoto.utils.compression
+import kyoto.utils.singleflight
 import kyoto.network.stream
+import kyoto.network.hedging
+import kyoto.network.pipeline
+import kyoto.network.balancing
 import kyoto.network.connection
 
 
+class DeadlineExceeded(gevent.socket.timeout):
+
+    """
+    Raised, when call isn't answered before its timeout. It's a socket timeout,
+    but it's caused by caller, not by node, so node isn't ejected for it
+    """
+
+
 class Service(object):
 
-    def __init__(self, address, name):
+    """
+    Client of remote module. Calls of functions listed as idempotent are hedged:
+    when reply is late, duplicate request is sent over another connection
+    """
+
+    def __init__(self, address, name, pipeline=False, single_flight=None, idempotent=None):
         self.address = address
         if not termformat.is_atom(name):
             message = "Module name must be an atom '{0}' ~> '{1}'"
@@ -18,36 +41,124 @@ class Service(object):
             raise ValueError(message.format(name, name_as_atom))
         self.name = name
         self.connections = kyoto.conf.settings.CONNECTION_MANAGER_CLASS(self.address)
+        if pipeline:
+            self.pipeline = kyoto.network.pipeline.Pipeline(self.address)
+        else:
+            self.pipeline = None
+        if kyoto.conf.settings.CLIENT_CACHE_SIZE:
+            self.cache = kyoto.utils.cache.Cache(0, kyoto.conf.settings.CLIENT_CACHE_SIZE)
+        else:
+            self.cache = None
+        self.cacheable = set()  # functions, which replies came with caching hint
+        self.cache_metrics = {
+            "hits": 0,
+            "misses": 0,
+        }
+        if single_flight is None:
+            single_flight = kyoto.conf.settings.CLIENT_SINGLE_FLIGHT
+        if single_flight:
+            self.flights = kyoto.utils.singleflight.SingleFlight()
+        else:
+            self.flights = None
+        self.idempotent = frozenset(idempotent or ())
+        if self.idempotent:
+            self.hedging = kyoto.network.hedging.Hedging()
+        else:
+            self.hedging = None
+
+    def send_messages(self, connection, messages):
+        writer = kyoto.network.stream.Writer(connection)
+        for message in messages:
+            writer.write(message)
+        writer.flush()
 
-    def send_message(self, connection, message):
-        message = kyoto.utils.berp.pack(beretta.encode(message))
-        return connection.sendall(message)
+    def transform_request(self, message, stream=None, timeout=None):
+        """
+        Yields messages of encoded request, optionally preceded by its timeout
+        and followed by streamed body
+        """
+        if timeout is not None:
+            yield beretta.encode((":info", ":deadline", [timeout]))
+        if stream:
+            yield beretta.encode((":info", ":stream", []))
+        for frame in kyoto.network.stream.frames(message):
+            yield frame
+        if stream:
+            for chunk in kyoto.network.stream.chunks(stream):
+                yield chunk
 
     def request(self, rtype, function, args, kwargs):
         stream = kwargs.get("stream", None)
+        message = kyoto.utils.codec.encode((rtype, self.name, function, args))
+        key = None
+        if self.cache is not None and rtype == ":call" and stream is None:
+            key = (function, message)  # arguments aren't encoded once more for key
+            if function in self.cacheable:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self.cache_metrics["hits"] += 1
+                    return self.handle_reply(kyoto.utils.codec.decode(cached[0]))
+                self.cache_metrics["misses"] += 1
+        messages = self.transform_request(message, stream, kwargs.get("timeout"))
+        if self.pipeline:
+            frames = self.pipeline.request(messages)
+            return self.handle_response(frames, kwargs, lambda complete: frames.close(), key=key)
         connection = self.connections.acquire()
-        if stream:
-            response = self.stream_request(connection, rtype, function, args, stream)
-        else:
-            connection = self.connections.acquire()
-            status = self.send_message(connection, (rtype, self.name, function, args))
+        try:
+            self.send_messages(connection, messages)
             stream = kyoto.network.stream.receive(connection, server=False)
-            response = self.handle_response(stream)
-        self.connections.release(connection)
-        return response
-
-    def stream_request(self, connection, rtype, function, args, stream):
-        status = self.send_message(connection, (":info", ":stream", []))
-        status = self.send_message(connection, (rtype, self.name, function, args))
-        stream = kyoto.network.stream.send(stream)
-        for chunk in stream:
-            connection.sendall(chunk)
-        stream = kyoto.network.stream.receive(connection, server=False)
-        response = self.handle_response(stream)
-        return response
-
-    def handle_response(self, stream):
-        response = beretta.decode(next(stream))
+            frames = kyoto.network.stream.response(stream)
+            response = kyoto.utils.codec.decode(next(frames))
+        except BaseException:
+            self.connections.discard(connection)  # including killed hedges and timeouts
+            raise
+        def release(complete):
+            if complete:
+                self.connections.release(connection)
+            else:
+                self.connections.discard(connection)
+        return self.handle_response(frames, kwargs, release, response, key)
+
+    def handle_response(self, stream, kwargs=None, release=None, response=None, key=None):
+        """
+        Transforms response to return value. Streamed response is returned as
+        (reply, chunks) pair, where chunks are read lazily with stream_response=True
+        or written to file-like object given as output=...
+        Reply preceded by caching hint is kept in cache under given key,
+        (function, encoded request), later calls of function look cache up
+        """
+        kwargs = kwargs or {}
+        complete = False
+        try:
+            if response is None:
+                response = kyoto.utils.codec.decode(next(stream))
+            if response[0] == ":info" and response[1] == ":cache":
+                ttl = kyoto.utils.cache.get_ttl(response)
+                message = next(stream)
+                response = kyoto.utils.codec.decode(message)
+                if key is not None and ttl and response[0] == ":reply":
+                    self.cacheable.add(key[0])
+                    self.cache.set(key, message, ttl)
+            if response[0] == ":info" and response[1] == ":stream":
+                reply = self.handle_reply(kyoto.utils.codec.decode(next(stream)))
+                chunks = self.receive_chunks(stream, ":zlib" in response[2], release)
+                release = None  # chunks own connection from now on
+                output = kwargs.get("output", None)
+                if output is not None:
+                    for chunk in chunks:
+                        output.write(chunk)
+                    return reply
+                elif kwargs.get("stream_response", False):
+                    return reply, chunks
+                else:
+                    return reply, list(chunks)
+            complete = True
+            return self.handle_reply(response)
+        finally:
+            if release:
+                release(complete)
+
+    def handle_reply(self, response):
         rtype = response[0]
         if rtype == ":reply":
             return response[1]
@@ -58,8 +169,136 @@ class Service(object):
         else:
             raise NotImplementedError
 
+    def receive_chunks(self, stream, compressed, release=None):
+        """
+        Lazily yields chunks of streamed response up to empty terminator.
+        Connection is released when stream is over or discarded, if it's abandoned
+        """
+        complete = False
+        try:
+            for chunk in stream:
+                if not chunk:
+                    complete = True
+                    break
+                if compressed:
+                    chunk = kyoto.utils.compression.decompress_chunk(chunk)
+                yield chunk
+        finally:
+            if release:
+                release(complete)
+
+    def invalidate(self, function=None, args=None):
+        """
+        Removes cached replies: all of them, all replies of given function
+        or reply to given function and arguments
+        """
+        if self.cache is None:
+            return
+        if function is None:
+            self.cache.clear()
+        elif args is None:
+            for key in self.cache.keys():
+                if key[0] == function:
+                    self.cache.delete(key)
+        else:
+            self.cache.delete((function, kyoto.utils.codec.encode((":call", self.name, function, args))))
+
     def call(self, function, args, **kwargs):
-        return self.request(":call", function, args, kwargs)
+        """
+        Calls remote function. With timeout=seconds server drops the call,
+        when deadline passes, and socket.timeout is raised here
+        """
+        if self.flights is not None and not kwargs:
+            key = (function, beretta.encode(args))
+            return self.flights.do(key, self.hedged_call, function, args, kwargs)
+        timeout = kwargs.get("timeout")
+        if timeout is not None:
+            with gevent.Timeout(timeout, DeadlineExceeded("Deadline exceeded")):
+                return self.hedged_call(function, args, kwargs)
+        return self.hedged_call(function, args, kwargs)
+
+    def hedged_call(self, function, args, kwargs):
+        if not is_hedged(self.hedging, self.idempotent, function, kwargs):
+            return self.request(":call", function, args, kwargs)
+        call = lambda: self.request(":call", function, args, kwargs)
+        return self.hedging.run(call, call, function)
 
     def cast(self, function, args, **kwargs):
         return self.request(":cast", function, args, kwargs)
+
+
+def is_hedged(hedging, idempotent, function, kwargs):
+    """
+    Streamed requests and responses written to file can't be duplicated
+    """
+    if hedging is None or function not in idempotent:
+        return False
+    return kwargs.get("stream") is None and kwargs.get("output") is None
+
+
+class ClusterService(object):
+
+    """
+    Drop-in replacement of Service, which spreads requests over nodes of
+    cluster with given policy: round_robin, least_outstanding, power_of_two
+    or consistent_hash (or policy class, which is created with list of nodes).
+    Nodes, which fail on network level, are ejected and probed back in later.
+    Late calls of idempotent functions are hedged to another node
+    """
+
+    def __init__(self, addresses, name, pipeline=False, policy=None, idempotent=None, **options):
+        if not addresses:
+            raise ValueError("Cluster must have at least one node")
+        self.name = name
+        self.nodes = [kyoto.network.balancing.Node(tuple(address), Service(tuple(address), name, pipeline))
+                      for address in addresses]
+        policy = policy or kyoto.conf.settings.CLUSTER_POLICY
+        if not callable(policy):
+            policy = kyoto.network.balancing.policies[policy]
+        self.policy = policy(self.nodes, **options)
+        self.idempotent = frozenset(idempotent or ())
+        if self.idempotent:
+            self.hedging = kyoto.network.hedging.Hedging()
+        else:
+            self.hedging = None
+
+    def request(self, rtype, function, args, kwargs, node=None):
+        node = node or self.policy.select(function, args)
+        node.acquire()
+        start = time.time()
+        try:
+            response = getattr(node.service, rtype)(function, args, **kwargs)
+        except (DeadlineExceeded, kyoto.network.connection.AcquireTimeout):
+            node.release()
+            raise
+        except gevent.socket.error:
+            node.fail()
+            raise
+        except BaseException:
+            node.release()
+            raise
+        else:
+            node.succeed(time.time() - start)
+            return response
+
+    def invalidate(self, function=None, args=None):
+        for node in self.nodes:
+            node.service.invalidate(function, args)
+
+    def alternative(self, node):
+        """
+        Returns another available node for hedged request, if there is one
+        """
+        nodes = [other for other in kyoto.network.balancing.available(self.nodes) if other is not node]
+        return random.choice(nodes) if nodes else node
+
+    def call(self, function, args, **kwargs):
+        if not is_hedged(self.hedging, self.idempotent, function, kwargs):
+            return self.request("call", function, args, kwargs)
+        node = self.policy.select(function, args)
+        primary = lambda: self.request("call", function, args, kwargs, node)
+        backup = lambda: self.request("call", function, args, kwargs, self.alternative(node))
+        return self.hedging.run(primary, backup, (function, node.address))
+
+    def cast(self, function, args, **kwargs):
+        return self.request("cast", function, args, kwargs)
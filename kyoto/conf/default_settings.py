@@ -20,10 +20,50 @@ BIND_ADDRESS = (BIND_HOSTNAME, BIND_PORT)
 
 MAX_BERP_SIZE = 33554432  # 32 megabytes
 READ_CHUNK_SIZE = 65536  # 64 kilobytes
-COMPRESS_RESPONSE = False
+FRAGMENT_SIZE = 1048576  # 1 megabyte, larger terms are split into fragments
+MAX_FRAGMENTED_SIZE = 67108864  # 64 megabytes
+WRITE_BUFFER_SIZE = 65536  # 64 kilobytes, small frames are coalesced up to it
+FILE_CHUNK_SIZE = 1048576  # 1 megabyte, frame size of files streamed with sendfile
+STREAM_WINDOW = 16  # streamed request chunks queued per request, see kyoto.stream_window
+COMPRESS_RESPONSE = False  # negotiated per connection, both sides must enable it
+COMPRESS_LEVEL = 6  # zlib compression level
+COMPRESS_THRESHOLD = 1024  # smaller frames are sent as is
+COMPRESS_OFFLOAD_SIZE = 1048576  # larger frames are (de)compressed in threadpool
 DISABLE_NAGLE = True
 CONNECTION_TIMEOUT = 10 # in seconds
 CONNECTION_MANAGER_CLASS = kyoto.network.connection.SingleConnectionManager
+CODEC_CLASS = None  # class, which encodes and decodes terms, kyoto.utils.codec.BerettaCodec by default
+DECODE_ZERO_COPY_SIZE = 0  # binary arguments of this size and larger are passed as memoryviews of request, 0 disables
+CONNECTION_POOL_MIN_SIZE = 0
+CONNECTION_POOL_MAX_SIZE = 32
+CONNECTION_POOL_MAX_IDLE_TIME = 60  # in seconds
+CONNECTION_POOL_MAX_LIFETIME = 600  # in seconds
+CONNECTION_POOL_ACQUIRE_TIMEOUT = CONNECTION_TIMEOUT  # in seconds
+PIPELINE_MAX_DEPTH = 128  # requests in flight per pipelined connection
+PIPELINE_TAGGED = False  # replies may arrive out of order, see SERVER_CONCURRENCY
+CLIENT_CACHE_SIZE = 1024  # replies with caching hints kept by every client, 0 disables
+CLIENT_SINGLE_FLIGHT = False  # concurrent equal calls of one client share one request
+CLIENT_HEDGE_PERCENTILE = 95  # idempotent calls slower than this percentile of recent ones are sent again
+CLIENT_HEDGE_WINDOW = 100  # latencies of recent calls, which percentile is computed from
+CLIENT_HEDGE_MIN_SAMPLES = 10  # calls aren't hedged, until this number of latencies is known
+CLIENT_HEDGE_BUDGET = 0.1  # hedges per call, e.g. at most one of ten calls is sent twice
+CLIENT_HEDGE_BURST = 10  # hedges, which unused budget may accumulate
+CLUSTER_POLICY = "round_robin"  # or least_outstanding, power_of_two, consistent_hash
+CLUSTER_MAX_FAILURES = 3  # consecutive network failures, before node is ejected
+CLUSTER_EJECT_TIME = 1  # in seconds, doubled on every failed probe
+CLUSTER_MAX_EJECT_TIME = 30  # in seconds
+CLUSTER_HASH_REPLICAS = 100  # points of every node on consistent hash ring
+SERVER_CONCURRENCY = 1  # requests handled concurrently per connection, replies keep request order
+SERVER_WORKERS = 1  # processes forked by kyoto.server.Supervisor, 0 means one per CPU
+SERVER_REUSE_PORT = False  # every worker binds own listener with SO_REUSEPORT
+SERVER_BACKLOG = 1024
+SERVER_RESTART_DELAY = 1  # in seconds, before restarting worker, which died right after start
+SERVER_STOP_TIMEOUT = 10  # in seconds, workers still running after it are killed
+SERVER_METRICS = True  # per-function latency histograms, exposed by reserved :kyoto_metrics module
+CAST_WORKERS = 100  # greenlets running casts in every server
+CAST_QUEUE_SIZE = 10000  # casts waiting for free worker
+CAST_QUEUE_POLICY = "block"  # when queue is full: block connection, drop cast or reject it with error
+CAST_PRIORITIES = {}  # module atom -> priority of its casts, lower go first, 0 by default
 
 """
 Logging settings
@@ -44,16 +84,31 @@ LOGGING = {
             "formatter": "standard",
             "class": "logging.StreamHandler",
         },
+        "access": {
+            "level": "INFO",
+            "formatter": "standard",
+            "class": "logging.StreamHandler",
+        },
     },
     "loggers": {
         "": {
             "handlers": ["default"],
             "level": "INFO",
             "propagate": True
+        },
+        "kyoto.access": {
+            "handlers": ["access"],
+            "level": "INFO",
+            "propagate": False
         }
     }
 }
 
+# requests are logged by "kyoto.access" logger in background thread
+ACCESS_LOG_SAMPLE_RATE = 1.0  # share of logged requests, 0 disables access log
+ACCESS_LOG_MAX_ARGS_LENGTH = 256  # in characters, longer arguments are truncated
+ACCESS_LOG_QUEUE_SIZE = 10000  # requests waiting for background writer, new ones are dropped above
+
 
 # list of modules which must be monkey-patched by gevent
 GEVENT_PATCH_MODULES = (
@@ -71,3 +126,12 @@ Blocking I/O settings
 BLOCKING_POOL_SIZE = getattr(os, "cpu_count", multiprocessing.cpu_count)()
 BLOCKING_POOL_CLASS = concurrent.futures.ThreadPoolExecutor
 BLOCKING_POOL = BLOCKING_POOL_CLASS(max_workers=BLOCKING_POOL_SIZE)
+
+"""
+CPU-bound settings
+"""
+
+CPU_POOL_SIZE = BLOCKING_POOL_SIZE  # processes, started on first call of @kyoto.cpu_bound function
+CPU_POOL_MAX_TASKS = 1000  # calls served by process, before it's replaced by new one
+CPU_SHARED_MEMORY_SIZE = 1048576  # 1 megabyte, larger binaries are passed through shared memory
+CPU_SHARED_MEMORY_PATH = "/dev/shm"
@@ -1,11 +1,24 @@
+import time
 import types
 import gevent
+import concurrent.futures
+import multiprocessing
+import beretta
+import inspect
+import collections
 import traceback
 import termformat
 
 import kyoto
 import kyoto.conf
+import kyoto.utils.cache
+import kyoto.utils.codec
+import kyoto.utils.metrics
+import kyoto.utils.executor
+import kyoto.utils.deadlines
 import kyoto.utils.modules
+import kyoto.utils.processes
+import kyoto.utils.singleflight
 import kyoto.utils.validation
 
 try:
@@ -16,29 +29,80 @@ except ImportError:
     izip = zip
 
 
-class Dispatcher(object):
+OVERLOADED = kyoto.utils.codec.constant((":error", (":server", 6, "OverloadError", "Cast queue is full", [])))
 
-    __slots__ = ("address", "handlers", "modules")
+Entry = collections.namedtuple("Entry", ("function", "blocking", "cpu_bound", "private",
+                                         "streaming", "stream_window", "cache", "flight", "metrics"))
 
-    def __init__(self, modules, address):
-        self.address = address
-        self.handlers = {
-            ":call": self.handle_call,
-            ":cast": self.handle_cast,
-        }
-        self.modules = self.transform_modules(modules)
 
-    def transform_modules(self, modules):
+def make_entry(function, metrics=None):
+    """
+    Resolves flags of given function once, when dispatch table is built
+    """
+    streaming = inspect.isgeneratorfunction(function)
+    options = kyoto.get_cache_options(function)
+    if options and not streaming:
+        cache = kyoto.utils.cache.Cache(*options)
+    else:
+        cache = None
+    if (cache is not None or kyoto.is_single_flight(function)) and not streaming:
+        flight = kyoto.utils.singleflight.SingleFlight()
+    else:
+        flight = None
+    return Entry(function=function,
+                 blocking=bool(kyoto.is_blocking(function)),
+                 cpu_bound=bool(kyoto.is_cpu_bound(function)),
+                 private=bool(kyoto.is_private(function)),
+                 streaming=streaming,
+                 stream_window=kyoto.get_stream_window(function),
+                 cache=cache,
+                 flight=flight,
+                 metrics=metrics)
+
+
+class Table(object):
+
+    """
+    Immutable dispatch table built once from given list of modules
+    and shared by all connections:
+    [kyoto.tests.dummy] => {
+      (":dummy", ":echo"): Entry(function=<function echo>, blocking=False, ...),
+    }
+    """
+
+    __slots__ = ("entries", "modules")
+
+    def __init__(self, modules):
+        entries = {}
+        names = set()
+        for module in modules:
+            name = termformat.binary_to_atom(kyoto.utils.modules.get_module_name(module))
+            names.add(name)
+            for key, function in inspect.getmembers(module, kyoto.utils.modules.is_callable_object):
+                key = termformat.binary_to_atom(key)
+                if kyoto.conf.settings.SERVER_METRICS:
+                    metrics = kyoto.utils.metrics.registry.function(name, key)
+                else:
+                    metrics = None
+                entries[(name, key)] = make_entry(function, metrics)
+        self.entries = entries
+        self.modules = frozenset(names)
+
+    def get(self, module, function):
         """
-        Creates dispatching dictionary from given list of modules:
-        [kyoto.tests.dummy] => {
-          ":dummy": <module 'kyoto.tests.dummy' object>,
-        }
+        Returns entry by module and function atoms or None
         """
-        def transform(module):
-            name = kyoto.utils.modules.get_module_name(module)
-            return (termformat.binary_to_atom(name), module)
-        return dict((transform(m) for m in modules))
+        return self.entries.get((module, function))
+
+
+class Dispatcher(object):
+
+    __slots__ = ("address", "table", "executor")
+
+    def __init__(self, modules, address, table=None, executor=None):
+        self.address = address
+        self.table = table or Table(modules)
+        self.executor = executor or kyoto.utils.executor.Executor()
 
     def transform_exceptions(function):
         """
@@ -103,33 +167,180 @@ class Dispatcher(object):
                 yield (":noreply",)
         return transform
 
+    def resolve(self, module, function):
+        """
+        Returns public function by its module and function atoms or None
+        """
+        entry = self.table.get(module, function)
+        if entry is None or entry.private:
+            return None
+        return entry.function
+
+    def handle(self, request, deadline=None, entry=None, **kwargs):
+        """
+        Yields response terms. Replies of cacheable functions are
+        served from cache of their entry as already encoded terms,
+        concurrent equal calls of single-flight functions share one execution.
+        Request isn't run past given deadline (absolute time), such requests
+        aren't coalesced, otherwise deadline of the first caller would apply to all.
+        Entry of request is looked up, unless caller has already done it
+        """
+        if entry is None:
+            entry = self.table.get(request[1], request[2])
+        if entry is None or entry.flight is None or entry.private or request[0] != ":call" or kwargs:
+            return self.dispatch(request, deadline, entry, **kwargs)
+        elif entry.cache is not None:
+            return self.handle_cached(entry, request, deadline)
+        elif deadline is not None:
+            return self.dispatch(request, deadline, entry)
+        else:
+            return self.handle_flight(entry, request)
+
+    def handle_flight(self, entry, request):
+        yield entry.flight.do(beretta.encode(request[3]), lambda: next(self.dispatch(request, None, entry)))
+
+    def handle_cached(self, entry, request, deadline=None):
+        """
+        Yields (:info, :cache, [:ttl, seconds]) hint and encoded reply
+        """
+        key = beretta.encode(request[3])
+        cached = entry.cache.get(key)
+        if cached is None:
+            if deadline is None:
+                message = entry.flight.do(key, self.fill_cache, entry, key, request)
+            else:
+                message = self.fill_cache(entry, key, request, deadline)
+            if not isinstance(message, bytes):
+                yield message  # errors aren't cached
+                return
+            ttl = entry.cache.ttl
+        else:
+            message, ttl = cached
+        yield (":info", ":cache", [":ttl", ttl])
+        yield message
+
+    def fill_cache(self, entry, key, request, deadline=None):
+        """
+        Calls function and caches its encoded reply
+        """
+        response = next(self.dispatch(request, deadline, entry))
+        if response[0] != ":reply":
+            return response
+        message = kyoto.utils.codec.encode_response(response)
+        entry.cache.set(key, message)
+        return message
+
     @transform_response
-    def handle(self, request, **kwargs):
-        rtype, module, function, args = request
-        if module in self.modules:
-            module = self.modules.get(module)
-            name = termformat.atom_to_binary(function)
-            function = getattr(module, name, None)
-            if function and kyoto.utils.modules.is_callable_object(function):
-                if kyoto.is_blocking(function):
-                    future = kyoto.conf.settings.BLOCKING_POOL.submit(self.handle_call, function, args, **kwargs)
+    def dispatch(self, request, deadline=None, entry=None, done=None, **kwargs):
+        """
+        Given event is set, when cast is finished: by executor
+        for queued casts, at once for other ones
+        """
+        try:
+            rtype, module, name, args = request
+            if entry is None:
+                entry = self.table.get(module, name)
+            if entry is not None and not entry.private:
+                if kyoto.utils.deadlines.is_expired(deadline):
+                    return kyoto.utils.deadlines.EXCEEDED  # nobody waits for this response anymore
+                start = time.time()
+                if entry.cpu_bound:
+                    response = self.handle_cpu_bound(rtype, entry.function, args, deadline, **kwargs)
+                elif entry.blocking:
+                    future = kyoto.conf.settings.BLOCKING_POOL.submit(self.handle_blocking, entry.function, args,
+                                                                      deadline, entry.metrics, start, **kwargs)
                     if rtype == ":call":
-                        response = future.result()
+                        try:
+                            response = future.result(kyoto.utils.deadlines.remaining(deadline))
+                        except concurrent.futures.TimeoutError:
+                            future.cancel()
+                            response = kyoto.utils.deadlines.EXCEEDED
                     else:
                         response = None
+                elif rtype == ":call":
+                    if deadline is None:
+                        response = self.handle_call(entry.function, args, **kwargs)
+                    else:
+                        response = self.handle_timed_call(entry.function, args, deadline, **kwargs)
                 else:
-                    response = self.handlers[rtype](function, args, **kwargs)
+                    priority = kyoto.conf.settings.CAST_PRIORITIES.get(module, 0)
+                    response = self.handle_cast(entry.function, args, priority, done, **kwargs)
+                    done = None  # executor sets it
+                if entry.metrics is not None:
+                    entry.metrics.count(response)
+                    if not entry.blocking and rtype == ":call":
+                        if isinstance(response, types.GeneratorType):
+                            response = self.measure(response, entry.metrics.execution, start)
+                        else:
+                            entry.metrics.execution.record(time.time() - start)
                 return response
+            elif module in self.table.modules:
+                return (":error", (":server", 2, "NameError", "No such function: '{0}'".format(name), []))
             else:
-                function = termformat.binary_to_atom(name)
-                return (":error", (":server", 2, "NameError", "No such function: '{0}'".format(function), []))
-        else:
-            return (":error", (":server", 1, "NameError", "No such module: '{0}'".format(module), []))
+                return (":error", (":server", 1, "NameError", "No such module: '{0}'".format(module), []))
+        finally:
+            if done is not None:
+                done.set()
+
+    def measure(self, response, histogram, start):
+        """
+        Yields messages of streaming response, its execution
+        is recorded, when response is exhausted or closed
+        """
+        try:
+            for message in response:
+                yield message
+        finally:
+            histogram.record(time.time() - start)
 
     @transform_exceptions
     def handle_call(self, function, args, **kwargs):
         return function(*args, **kwargs)
 
+    def handle_timed_call(self, function, args, deadline, **kwargs):
+        """
+        Kills call, which is still running at deadline
+        """
+        timeout = gevent.Timeout(kyoto.utils.deadlines.remaining(deadline))
+        timeout.start()
+        try:
+            return self.handle_call(function, args, **kwargs)
+        except gevent.Timeout as exception:
+            if exception is not timeout:
+                raise
+            return kyoto.utils.deadlines.EXCEEDED
+        finally:
+            timeout.cancel()
+
+    def handle_blocking(self, function, args, deadline=None, metrics=None, submitted=None, **kwargs):
+        """
+        Runs in BLOCKING_POOL thread, calls expired while queued are dropped
+        """
+        if kyoto.utils.deadlines.is_expired(deadline):
+            return kyoto.utils.deadlines.EXCEEDED
+        if metrics is None:
+            return self.handle_call(function, args, **kwargs)
+        start = time.time()
+        metrics.queue.record(start - submitted)
+        try:
+            return self.handle_call(function, args, **kwargs)
+        finally:
+            metrics.execution.record(time.time() - start)
+
+    @transform_exceptions
+    def handle_cast(self, function, args, priority=0, done=None, **kwargs):
+        if not self.executor.submit(function, args, kwargs, priority, done) and self.executor.policy == "reject":
+            return OVERLOADED
+
     @transform_exceptions
-    def handle_cast(self, function, args, **kwargs):
-        gevent.spawn(function, *args, **kwargs)
+    def handle_cpu_bound(self, rtype, function, args, deadline=None, **kwargs):
+        if kwargs.get("stream") is not None:
+            raise NotImplementedError("Streamed request can't be sent to process pool")
+        if rtype == ":call":
+            result = kyoto.utils.processes.submit(function, args, deadline=deadline)
+            try:
+                return kyoto.utils.processes.wait(result, kyoto.utils.deadlines.remaining(deadline))
+            except multiprocessing.TimeoutError:
+                return kyoto.utils.deadlines.EXCEEDED
+        else:
+            kyoto.utils.processes.submit(function, args, shared=False, deadline=deadline)
@@ -0,0 +1,21 @@
+"""
+Reserved module, which exposes metrics of server over BERT-RPC:
+
+    >>> service = kyoto.client.Service(address, ":kyoto_metrics")
+    >>> service.call(":snapshot", [])
+"""
+import kyoto.utils.metrics
+
+
+def snapshot():
+    """
+    Returns metrics of server process as dict
+    """
+    return kyoto.utils.metrics.registry.snapshot()
+
+
+def dump():
+    """
+    Returns metrics of server process in Prometheus text format
+    """
+    return kyoto.utils.metrics.registry.dump()
@@ -0,0 +1,165 @@
+import time
+import bisect
+import random
+import hashlib
+import itertools
+
+import beretta
+
+import kyoto.conf
+
+
+class Node(object):
+
+    """
+    Node of cluster with its health and load statistics.
+    Node is ejected after CLUSTER_MAX_FAILURES consecutive failures,
+    when ejection expires, single request probes it back in
+    """
+
+    __slots__ = ("address", "service", "outstanding", "latency", "failures",
+                 "ejections", "ejected_until", "probing")
+
+    def __init__(self, address, service):
+        self.address = address
+        self.service = service
+        self.outstanding = 0
+        self.latency = 0.0  # exponentially weighted moving average, in seconds
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0
+        self.probing = False
+
+    def is_available(self, now=None):
+        if not self.ejected_until:
+            return True
+        return not self.probing and (now or time.time()) >= self.ejected_until
+
+    def acquire(self):
+        if self.ejected_until:
+            self.probing = True
+        self.outstanding += 1
+
+    def succeed(self, elapsed):
+        self.outstanding -= 1
+        if self.latency:
+            self.latency += 0.3 * (elapsed - self.latency)
+        else:
+            self.latency = elapsed
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0
+        self.probing = False
+
+    def fail(self):
+        self.outstanding -= 1
+        self.failures += 1
+        if self.probing or self.failures >= kyoto.conf.settings.CLUSTER_MAX_FAILURES:
+            timeout = kyoto.conf.settings.CLUSTER_EJECT_TIME * 2 ** self.ejections
+            self.ejected_until = time.time() + min(timeout, kyoto.conf.settings.CLUSTER_MAX_EJECT_TIME)
+            self.ejections += 1
+        self.probing = False
+
+    def release(self):
+        """
+        Finishes request, which neither proves nor disproves node health
+        """
+        self.outstanding -= 1
+        self.probing = False
+
+
+def available(nodes):
+    """
+    Returns nodes, which may receive requests. When every node is ejected,
+    the one, which will come back first, is returned
+    """
+    now = time.time()
+    result = [node for node in nodes if node.is_available(now)]
+    return result or [min(nodes, key=lambda node: node.ejected_until)]
+
+
+class RoundRobin(object):
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.counter = itertools.count()
+
+    def select(self, function, args):
+        nodes = available(self.nodes)
+        return nodes[next(self.counter) % len(nodes)]
+
+
+class LeastOutstanding(object):
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def select(self, function, args):
+        nodes = available(self.nodes)
+        least = min(node.outstanding for node in nodes)
+        return random.choice([node for node in nodes if node.outstanding == least])
+
+
+class PowerOfTwoChoices(object):
+
+    """
+    Picks two random nodes and selects one with lower observed latency,
+    weighted by requests in flight
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def select(self, function, args):
+        nodes = available(self.nodes)
+        if len(nodes) < 2:
+            return nodes[0]
+        first, second = random.sample(nodes, 2)
+        cost = lambda node: node.latency * (node.outstanding + 1)
+        return first if cost(first) <= cost(second) else second
+
+
+def first_argument(function, args):
+    return beretta.encode(args[0] if args else None)
+
+
+class ConsistentHash(object):
+
+    """
+    Maps key extracted from arguments (first argument by default) to node
+    on hash ring, so equal keys hit the same node while it's available
+    """
+
+    def __init__(self, nodes, key=first_argument, replicas=None):
+        self.nodes = nodes
+        self.key = key
+        self.ring = []
+        for node in nodes:
+            for replica in range(replicas or kyoto.conf.settings.CLUSTER_HASH_REPLICAS):
+                point = "{0}:{1}-{2}".format(node.address[0], node.address[1], replica)
+                self.ring.append((self.hash(point.encode("utf-8")), node))
+        self.ring.sort(key=lambda point: point[0])
+        self.points = [point for point, _ in self.ring]
+
+    def hash(self, key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def select(self, function, args):
+        key = self.key(function, args)
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+        start = bisect.bisect(self.points, self.hash(key))
+        now = time.time()
+        for index in range(len(self.ring)):
+            node = self.ring[(start + index) % len(self.ring)][1]
+            if node.is_available(now):
+                return node
+        return available(self.nodes)[0]
+
+
+policies = {
+    "round_robin": RoundRobin,
+    "least_outstanding": LeastOutstanding,
+    "power_of_two": PowerOfTwoChoices,
+    "consistent_hash": ConsistentHash,
+}
@@ -1,8 +1,23 @@
+import time
+import collections
+
+import beretta
 import kyoto.conf
+import kyoto.utils.berp
+import kyoto.network.stream
 import gevent.coros
+import gevent.select
 import gevent.socket
 
 
+class AcquireTimeout(gevent.socket.timeout):
+
+    """
+    Raised, when no connection of pool is released in time. Pool of caller
+    is saturated, peer isn't at fault, so cluster node isn't ejected for it
+    """
+
+
 class BaseConnectionManager(object):
 
     def __init__(self, address):
@@ -11,13 +26,33 @@ class BaseConnectionManager(object):
 
     def create(self):
         """
-        Creates TCP connection
+        Creates TCP connection, compression of responses is negotiated, if it's enabled
         """
         connection = gevent.socket.create_connection(self.address, self.timeout)
         connection.setsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_KEEPALIVE, 1)
         connection.setsockopt(gevent.socket.IPPROTO_TCP, gevent.socket.TCP_NODELAY, 1)
+        if kyoto.conf.settings.COMPRESS_RESPONSE:
+            try:
+                self.negotiate(connection)
+            except Exception:
+                connection.close()
+                raise
         return connection
 
+    def negotiate(self, connection):
+        """
+        Announces, that compressed responses are accepted, and reads answer of server:
+        (:info, :compress, [:zlib]) or (:info, :compress, []). Server, which doesn't
+        support compression, answers with error. Returns True, if responses are compressed
+        """
+        message = beretta.encode((":info", ":compress", [":zlib"]))
+        connection.sendall(kyoto.utils.berp.pack(message))
+        try:
+            answer = next(kyoto.network.stream.receive(connection, server=False))
+        except StopIteration:
+            raise gevent.socket.error("Connection closed by {0}:{1}".format(*self.address))
+        return beretta.decode(answer) == (":info", ":compress", [":zlib"])
+
     def destroy(self, connection):
         """
         Closes connection
@@ -26,9 +61,16 @@ class BaseConnectionManager(object):
 
     def is_alive(self, connection):
         """
-        Checks that connection is still alive
+        Checks that connection is still alive: idle connection must not be
+        readable, otherwise peer closed it or it has unread garbage in buffer
         """
-        return not connection.closed
+        if connection.closed:
+            return False
+        try:
+            readable, _, _ = gevent.select.select([connection], [], [], 0)
+        except Exception:
+            return False
+        return not readable
 
     def acquire(self):
         """
@@ -42,12 +84,21 @@ class BaseConnectionManager(object):
         """
         raise NotImplementedError
 
+    def discard(self, connection):
+        """
+        Releases connection, which can't be reused: e.g. response
+        wasn't read completely or connection is broken
+        """
+        self.destroy(connection)
+        self.release(connection)
+
     def clear(self):
         """
         Closes all opened connections, must be used in __del__ method
         """
         raise NotImplementedError
 
+
 class SingleConnectionManager(BaseConnectionManager):
 
     """
@@ -63,6 +114,7 @@ class SingleConnectionManager(BaseConnectionManager):
     def clear(self):
         pass
 
+
 class SharedConnectionManager(BaseConnectionManager):
 
     """
@@ -75,13 +127,17 @@ class SharedConnectionManager(BaseConnectionManager):
         super(SharedConnectionManager, self).__init__(*args, **kwargs)
 
     def acquire(self):
-        if self.connection:
-            if not self.is_alive(self.connection):
-                self.destroy(self.connection)
+        if not self.semaphore.acquire(timeout=self.timeout):
+            message = "No free connection to {0}:{1} in {2} seconds"
+            raise AcquireTimeout(message.format(self.address[0], self.address[1], self.timeout))
+        try:  # connection is checked only when it's idle, reply of other caller may be readable
+            if self.connection is None or not self.is_alive(self.connection):
+                if self.connection is not None:
+                    self.destroy(self.connection)
                 self.connection = self.create()
-        else:
-            self.connection = self.create()
-        self.semaphore.acquire(timeout=self.timeout)
+        except Exception:
+            self.semaphore.release()
+            raise
         return self.connection
 
     def release(self, connection):
@@ -92,3 +148,108 @@ class SharedConnectionManager(BaseConnectionManager):
             self.semaphore.acquire()
             self.connection.close()
             self.semaphore.release()
+
+
+class PooledConnectionManager(BaseConnectionManager):
+
+    """
+    Bounded pool of reusable connections with idle eviction and max lifetime
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PooledConnectionManager, self).__init__(*args, **kwargs)
+        self.min_size = kyoto.conf.settings.CONNECTION_POOL_MIN_SIZE
+        self.max_size = kyoto.conf.settings.CONNECTION_POOL_MAX_SIZE
+        self.max_idle_time = kyoto.conf.settings.CONNECTION_POOL_MAX_IDLE_TIME
+        self.max_lifetime = kyoto.conf.settings.CONNECTION_POOL_MAX_LIFETIME
+        self.acquire_timeout = kyoto.conf.settings.CONNECTION_POOL_ACQUIRE_TIMEOUT
+        self.idle = collections.deque()
+        self.created = {}
+        self.semaphore = gevent.coros.BoundedSemaphore(self.max_size)
+        self.metrics = {
+            "acquired": 0,
+            "created": 0,
+            "destroyed": 0,
+            "timeouts": 0,
+            "wait_time": 0.0,
+            "max_wait_time": 0.0,
+        }
+
+    @property
+    def size(self):
+        return len(self.created)
+
+    def create(self):
+        connection = super(PooledConnectionManager, self).create()
+        self.created[connection] = time.time()
+        self.metrics["created"] += 1
+        return connection
+
+    def destroy(self, connection):
+        if self.created.pop(connection, None) is not None:
+            self.metrics["destroyed"] += 1
+        super(PooledConnectionManager, self).destroy(connection)
+
+    def is_expired(self, connection, now):
+        """
+        Checks that connection lived longer than allowed
+        """
+        return now - self.created.get(connection, now) > self.max_lifetime
+
+    def fill(self):
+        """
+        Opens connections up to minimal pool size
+        """
+        while self.size < self.min_size:
+            self.idle.append((self.create(), time.time()))
+
+    def evict(self, now):
+        """
+        Closes connections which were idle for too long, keeping minimal pool size
+        """
+        while self.idle and self.size > self.min_size:
+            connection, released = self.idle[0]
+            if now - released > self.max_idle_time:
+                self.idle.popleft()
+                self.destroy(connection)
+            else:
+                break
+
+    def acquire(self):
+        start = time.time()
+        if not self.semaphore.acquire(timeout=self.acquire_timeout):
+            self.metrics["timeouts"] += 1
+            message = "No free connection to {0}:{1} in {2} seconds"
+            raise AcquireTimeout(message.format(self.address[0], self.address[1], self.acquire_timeout))
+        now = time.time()
+        wait_time = now - start
+        self.metrics["acquired"] += 1
+        self.metrics["wait_time"] += wait_time
+        self.metrics["max_wait_time"] = max(self.metrics["max_wait_time"], wait_time)
+        try:
+            self.evict(now)
+            while self.idle:
+                connection, _ = self.idle.pop()
+                if self.is_expired(connection, now) or not self.is_alive(connection):
+                    self.destroy(connection)
+                else:
+                    return connection
+            connection = self.create()
+            self.fill()
+            return connection
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def release(self, connection):
+        now = time.time()
+        if connection.closed or self.is_expired(connection, now):
+            self.destroy(connection)
+        else:
+            self.idle.append((connection, now))
+        self.semaphore.release()
+
+    def clear(self):
+        while self.idle:
+            connection, _ = self.idle.pop()
+            self.destroy(connection)
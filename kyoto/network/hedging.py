@@ -0,0 +1,122 @@
+import time
+import collections
+
+import gevent
+
+import kyoto.conf
+
+
+class Latencies(object):
+
+    """
+    Sliding window of latencies of recent calls
+    """
+
+    __slots__ = ("samples",)
+
+    def __init__(self, size=None):
+        self.samples = collections.deque(maxlen=size or kyoto.conf.settings.CLIENT_HEDGE_WINDOW)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, elapsed):
+        self.samples.append(elapsed)
+
+    def percentile(self, percent):
+        """
+        Returns latency, which given percent of recent calls didn't exceed,
+        or None, while there are too few samples
+        """
+        if len(self.samples) < kyoto.conf.settings.CLIENT_HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(int(len(samples) * percent / 100.0), len(samples) - 1)]
+
+
+class Budget(object):
+
+    """
+    Every call deposits ratio of token, every hedge withdraws whole one,
+    so hedges never exceed given share of calls, even under overload
+    """
+
+    __slots__ = ("ratio", "capacity", "tokens")
+
+    def __init__(self, ratio=None, capacity=None):
+        self.ratio = kyoto.conf.settings.CLIENT_HEDGE_BUDGET if ratio is None else ratio
+        self.capacity = capacity or kyoto.conf.settings.CLIENT_HEDGE_BURST
+        self.tokens = 0.0
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.capacity)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Hedging(object):
+
+    """
+    Sends duplicate of call, which didn't return within CLIENT_HEDGE_PERCENTILE
+    of recent latencies, and returns first successful reply, the other call is killed.
+    Latencies are kept per key of calls (e.g. function or function and node),
+    so slow functions aren't hedged against fast ones. Only idempotent calls may be hedged
+    """
+
+    def __init__(self, percentile=None, latencies=None, budget=None):
+        self.percentile = percentile or kyoto.conf.settings.CLIENT_HEDGE_PERCENTILE
+        self.windows = {}  # key of calls -> Latencies
+        if latencies is not None:
+            self.windows[None] = latencies
+        self.budget = budget or Budget()
+        self.metrics = {
+            "calls": 0,
+            "hedged": 0,  # duplicates sent
+            "won": 0,  # duplicates, which replied first
+            "throttled": 0,  # duplicates not sent because of exhausted budget
+        }
+
+    def latencies(self, key=None):
+        """
+        Returns latencies of calls with given key
+        """
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = Latencies()
+        return window
+
+    def run(self, primary, backup, key=None):
+        """
+        Calls primary function, backup one is called when primary is late
+        """
+        self.metrics["calls"] += 1
+        self.budget.deposit()
+        start = time.time()
+        latencies = self.latencies(key)
+        delay = latencies.percentile(self.percentile)
+        calls = [gevent.spawn(primary)]
+        try:
+            calls[0].join(delay)
+            if not calls[0].ready():
+                if self.budget.withdraw():
+                    self.metrics["hedged"] += 1
+                    calls.append(gevent.spawn(backup))
+                else:
+                    self.metrics["throttled"] += 1
+            pending = list(calls)
+            while True:
+                call = gevent.wait(pending, count=1)[0]
+                pending.remove(call)
+                if call.successful() or not pending:
+                    break
+            if call.successful():
+                latencies.add(time.time() - start)
+                if call is not calls[0]:
+                    self.metrics["won"] += 1
+            return call.get()
+        finally:
+            gevent.killall(calls)  # loser is cancelled, as well as both calls on timeout
@@ -0,0 +1,158 @@
+import itertools
+import collections
+
+import beretta
+import gevent
+import gevent.coros
+import gevent.queue
+import gevent.socket
+
+import kyoto.conf
+import kyoto.network.stream
+import kyoto.network.connection
+
+
+class Pipeline(object):
+
+    """
+    One shared connection with many requests in flight.
+    Requests are written back-to-back, a reader greenlet matches
+    responses to waiters in order (server answers in order per connection).
+    Tagged requests may be answered out of order, responses are matched by tag
+    """
+
+    def __init__(self, address, tagged=None):
+        if tagged is None:
+            tagged = kyoto.conf.settings.PIPELINE_TAGGED
+        self.address = address
+        self.tagged = tagged
+        self.tags = itertools.count()
+        self.connections = kyoto.network.connection.SingleConnectionManager(address)
+        self.connection = None
+        self.waiters = collections.OrderedDict()
+        self.semaphore = gevent.coros.Semaphore()
+        self.depth = gevent.coros.BoundedSemaphore(kyoto.conf.settings.PIPELINE_MAX_DEPTH)
+
+    def open(self):
+        """
+        Returns current connection, opens new one with its own reader if required
+        """
+        if not self.connection:
+            self.connection = self.connections.create()
+            self.waiters = collections.OrderedDict()
+            gevent.spawn(self.read, self.connection, self.waiters)
+        return self.connection
+
+    def request(self, messages):
+        """
+        Writes given messages and returns iterator over response frames
+        """
+        queue = gevent.queue.Queue(max(kyoto.conf.settings.STREAM_WINDOW, 2))
+        self.depth.acquire()
+        with self.semaphore:
+            try:
+                connection = self.open()
+            except Exception:
+                self.depth.release()
+                raise
+            waiters = self.waiters
+            tag = next(self.tags)
+            waiters[tag] = queue
+            try:
+                writer = kyoto.network.stream.Writer(connection)
+                if self.tagged:
+                    writer.write(kyoto.network.stream.tag(tag))
+                for message in messages:
+                    writer.write(message)
+                writer.flush()
+            except Exception as exception:
+                self.fail(connection, waiters, exception)
+                raise
+        return self.receive(queue)
+
+    def receive(self, queue):
+        """
+        Yields response frames from waiter's queue. Queue is bounded, so reader
+        waits for slow consumer of streamed response instead of buffering it
+        """
+        complete = False
+        try:
+            for message in queue:
+                if isinstance(message, Exception):
+                    complete = True
+                    raise message
+                yield message
+            complete = True
+        finally:
+            if not complete:
+                self.drain(queue)
+
+    def drain(self, queue):
+        """
+        Discards rest of abandoned response, so reader isn't blocked by it
+        """
+        while not queue.empty():
+            if queue.get_nowait() is StopIteration:
+                return
+        gevent.spawn(lambda: [message for message in queue])
+
+    def read(self, connection, waiters):
+        """
+        Reads responses and dispatches their frames to waiters
+        """
+        stream = kyoto.network.stream.receive(connection, server=False)
+        queue = None
+        try:
+            while True:
+                queue = None
+                if self.tagged:
+                    message = kyoto.network.stream.term(stream)
+                    if message is None:
+                        break
+                    queue = waiters.pop(beretta.decode(message)[2][0])
+                empty = True
+                for message in kyoto.network.stream.response(stream):
+                    if queue is None:
+                        queue = waiters.popitem(last=False)[1]
+                    queue.put(message)
+                    empty = False
+                if empty:
+                    break
+                queue.put(StopIteration)
+                self.depth.release()
+        except Exception as exception:
+            if queue is not None:
+                self.abort(queue, exception)
+            self.fail(connection, waiters, exception)
+        else:
+            exception = gevent.socket.error("Connection closed by server")
+            if queue is not None:
+                self.abort(queue, exception)
+            self.fail(connection, waiters, exception)
+
+    def abort(self, queue, exception):
+        """
+        Wakes up waiter with given exception instead of the rest of response
+        """
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put(exception)
+        queue.put(StopIteration)
+        self.depth.release()
+
+    def fail(self, connection, waiters, exception):
+        """
+        Closes broken connection and wakes up all its waiters with given exception
+        """
+        if self.connection is connection:
+            self.connection = None
+        self.connections.destroy(connection)
+        while waiters:
+            self.abort(waiters.popitem(last=False)[1], exception)
+
+    def clear(self):
+        """
+        Closes pipelined connection
+        """
+        if self.connection:
+            self.fail(self.connection, self.waiters, gevent.socket.error("Connection closed by client"))
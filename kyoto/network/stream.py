@@ -1,9 +1,18 @@
 import io
+import os
+import mmap
+import numbers
+import stat
+import errno
 import types
 import beretta
+import gevent
+import gevent.coros
+import gevent.socket
 
 import kyoto.conf
 import kyoto.utils.berp
+import kyoto.utils.validation
 
 try:
     # Python 2.x
@@ -12,42 +21,410 @@ except NameError:
     # Python 3.x
     file = io.IOBase
 
+STREAM_INFO = beretta.encode((":info", ":stream", []))
+STREAM_ZLIB_INFO = beretta.encode((":info", ":stream", [":zlib"]))  # chunks are compressed
+INFO_PREFIX = b"\x83h\x03d\x00\x04info"  # encoded head of (:info, _, _) tuple
+IOV_MAX = 1024  # buffers per sendmsg call
 
-def send(source):
+
+class FileRange(object):
+
+    """
+    Extent of regular file, which is written to connection
+    with os.sendfile, without copying into user space
+    """
+
+    __slots__ = ("file", "offset", "length")
+
+    def __init__(self, file, offset=0, length=None):
+        if length is None:
+            length = os.fstat(file.fileno()).st_size - offset
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self):
+        self.file.seek(self.offset)
+        return self.file.read(self.length)
+
+
+def is_regular_file(source):
+    try:
+        return stat.S_ISREG(os.fstat(source.fileno()).st_mode)
+    except (AttributeError, EnvironmentError, ValueError):
+        return False  # file-like object without descriptor, e.g. io.BytesIO
+
+
+def extents(source):
+    """
+    Splits file-backed stream chunk into frames, which are written without copying:
+    regular files and file ranges into FileRange extents, mmaps into memoryview slices.
+    Other chunks are yielded as is
+    """
+    size = min(kyoto.conf.settings.FILE_CHUNK_SIZE, kyoto.conf.settings.MAX_BERP_SIZE)
+    if isinstance(source, FileRange):
+        for offset in range(0, source.length, size):
+            length = min(size, source.length - offset)
+            yield FileRange(source.file, source.offset + offset, length)
+    elif isinstance(source, mmap.mmap):
+        try:
+            view = memoryview(source)
+        except TypeError:
+            # Python 2.x, mmap doesn't support new buffer protocol
+            for offset in range(0, len(source), size):
+                yield source[offset:offset + size]
+        else:
+            try:
+                for offset in range(0, len(view), size):
+                    chunk = view[offset:offset + size]
+                    try:
+                        yield chunk
+                    finally:
+                        chunk.release()  # chunk is written out, so handler may close its map once resumed
+            finally:
+                view.release()
+    elif isinstance(source, file):
+        try:
+            if is_regular_file(source):
+                for extent in extents(FileRange(source, source.tell())):
+                    yield extent
+            else:
+                while source:
+                    chunk = source.read(kyoto.conf.settings.READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            source.close()
+    else:
+        yield source
+
+
+def chunks(source):
+    """
+    Yields raw chunks of given stream source, followed by empty terminator
+    """
     if isinstance(source, file):
-        while source:
-            chunk = source.read(kyoto.conf.settings.READ_CHUNK_SIZE)
-            if not chunk:
-                break
-            yield kyoto.utils.berp.pack(chunk)
-        source.close()
+        for chunk in extents(source):
+            yield chunk
     elif isinstance(source, types.GeneratorType):
         for chunk in source:
-            yield kyoto.utils.berp.pack(chunk)
+            yield chunk
     else:
         raise ValueError("Stream must be file-like or generator object")
-    yield b"\x00\x00\x00\x00"
+    yield b""
 
 
-def receive(connection, server=True):
-    receive_buffer = b""
-    while connection:
-        message = connection.recv(kyoto.conf.settings.READ_CHUNK_SIZE)
+def send(source):
+    for chunk in chunks(source):
+        if isinstance(chunk, FileRange):
+            chunk = chunk.read()
+        yield kyoto.utils.berp.pack(chunk)
+
+
+def sendfile(connection, extent):
+    """
+    Writes file extent to connection with os.sendfile, falls back to
+    reading of extent, where sendfile isn't available
+    """
+    try:
+        fileno = connection.fileno()
+    except AttributeError:
+        fileno = None
+    if fileno is None or not hasattr(os, "sendfile"):
+        return connection.sendall(extent.read())
+    offset, length = extent.offset, extent.length
+    while length:
+        try:
+            sent = os.sendfile(fileno, extent.file.fileno(), offset, length)
+        except EnvironmentError as exception:
+            if exception.errno == errno.EAGAIN:
+                gevent.socket.wait_write(fileno, timeout=connection.gettimeout())
+                continue
+            raise
+        if not sent:
+            message = "File is shorter than its range: {0} bytes are missing"
+            raise ValueError(message.format(length))
+        offset += sent
+        length -= sent
+
+
+def sendall(connection, buffers, flags=0):
+    """
+    Writes all given buffers to connection: with scatter/gather sendmsg
+    where it's available, otherwise small buffers are joined together
+    """
+    sendmsg = getattr(connection, "sendmsg", None)
+    if sendmsg:
+        buffers = [memoryview(buffer) for buffer in buffers]
+        position = 0
+        while position < len(buffers):
+            sent = sendmsg(buffers[position:position + IOV_MAX], (), flags)
+            while sent:
+                length = len(buffers[position])
+                if sent >= length:
+                    sent -= length
+                    position += 1
+                else:
+                    buffers[position] = buffers[position][sent:]
+                    sent = 0
+            while position < len(buffers) and not len(buffers[position]):
+                position += 1
+    else:
+        pending = []
+        for buffer in buffers:
+            if len(buffer) >= kyoto.conf.settings.WRITE_BUFFER_SIZE:
+                if pending:
+                    connection.sendall(b"".join(pending))
+                    pending = []
+                connection.sendall(buffer)
+            else:
+                pending.append(buffer)
+        if pending:
+            connection.sendall(b"".join(pending))
+
+
+class Writer(object):
+
+    """
+    Buffers outgoing BERP frames and writes them with scatter/gather I/O:
+    headers are never concatenated with payloads and many small frames
+    go out with one system call
+    """
+
+    __slots__ = ("connection", "buffers", "size", "lock", "deferred")
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.buffers = []
+        self.size = 0
+        self.lock = gevent.coros.Semaphore()  # buffers of deferred flush go out as a whole
+        self.deferred = None
+
+    def write(self, message):
+        if isinstance(message, FileRange):
+            return self.write_file(message)
+        if not isinstance(message, (bytes, bytearray, memoryview)):
+            message = message.encode("utf-8")
+        self.buffers.append(kyoto.utils.berp.header(len(message)))
         if message:
-            receive_buffer += message
-            while len(receive_buffer) >= 4:
+            self.buffers.append(message)
+        self.size += 4 + len(message)
+        if self.size >= kyoto.conf.settings.WRITE_BUFFER_SIZE or isinstance(message, memoryview):
+            self.flush()  # views borrow memory of their source, which is released by extents
+
+    def write_file(self, extent):
+        """
+        Writes file extent as one frame: pending buffers with header
+        go first (corked with MSG_MORE, where it's available), body is sent with sendfile
+        """
+        self.buffers.append(kyoto.utils.berp.header(len(extent)))
+        self.flush(getattr(gevent.socket, "MSG_MORE", 0))
+        sendfile(self.connection, extent)
+
+    def flush(self, flags=0):
+        if self.buffers:
+            with self.lock:
+                buffers, self.buffers, self.size = self.buffers, [], 0
+                sendall(self.connection, buffers, flags)
+
+    def defer(self):
+        """
+        Flushes buffered frames, as soon as current greenlet waits for anything:
+        frames written without waiting are still coalesced, but slow handler
+        or next pipelined request doesn't hold them back
+        """
+        if self.buffers and self.deferred is None:
+            self.deferred = gevent.spawn(self.flush_deferred)
+
+    def flush_deferred(self):
+        self.deferred = None
+        try:
+            self.flush()
+        except EnvironmentError:
+            self.connection.close()  # writing greenlet fails on closed connection
+
+
+def receive(connection, server=True, framer=None):
+    framer = framer or kyoto.utils.berp.Framer()
+    while connection:
+        size = connection.recv_into(framer.writable())
+        if size:
+            framer.commit(size)
+            while True:
                 try:
-                    _, message, tail = kyoto.utils.berp.unpack(receive_buffer)
-                except ValueError as exception:
-                    break  # received incomplete packet, continue loop
+                    message = framer.pop()
                 except kyoto.utils.berp.MaxBERPSizeError as exception:
                     if server:
                         exception = (":error", (":protocol", 3, "MaxBERPSizeError", str(exception), []))
                         exception = kyoto.utils.berp.pack(beretta.encode(exception))
                         connection.sendall(exception)
                     raise
-                else:
-                    receive_buffer = tail
-                    yield message
+                if message is None:
+                    break  # received incomplete packet, continue loop
+                yield message
         else:
             break
+
+
+def is_info(message, info_type):
+    """
+    Checks that encoded term is an info of given type: (:info, info_type, [...])
+    """
+    if message[:len(INFO_PREFIX)] == INFO_PREFIX:
+        try:
+            info = beretta.decode(message)
+        except ValueError:
+            return False
+        return kyoto.utils.validation.is_valid_info(info) and info[1] == info_type
+    return False
+
+
+def is_fragment_info(message):
+    """
+    Checks that term is a header of fragmented term: (:info, :fragment, [length])
+    """
+    return is_info(message, ":fragment")
+
+
+def is_cache_info(message):
+    """
+    Checks that term is a caching hint of following reply: (:info, :cache, [...])
+    """
+    return is_info(message, ":cache")
+
+
+def is_tag_info(message):
+    """
+    Checks that term is a tag of following request or response: (:info, :tag, [tag])
+    """
+    return is_info(message, ":tag")
+
+
+def is_deadline_info(message):
+    """
+    Checks that term is a timeout of following request: (:info, :deadline, [seconds])
+    """
+    return is_info(message, ":deadline")
+
+
+def tag(value):
+    """
+    Returns encoded tag, which matches response to request,
+    when responses are sent out of order
+    """
+    return beretta.encode((":info", ":tag", [value]))
+
+
+def fragment(message):
+    """
+    Splits encoded term, which doesn't fit into MAX_BERP_SIZE, into
+    fragment header, slices of at most FRAGMENT_SIZE bytes and empty terminator
+    """
+    length = len(message)
+    if length > kyoto.conf.settings.MAX_FRAGMENTED_SIZE:
+        error = "Invalid fragmented term length: {0}/{1}"
+        raise kyoto.utils.berp.MaxBERPSizeError(
+            error.format(kyoto.conf.settings.MAX_FRAGMENTED_SIZE, length)
+        )
+    size = min(kyoto.conf.settings.FRAGMENT_SIZE, kyoto.conf.settings.MAX_BERP_SIZE)
+    view = memoryview(message)
+    frames = [beretta.encode((":info", ":fragment", [length]))]
+    frames.extend(view[offset:offset + size] for offset in range(0, length, size))
+    frames.append(b"")
+    return frames
+
+
+def frames(message):
+    """
+    Returns frames of encoded term, fragmented if it doesn't fit into MAX_BERP_SIZE
+    """
+    if len(message) > kyoto.conf.settings.MAX_BERP_SIZE:
+        return fragment(message)
+    else:
+        return (message,)
+
+
+class Assembler(object):
+
+    """
+    Reassembles fragmented term, buffer grows as fragments arrive, so it's
+    never larger than received data. Invalid term is skipped up to its
+    terminator to keep connection in sync, its error is raised by result
+    """
+
+    __slots__ = ("length", "buffer", "error")
+
+    def __init__(self, info):
+        self.length = info[2][0] if len(info[2]) == 1 else None
+        self.buffer = bytearray()
+        self.error = None
+        if not isinstance(self.length, numbers.Integral) or isinstance(self.length, bool) or self.length < 0:
+            self.error = ValueError("Invalid fragmented term header: {0}".format(info))
+        elif self.length > kyoto.conf.settings.MAX_FRAGMENTED_SIZE:
+            error = "Invalid fragmented term length: {0}/{1}"
+            self.error = kyoto.utils.berp.MaxBERPSizeError(
+                error.format(kyoto.conf.settings.MAX_FRAGMENTED_SIZE, self.length)
+            )
+
+    def feed(self, message):
+        if self.error is not None:
+            return  # fragments of invalid term are dropped
+        end = len(self.buffer) + len(message)
+        if end > self.length:
+            error = "Fragment overflows term length: {0}/{1}"
+            self.error = ValueError(error.format(end, self.length))
+            self.buffer = bytearray()
+        else:
+            self.buffer += message
+
+    def result(self):
+        if self.error is None and len(self.buffer) != self.length:
+            error = "Incomplete fragmented term: received {0} of {1} bytes"
+            self.error = ValueError(error.format(len(self.buffer), self.length))
+        if self.error is not None:
+            raise self.error
+        return self.buffer
+
+
+def term(stream):
+    """
+    Returns next encoded term from frame stream, fragmented terms are
+    reassembled; None, if stream is over
+    """
+    for message in stream:
+        if is_fragment_info(message):
+            assembler = Assembler(beretta.decode(message))
+            for message in stream:
+                if not message:
+                    return assembler.result()
+                assembler.feed(message)
+            raise ValueError("Incomplete fragmented term: stream is over")
+        return message
+    return None
+
+
+def response(stream):
+    """
+    Yields frames of exactly one response from given frame stream:
+    a single reply (optionally preceded by caching hint) or stream header,
+    reply and chunks up to empty terminator.
+    Fragmented terms are yielded reassembled
+    """
+    message = term(stream)
+    if message is not None and is_cache_info(message):
+        yield message
+        message = term(stream)
+    if message is not None:
+        yield message
+        if message == STREAM_INFO or message == STREAM_ZLIB_INFO:
+            message = term(stream)
+            if message is not None:
+                yield message
+                for message in stream:
+                    yield message
+                    if not message:
+                        break
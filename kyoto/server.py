@@ -1,123 +1,642 @@
+import os
+import time
+import errno
+import signal
 import logging
+import itertools
+import importlib
+import multiprocessing
 import beretta
 import traceback
 
 import gevent
+import gevent.pool
+import gevent.coros
+import gevent.event
 import gevent.queue
 import gevent.socket
 import gevent.server
 
+import kyoto
 import kyoto.conf
+import kyoto.kyoto_metrics
 import kyoto.dispatch
 import kyoto.utils.berp
+import kyoto.utils.codec
+import kyoto.utils.access
 import kyoto.utils.validation
+import kyoto.utils.metrics
+import kyoto.utils.executor
+import kyoto.utils.deadlines
+import kyoto.utils.compression
 import kyoto.network.stream
 
 
+CORRUPT_REQUEST = kyoto.utils.codec.constant((":error", (":server", 3, "ValueError", "Corrupt request data", [])))
+COMPRESS_ACCEPTED = kyoto.utils.codec.constant((":info", ":compress", [":zlib"]))
+COMPRESS_REFUSED = kyoto.utils.codec.constant((":info", ":compress", []))
+
+
 class Agent(object):
 
     __slots__ = ("state", "address", "logger", "dispatcher")
 
-    def __init__(self, modules, address):
+    def __init__(self, modules, address, table=None, executor=None):
         self.state = {
             "stream": {
                 "on": False,
                 "request": None,
+                "stalls": 0,
+                "stall_time": 0.0,
             },
+            "compress": None,
+            "fragment": None,
         }
         self.address = address
         self.logger = logging.getLogger("kyoto.server.Agent")
-        self.dispatcher = kyoto.dispatch.Dispatcher(modules, address)
+        self.dispatcher = kyoto.dispatch.Dispatcher(modules, address, table, executor)
 
-    def transform_response(function):
-        def transform(*args, **kwargs):
-            response = function(*args, **kwargs)
+    def is_concurrent(self, message):
+        """
+        Returns true if message is a complete request, which doesn't depend
+        on state of connection and may be handled concurrently with others
+        """
+        if self.state["stream"]["on"] or self.state["fragment"]:
+            return False
+        return message[:len(kyoto.network.stream.INFO_PREFIX)] != kyoto.network.stream.INFO_PREFIX
+
+    def decode(self, message):
+        """
+        Decodes request, returns it with its entry of dispatch table (or None).
+        Envelope is parsed first, so unknown functions are refused without
+        decoding arguments. Large binary arguments of functions without cache
+        are passed as memoryviews of message (DECODE_ZERO_COPY_SIZE)
+        """
+        header = kyoto.utils.codec.decode_header(message)
+        if header is None:
+            request = kyoto.utils.codec.decode(message)
+            if kyoto.utils.validation.is_valid_request(request):
+                return request, self.dispatcher.table.get(request[1], request[2])
+            return request, None
+        rtype, module, function, offset = header
+        entry = self.dispatcher.table.get(module, function)
+        if entry is None or entry.private:
+            return (rtype, module, function, []), entry  # dispatcher replies with error, arguments aren't needed
+        size = kyoto.conf.settings.DECODE_ZERO_COPY_SIZE
+        if size and entry.flight is None:  # keys of cache are encoded from arguments
+            return (rtype, module, function, kyoto.utils.codec.decode_args(message, offset, size)), entry
+        return kyoto.utils.codec.decode(message), entry
+
+    def feed(self, message):
+        """
+        Puts streamed chunk into bounded queue of worker. When queue is full,
+        connection isn't read until worker consumes some chunks (backpressure).
+        If worker waits for connection too, because its outbox is full,
+        ready frames of response are yielded before request stream is over
+        """
+        stream = self.state["stream"]
+        if stream["finished"].is_set():
+            return  # handler doesn't consume stream anymore, chunk is dropped
+        if not stream["queue"].full():
+            stream["queue"].put(message)
+            return
+        start = time.time()
+        putter = gevent.spawn(stream["queue"].put, message)
+        while not putter.ready():
+            gevent.wait([putter, stream["ready"]], count=1)
+            if stream["ready"].is_set():
+                stream["ready"].clear()
+                for frame in self.flush():
+                    yield frame
+        elapsed = time.time() - start
+        stream["stalls"] += 1
+        stream["stall_time"] += elapsed
+        kyoto.utils.metrics.registry.stream_stalls += 1
+        kyoto.utils.metrics.registry.stream_stall_time += elapsed
+
+    def consume(self, response, outbox, ready):
+        """
+        Runs handler of streamed request concurrently with receiving of stream,
+        response terms are handed to connection through bounded outbox
+        """
+        try:
+            for message in response:
+                if outbox.full():
+                    ready.set()  # connection may wait for room in request queue
+                outbox.put(message)
+        finally:
+            if outbox.full():
+                ready.set()
+            outbox.put(StopIteration)
+
+    def results(self, outbox, worker):
+        """
+        Yields response terms from outbox of worker, exception of handler is re-raised
+        """
+        for message in outbox:
+            yield message
+        worker.get()
+
+    def flush(self):
+        """
+        Yields frames of response to streamed request, which are ready to be written
+        """
+        stream = self.state["stream"]
+        while not stream["outbox"].empty():
             try:
-                message = next(response)
+                yield next(stream["frames"])
             except StopIteration:
-                pass
+                return
+
+    def drain(self, queue):
+        """
+        Unblocks connection, when handler has finished without consuming whole stream
+        """
+        kyoto.utils.metrics.registry.streams.discard(queue)
+        while not queue.empty():
+            queue.get_nowait()
+
+    def transform_term(self, message, level):
+        """
+        Yields frames of encoded term: compressed, if negotiated,
+        and split into fragments, if it doesn't fit into MAX_BERP_SIZE
+        """
+        if level is not None:
+            message = kyoto.utils.compression.compress_term(message, level)
+        try:
+            frames = kyoto.network.stream.frames(message)
+        except kyoto.utils.berp.MaxBERPSizeError as exception:
+            name = exception.__class__.__name__
+            description = str(exception)
+            trace = traceback.format_exc().splitlines()
+            yield beretta.encode((":error", (":user", 500, name, description, trace)))
+        else:
+            for frame in frames:
+                yield frame
+
+    def transform(self, response):
+        """
+        Yields encoded frames of response terms
+        """
+        level = self.state["compress"]
+        try:
+            message = next(response)
+        except StopIteration:
+            pass
+        else:
+            if message == (":info", ":stream", []):
+                if level is None:
+                    yield kyoto.network.stream.STREAM_INFO
+                else:
+                    yield kyoto.network.stream.STREAM_ZLIB_INFO
+                for frame in self.transform_term(kyoto.utils.codec.encode_response(next(response)), level):
+                    yield frame
+                for message in response:
+                    for chunk in kyoto.network.stream.extents(message):
+                        if level is None:
+                            yield chunk
+                        else:
+                            if isinstance(chunk, kyoto.network.stream.FileRange):
+                                chunk = chunk.read()
+                            yield kyoto.utils.compression.compress_chunk(chunk, level)
+                yield b""
             else:
-                yield beretta.encode(message)
-                if message == (":info", ":stream", []):
-                    yield beretta.encode(next(response))
-                    for message in response:
-                        yield message
-                    yield b""
+                if kyoto.utils.validation.is_valid_info(message) and message[1] == ":cache":
+                    yield kyoto.utils.codec.encode(message)
+                    message = next(response)
+                if not isinstance(message, bytes):
+                    message = kyoto.utils.codec.encode_response(message)  # cached replies are encoded already
+                for frame in self.transform_term(message, level):
+                    yield frame
+
+    def transform_response(function):
+        def transform(self, *args, **kwargs):
+            return self.transform(function(self, *args, **kwargs))
         return transform
 
+    def handle(self, message, deadline=None):
+        """
+        Returns encoded frames of response to message
+        """
+        stream = self.state["stream"]
+        if stream["on"] and stream["request"] and not self.state["fragment"]:
+            return self.receive(message)
+        return self.respond(message, deadline)
+
+    def receive(self, message):
+        """
+        Feeds chunk of streamed request to its worker,
+        the rest of response is yielded after end of stream
+        """
+        stream = self.state["stream"]
+        if message:
+            for frame in self.feed(message):
+                yield frame
+            return
+        stream["on"] = False
+        stream["request"] = None
+        for frame in self.feed(StopIteration):
+            yield frame
+        if stream["stalls"]:
+            message = "{0}:{1} stream stalled {2} times for {3:.3f} seconds"
+            self.logger.debug(message.format(self.address[0], self.address[1], stream["stalls"], stream["stall_time"]))
+        for frame in stream["frames"]:
+            yield frame
+
     @transform_response
-    def handle(self, message):
+    def respond(self, message, deadline=None):
+        if self.state["fragment"]:
+            if message:
+                self.state["fragment"].feed(message)
+                return
+            assembler, self.state["fragment"] = self.state["fragment"], None
+            try:
+                message = assembler.result()
+            except kyoto.utils.berp.MaxBERPSizeError as exception:
+                yield (":error", (":protocol", 3, "MaxBERPSizeError", str(exception), []))
+                return
+            except ValueError:
+                yield CORRUPT_REQUEST
+                return
+        elif not self.state["stream"]["on"] or not self.state["stream"]["request"]:
+            if kyoto.network.stream.is_fragment_info(message):
+                self.state["fragment"] = kyoto.network.stream.Assembler(beretta.decode(message))
+                return
         if not self.state["stream"]["on"]:
             try:
-                request = beretta.decode(message)
+                request, entry = self.decode(message)
             except ValueError:
-                yield (":error", (":server", 3, "ValueError", "Corrupt request data", []))
+                yield CORRUPT_REQUEST
             else:
-                self.logger.info("{1}:{2} ~> {0}".format(request, *self.address))
                 if kyoto.utils.validation.is_valid_request(request):
-                    for message in self.dispatcher.handle(request):
-                        yield message
+                    kyoto.utils.access.log(self.address, request)
+                    responses = self.dispatcher.handle(request, deadline, entry)
+                    if entry is None or entry.metrics is None:
+                        for response in responses:
+                            yield response
+                        return
+                    metrics = entry.metrics
+                    metrics.bytes_in += len(message)
+                    streaming = False
+                    for response in responses:
+                        if response == (":info", ":stream", []):
+                            streaming = True  # reply of stream is encoded along with compression of its chunks
+                        elif not streaming and isinstance(response, tuple) and response[0] != ":info":
+                            start = time.time()  # replies are encoded here to measure encoding separately
+                            response = kyoto.utils.codec.encode_response(response)
+                            metrics.encode.record(time.time() - start)
+                        if isinstance(response, bytes):
+                            metrics.bytes_out += len(response)
+                        yield response
                 elif kyoto.utils.validation.is_valid_info(request):
                     if request[1] == ":stream":
                         self.state["stream"]["on"] = True
-                        self.state["stream"]["queue"] = gevent.queue.Queue()
+                        self.state["stream"]["stalls"] = 0
+                        self.state["stream"]["stall_time"] = 0.0
+                    elif request[1] == ":compress":  # client reads answer, before connection is used
+                        if kyoto.conf.settings.COMPRESS_RESPONSE and ":zlib" in request[2]:
+                            self.state["compress"] = kyoto.conf.settings.COMPRESS_LEVEL
+                            yield COMPRESS_ACCEPTED
+                        else:
+                            yield COMPRESS_REFUSED
                     else:
                         raise NotImplementedError
                 else:
                     yield (":error", (":server", 4, "ValueError", "Invalid MFA: {0}".format(request), []))
-        else:
-            if not self.state["stream"]["request"]:
-                try:
-                    request = beretta.decode(message)
-                except ValueError:
-                    self.state["stream"]["on"] = False
-                    yield (":error", (":server", 3, "ValueError", "Corrupt request data", []))
-                else:
-                    if kyoto.utils.validation.is_valid_request(request):
-                        self.state["stream"]["request"] = request
-                        self.state["stream"]["worker"] = gevent.spawn(self.dispatcher.handle,
-                                                                      self.state["stream"]["request"],
-                                                                      stream=self.state["stream"]["queue"])
-                    else:
-                        raise NotImplementedError
+        else:  # request of stream, its chunks are handled by receive
+            try:
+                request, entry = self.decode(message)
+            except ValueError:
+                self.state["stream"]["on"] = False
+                yield CORRUPT_REQUEST
             else:
-                if message:
-                    self.state["stream"]["queue"].put(message)
+                if kyoto.utils.validation.is_valid_request(request):
+                    kyoto.utils.access.log(self.address, request)
+                    window = entry and entry.stream_window or kyoto.conf.settings.STREAM_WINDOW
+                    queue = gevent.queue.Queue(window)
+                    outbox = gevent.queue.Queue(window + 2)  # room for reply and end of response
+                    ready = gevent.event.Event()
+                    finished = gevent.event.Event()  # handler has returned, stream isn't consumed anymore
+                    finished.rawlink(lambda finished: self.drain(queue))
+                    done = finished if request[0] == ":cast" else None  # casts are run by executor
+                    response = self.dispatcher.handle(request, deadline, entry, stream=queue, done=done)
+                    worker = gevent.spawn(self.consume, response, outbox, ready)
+                    if done is None:
+                        worker.link(lambda worker: finished.set())
+                    if entry is not None and entry.metrics is not None:
+                        entry.metrics.bytes_in += len(message)
+                        kyoto.utils.metrics.registry.streams.add(queue)
+                    self.state["stream"]["request"] = request
+                    self.state["stream"]["queue"] = queue
+                    self.state["stream"]["outbox"] = outbox
+                    self.state["stream"]["ready"] = ready
+                    self.state["stream"]["worker"] = worker
+                    self.state["stream"]["finished"] = finished
+                    self.state["stream"]["frames"] = self.transform(self.results(outbox, worker))
                 else:
-                    self.state["stream"]["on"] = False
-                    self.state["stream"]["request"] = None
-                    self.state["stream"]["queue"].put(StopIteration)
-                    response = self.state["stream"]["worker"].get()
-                    for message in response:
-                        yield message
+                    raise NotImplementedError
 
 
 class BertRPCServer(gevent.server.StreamServer):
 
-    def __init__(self, modules):
+    def __init__(self, modules, listener=None):
         self.modules = modules
+        if kyoto.conf.settings.SERVER_METRICS:
+            modules = list(modules) + [kyoto.kyoto_metrics]
+        self.table = kyoto.dispatch.Table(modules)
+        self.executor = kyoto.utils.executor.Executor()  # runs casts of all connections
+        kyoto.utils.metrics.registry.gauges["cast_queue"] = self.executor.depth
         self.address = kyoto.conf.settings.BIND_ADDRESS
         self.logger = logging.getLogger("kyoto.server.BertRPCServer")
-        super(BertRPCServer, self).__init__(self.address)
+        super(BertRPCServer, self).__init__(listener or self.address)
+
+    def stop(self, *args, **kwargs):
+        super(BertRPCServer, self).stop(*args, **kwargs)
+        self.executor.stop()
 
     def handle(self, connection, address):
-        self.logger.info("{0}:{1} connected".format(*address))
-        agent = Agent(self.modules, address)
-        stream = kyoto.network.stream.receive(connection)
+        self.logger.debug("%s:%s connected", *address)
+        agent = Agent(self.modules, address, self.table, self.executor)
+        kyoto.utils.metrics.registry.connections += 1
+        framer = kyoto.utils.berp.Framer()
+        writer = kyoto.network.stream.Writer(connection)
+        stream = kyoto.network.stream.receive(connection, framer=framer)
+        concurrency = kyoto.conf.settings.SERVER_CONCURRENCY
         try:
-            for request in stream:
-                for response in agent.handle(request):
-                    try:
-                        message = kyoto.utils.berp.pack(response)
-                    except kyoto.utils.berp.MaxBERPSizeError as exception:
-                        name = exception.__class__.__name__
-                        description = str(exception)
-                        trace = traceback.format_exc().splitlines()
-                        message = (":error", (":user", 500, name, description, trace))
-                        message = kyoto.utils.berp.pack(beretta.encode(message))
-                    connection.sendall(message)
+            if concurrency > 1:
+                self.handle_concurrently(connection, agent, writer, stream, concurrency)
+            else:
+                tag = deadline = None
+                for request in stream:
+                    if kyoto.network.stream.is_tag_info(request):
+                        tag = beretta.decode(request)[2][0]
+                        continue
+                    if kyoto.network.stream.is_deadline_info(request):
+                        deadline = kyoto.utils.deadlines.get_deadline(beretta.decode(request))
+                        continue
+                    if self.write(writer, agent.handle(request, deadline), tag):
+                        tag = deadline = None
+                    if framer.ready():
+                        writer.defer()  # replies to pipelined requests are coalesced, until handler waits
+                    else:
+                        writer.flush()
         except Exception as exception:
             self.logger.exception(exception)
         finally:
             connection.close()
-        self.logger.info("{0}:{1} disconnected".format(*address))
+            kyoto.utils.metrics.registry.connections -= 1
+        self.logger.debug("%s:%s disconnected", *address)
+
+    def handle_concurrently(self, connection, agent, writer, stream, concurrency):
+        """
+        Runs every complete request in its own greenlet, at most given number
+        per connection. Replies are written by sequencer in order of requests,
+        tagged replies are written as soon as they are ready
+        """
+        lock = gevent.coros.Semaphore()
+        slots = gevent.coros.BoundedSemaphore(concurrency)
+        sequence = gevent.queue.JoinableQueue()
+        workers = gevent.pool.Group()
+        workers.spawn(self.sequence, connection, writer, lock, slots, sequence)
+        tag = deadline = None
+        try:
+            for request in stream:
+                if kyoto.network.stream.is_tag_info(request):
+                    tag = beretta.decode(request)[2][0]
+                elif kyoto.network.stream.is_deadline_info(request):
+                    deadline = kyoto.utils.deadlines.get_deadline(beretta.decode(request))
+                elif agent.is_concurrent(request):
+                    slots.acquire()
+                    worker = gevent.spawn(self.respond, agent.handle(request, deadline))
+                    if tag is None:
+                        sequence.put(worker)
+                    else:
+                        workers.spawn(self.write_tagged, connection, writer, lock, slots, worker, tag)
+                    tag = deadline = None
+                else:
+                    sequence.join()  # request depends on state, earlier replies go first
+                    with lock:
+                        if self.write(writer, agent.handle(request, deadline), tag):
+                            tag = deadline = None
+                        writer.flush()
+        finally:
+            sequence.put(StopIteration)
+            workers.join()
+
+    def respond(self, responses):
+        """
+        Runs request handler until first frame of its response is produced
+        """
+        for response in responses:
+            return itertools.chain((response,), responses)
+        return responses
+
+    def sequence(self, connection, writer, lock, slots, sequence):
+        """
+        Writes untagged replies in order of requests
+        """
+        for worker in sequence:
+            try:
+                responses = worker.get()
+                with lock:
+                    self.write(writer, responses)
+                    if sequence.empty() or not sequence.peek().ready():
+                        writer.flush()
+            except Exception as exception:
+                self.logger.exception(exception)
+                connection.close()
+            finally:
+                slots.release()
+                sequence.task_done()
+
+    def write_tagged(self, connection, writer, lock, slots, worker, tag):
+        """
+        Writes tagged reply as soon as it's ready
+        """
+        try:
+            responses = worker.get()
+            with lock:
+                self.write(writer, responses, tag)
+                writer.flush()
+        except Exception as exception:
+            self.logger.exception(exception)
+            connection.close()
+        finally:
+            slots.release()
+
+    def write(self, writer, responses, tag=None):
+        """
+        Writes frames of response, preceded by tag of request, if any.
+        Returns False, if handler didn't respond yet
+        """
+        written = streaming = False
+        for response in responses:
+            if tag is not None and not written:
+                writer.write(kyoto.network.stream.tag(tag))
+            written = True
+            try:
+                writer.write(response)
+            except kyoto.utils.berp.MaxBERPSizeError as exception:
+                name = exception.__class__.__name__
+                description = str(exception)
+                trace = traceback.format_exc().splitlines()
+                message = (":error", (":user", 500, name, description, trace))
+                writer.write(beretta.encode(message))
+            if streaming:
+                writer.defer()  # chunks are coalesced, until generator of handler waits
+            elif response is kyoto.network.stream.STREAM_INFO or response is kyoto.network.stream.STREAM_ZLIB_INFO:
+                streaming = True
+        return written
+
+
+def load_modules(modules):
+    """
+    Imports given modules, dotted names are resolved with importlib
+    """
+    return [importlib.import_module(module) if isinstance(module, str) else module
+            for module in modules]
+
+
+def listen(address, reuse_port=False, backlog=None):
+    """
+    Returns listening socket bound to given address.
+    With reuse_port every process binds its own socket and kernel
+    balances incoming connections between them
+    """
+    listener = gevent.socket.socket(gevent.socket.AF_INET, gevent.socket.SOCK_STREAM)
+    listener.setsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if not hasattr(gevent.socket, "SO_REUSEPORT"):
+            raise NotImplementedError("SO_REUSEPORT isn't supported by platform")
+        listener.setsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_REUSEPORT, 1)
+    listener.bind(address)
+    listener.listen(backlog or kyoto.conf.settings.SERVER_BACKLOG)
+    listener.setblocking(0)
+    return listener
+
+
+class Supervisor(object):
+
+    """
+    Forks workers, which serve INSTALLED_MODULES on one address,
+    and restarts them when they die. Listener is either bound once before fork
+    and inherited by workers, or bound by every worker with SO_REUSEPORT
+    """
+
+    def __init__(self, modules=None, workers=None, reuse_port=None):
+        if modules is None:
+            modules = kyoto.conf.settings.INSTALLED_MODULES
+        if workers is None:
+            workers = kyoto.conf.settings.SERVER_WORKERS
+        if reuse_port is None:
+            reuse_port = kyoto.conf.settings.SERVER_REUSE_PORT
+        self.modules = load_modules(modules)
+        self.workers = workers or getattr(os, "cpu_count", multiprocessing.cpu_count)()
+        self.reuse_port = reuse_port
+        self.address = kyoto.conf.settings.BIND_ADDRESS
+        self.listener = None
+        self.children = {}  # pid -> start time
+        self.pid = os.getpid()
+        self.running = False
+        self.stopped = None
+        self.logger = logging.getLogger("kyoto.server.Supervisor")
+
+    def spawn(self):
+        """
+        Forks worker process and returns its pid
+        """
+        pid = os.fork()  # supervisor reaps workers itself, without gevent child watchers
+        if pid:
+            self.children[pid] = time.time()
+            self.logger.info("Worker {0} started".format(pid))
+            if not self.running:
+                os.kill(pid, signal.SIGTERM)  # supervisor was stopped during fork
+            return pid
+        status = 0
+        try:
+            gevent.reinit()
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # supervisor stops workers
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            listener = self.listener or listen(self.address, reuse_port=True)
+            server = BertRPCServer(self.modules, listener)
+            gevent.signal(signal.SIGTERM, server.stop)
+            server.serve_forever()
+        except Exception as exception:
+            self.logger.exception(exception)
+            status = 1
+        finally:
+            os._exit(status)
+
+    def stop(self, signum=None, frame=None):
+        """
+        Stops supervisor and terminates its workers
+        """
+        if os.getpid() != self.pid:
+            os._exit(0)  # worker has been terminated before it reset signal handlers
+        if self.running:
+            self.running = False
+            self.stopped = time.time()
+        self.kill(signal.SIGTERM)
+
+    def kill(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def wait(self):
+        """
+        Waits for any worker to exit, returns its pid. When supervisor is stopped,
+        workers are terminated again every second (signal may be lost during fork)
+        and killed after SERVER_STOP_TIMEOUT
+        """
+        signalled = time.time()
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as exception:
+                if exception.errno == errno.EINTR:
+                    continue
+                raise
+            if pid in self.children:
+                self.logger.info("Worker {0} exited with status {1}".format(pid, status))
+                return pid
+            if not pid:
+                if not self.running and time.time() - signalled >= 1:
+                    if time.time() - self.stopped < kyoto.conf.settings.SERVER_STOP_TIMEOUT:
+                        self.kill(signal.SIGTERM)
+                    else:
+                        self.kill(signal.SIGKILL)
+                    signalled = time.time()
+                time.sleep(0.1)
+
+    def serve_forever(self):
+        self.pid = os.getpid()
+        self.running = True
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        if not self.reuse_port:
+            self.listener = listen(self.address)
+        try:
+            for _ in range(self.workers):
+                if self.running:
+                    self.spawn()
+            while self.children:
+                pid = self.wait()
+                started = self.children.pop(pid)
+                if self.running:
+                    if time.time() - started < kyoto.conf.settings.SERVER_RESTART_DELAY:
+                        time.sleep(kyoto.conf.settings.SERVER_RESTART_DELAY)
+                    if self.running:
+                        self.spawn()
+        finally:
+            self.stop()
+            if self.listener:
+                self.listener.close()
+
+
+if __name__ == "__main__":
+    import logging.config
+    logging.config.dictConfig(kyoto.conf.settings.LOGGING)
+    Supervisor().serve_forever()
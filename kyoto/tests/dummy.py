@@ -1,6 +1,10 @@
 import kyoto
 import kyoto.conf
+import kyoto.network.stream
 
+import os
+import mmap
+import contextlib
 import gevent
 import threading
 
@@ -38,6 +42,19 @@ def streaming_echo_response(message):
     for x in range(10):
         yield u"{0}?".format(message)
 
+def streaming_file_response(path):
+    """
+    Streams given file three times: as file object, as mmap and as file range
+    """
+    yield {
+        "name": path,
+    }
+    yield open(path, "rb")
+    with open(path, "rb") as source:
+        with contextlib.closing(mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)) as mapped:
+            yield mapped
+        yield kyoto.network.stream.FileRange(source, 1, 10)
+
 def broken_streaming_echo(message):
     """
     Must act like other streaming echo examples, but actually don't returns byte stream
@@ -56,13 +73,132 @@ def streaming_echo_length(stream):
         length += len(message)
     return length
 
+@kyoto.stream_window(2)
+def slow_streaming_echo_length(stream):
+    length = 0
+    for message in stream:
+        gevent.sleep(0.001)
+        length += len(message)
+    return length
+
+collected_chunks = []
+
+@kyoto.stream_window(2)
+def streaming_collect(stream):
+    """
+    Collects chunks of request stream, None marks its end
+    """
+    for message in stream:
+        gevent.sleep(0.001)
+        collected_chunks.append(message)
+    collected_chunks.append(None)
+
+@kyoto.stream_window(1)
+def streaming_ignore(stream):
+    """
+    Returns without consuming of request stream
+    """
+    return None
+
 def large_echo(message):
     """
-    Raises MAX_BERP_SIZE exception
+    Returns reply, which doesn't fit into MAX_BERP_SIZE
     """
     message = message * kyoto.conf.settings.MAX_BERP_SIZE
     return message
 
+def binary_type(data):
+    """
+    Returns name of type, which binary argument was decoded to
+    """
+    return type(data).__name__
+
+def sleep_echo(message, seconds):
+    """
+    Replies after given delay, without blocking other requests
+    """
+    gevent.sleep(seconds)
+    return echo(message)
+
+def slow_streaming_echo_response(message, seconds):
+    """
+    Streams first chunk at once, second one after given delay
+    """
+    yield {
+        "count": 2,
+    }
+    yield u"{0}?".format(message)
+    gevent.sleep(seconds)
+    yield u"{0}?".format(message)
+
+@kyoto.cpu_bound
+def cpu_bound_pid():
+    """
+    Must be executed in process pool
+    """
+    return os.getpid()
+
+@kyoto.cpu_bound
+def cpu_bound_reverse(data):
+    """
+    Returns reversed binary, large ones are passed through shared memory
+    """
+    return data[::-1]
+
+@kyoto.cpu_bound
+def cpu_bound_sleep(seconds):
+    import time
+    time.sleep(seconds)
+
+@kyoto.cpu_bound
+def cpu_bound_unpicklable(data):
+    """
+    Reply can't be sent back to parent process
+    """
+    return threading.Lock()
+
+@kyoto.cpu_bound
+def cpu_bound_exception(message):
+    raise ValueError("This is exception with your text: {0}".format(message))
+
+cached_calls = []
+
+@kyoto.cacheable(ttl=60, maxsize=2)
+def cached_echo(message):
+    """
+    Replies are cached by server
+    """
+    cached_calls.append(message)
+    return echo(message)
+
+flight_calls = []
+
+@kyoto.single_flight
+def slow_lookup(key):
+    """
+    Concurrent calls with equal key share one execution
+    """
+    flight_calls.append(key)
+    gevent.sleep(0.1)
+    return echo(key)
+
+hedged_calls = []
+
+def slow_once(message):
+    """
+    First call is late, so idempotent call is hedged
+    """
+    hedged_calls.append(message)
+    if len(hedged_calls) == 1:
+        gevent.sleep(1)
+    return echo(message)
+
+def pid():
+    """
+    Returns pid of worker process
+    """
+    return os.getpid()
+
 @kyoto.blocking
 def blocking_echo():
     """
@@ -1,7 +1,18 @@
+import io
+import time
+import beretta
+import gevent
+import gevent.coros
+import gevent.server
+import gevent.socket
 import unittest
+import kyoto.conf
 import kyoto.server
 import kyoto.tests.dummy
 import kyoto.client
+import kyoto.utils.berp
+import kyoto.network.stream
+import kyoto.network.connection
 
 
 class ServiceTestCase(unittest.TestCase):
@@ -29,6 +40,164 @@ class ServiceTestCase(unittest.TestCase):
         response = self.service.call(":streaming_echo_length", [], stream=self.stream())
         self.assertEqual(response, 5 * 10)
 
+    def test_sync_file_stream_request(self):
+        with open("/etc/passwd", "rb") as source:
+            length = len(source.read())
+        response = self.service.call(":streaming_echo_length", [], stream=open("/etc/passwd", "rb"))
+        self.assertEqual(response, length)
+
+    def test_sync_long_stream_request(self):
+        stream = ("hello" for x in range(100))
+        response = self.service.call(":slow_streaming_echo_length", [], stream=stream)
+        self.assertEqual(response, 5 * 100)
+
+    def test_cached_response(self):
+        self.assertEqual(self.service.call(":cached_echo", ["cached"]), "cached?")
+        self.assertEqual(self.service.call(":cached_echo", ["cached"]), "cached?")
+        self.assertEqual(self.service.call(":echo", ["hello"]), "hello?")
+        self.assertEqual(self.service.call(":echo", ["hello"]), "hello?")
+        self.assertEqual(self.service.cache_metrics, {"hits": 1, "misses": 0})  # echo isn't looked up
+        self.assertEqual(self.service.cacheable, set([":cached_echo"]))
+
+    def test_cached_response_answered_locally(self):
+        self.service.call(":cached_echo", ["local"])
+        self.server.stop()
+        self.assertEqual(self.service.call(":cached_echo", ["local"]), "local?")
+        self.server = kyoto.server.BertRPCServer([kyoto.tests.dummy])
+        self.server.start()
+
+    def test_single_flight(self):
+        del kyoto.tests.dummy.flight_calls[:]
+        service = kyoto.client.Service(self.address, ":dummy", single_flight=True)
+        service.connections = kyoto.network.connection.PooledConnectionManager(self.address)
+        jobs = [gevent.spawn(service.call, ":slow_lookup", ["herd"]) for _ in range(10)]
+        gevent.joinall(jobs)
+        self.assertEqual([job.value for job in jobs], ["herd?"] * 10)
+        self.assertEqual(kyoto.tests.dummy.flight_calls, ["herd"])
+        self.assertEqual(service.connections.metrics["created"], 1)
+
+    def test_invalidate_cache(self):
+        del kyoto.tests.dummy.cached_calls[:]
+        self.service.call(":cached_echo", ["first"])
+        self.service.call(":cached_echo", ["second"])
+        self.service.invalidate(":cached_echo", ["first"])
+        self.service.call(":cached_echo", ["first"])
+        self.service.call(":cached_echo", ["second"])
+        self.assertEqual(self.service.cache_metrics, {"hits": 1, "misses": 2})
+        self.service.invalidate(":cached_echo")
+        self.assertEqual(len(self.service.cache), 0)
+
+    def test_streaming_response(self):
+        reply, chunks = self.service.call(":streaming_echo_response", ["hello"])
+        self.assertEqual(reply, {"count": 10})
+        self.assertEqual(chunks, [b"hello?"] * 10)
+
+    def test_lazy_streaming_response(self):
+        reply, chunks = self.service.call(":streaming_echo_response", ["hello"], stream_response=True)
+        self.assertEqual(reply, {"count": 10})
+        self.assertEqual(next(chunks), b"hello?")
+        self.assertEqual(list(chunks), [b"hello?"] * 9)
+
+    def test_abandoned_streaming_response(self):
+        service = kyoto.client.Service(self.address, ":dummy")
+        service.connections = kyoto.network.connection.SharedConnectionManager(self.address)
+        reply, chunks = service.call(":streaming_echo_response", ["hello"], stream_response=True)
+        self.assertEqual(next(chunks), b"hello?")
+        chunks.close()
+        self.assertEqual(service.call(":echo", ["hello"]), "hello?")
+
+    def test_streaming_response_to_file(self):
+        output = io.BytesIO()
+        reply = self.service.call(":streaming_echo_response", ["hello"], output=output)
+        self.assertEqual(reply, {"count": 10})
+        self.assertEqual(output.getvalue(), b"hello?" * 10)
+
+    def test_compressed_streaming_response(self):
+        kyoto.conf.settings.COMPRESS_RESPONSE = True
+        try:
+            service = kyoto.client.Service(self.address, ":dummy")
+            reply, chunks = service.call(":streaming_echo_response", ["hello" * 1000])
+        finally:
+            kyoto.conf.settings.COMPRESS_RESPONSE = False
+        self.assertEqual(chunks, [b"hello" * 1000 + b"?"] * 10)
+
+    def test_compressed_response(self):
+        kyoto.conf.settings.COMPRESS_RESPONSE = True
+        try:
+            service = kyoto.client.Service(self.address, ":dummy")
+            response = service.call(":echo", ["hello" * 1000])
+            self.assertEqual(response, "hello" * 1000 + "?")
+        finally:
+            kyoto.conf.settings.COMPRESS_RESPONSE = False
+
+    def test_compression_refused_by_server(self):
+        def handle(connection, address):
+            for message in kyoto.network.stream.receive(connection):
+                request = beretta.decode(message)
+                if request[0] == ":info":  # server without support of compression
+                    reply = (":error", (":server", 4, "ValueError", "Invalid MFA: {0}".format(request), []))
+                else:
+                    reply = (":reply", request[3][0])
+                connection.sendall(kyoto.utils.berp.pack(beretta.encode(reply)))
+        server = gevent.server.StreamServer(("localhost", 1338), handle)
+        server.start()
+        kyoto.conf.settings.COMPRESS_RESPONSE = True
+        try:
+            service = kyoto.client.Service(("localhost", 1338), ":dummy")
+            self.assertEqual(service.call(":echo", ["a"]), "a")
+            self.assertEqual(service.call(":echo", ["b"]), "b")
+        finally:
+            kyoto.conf.settings.COMPRESS_RESPONSE = False
+            server.stop()
+
+    def test_fragmented_request_and_response(self):
+        max_berp_size = kyoto.conf.settings.MAX_BERP_SIZE
+        kyoto.conf.settings.MAX_BERP_SIZE = 1024
+        try:
+            response = self.service.call(":echo", ["hello" * 1000])
+        finally:
+            kyoto.conf.settings.MAX_BERP_SIZE = max_berp_size
+        self.assertEqual(response, "hello" * 1000 + "?")
+
+    def test_call_with_timeout(self):
+        start = time.time()
+        with self.assertRaises(gevent.socket.timeout):
+            self.service.call(":sleep_echo", ["hello", 10], timeout=0.1)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(self.service.call(":sleep_echo", ["hello", 0.01], timeout=1), "hello?")
+        self.assertEqual(self.service.call(":echo", ["hello"]), "hello?")
+
+    def test_hedged_call(self):
+        del kyoto.tests.dummy.hedged_calls[:]
+        service = kyoto.client.Service(self.address, ":dummy", idempotent=[":slow_once"])
+        for _ in range(kyoto.conf.settings.CLIENT_HEDGE_MIN_SAMPLES):
+            service.hedging.latencies(":slow_once").add(0.01)
+        service.hedging.budget.tokens = 1
+        start = time.time()
+        self.assertEqual(service.call(":slow_once", ["hello"]), "hello?")
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(kyoto.tests.dummy.hedged_calls, ["hello", "hello"])
+        self.assertEqual(service.hedging.metrics, {"calls": 1, "hedged": 1, "won": 1, "throttled": 0})
+
+    def test_call_of_not_idempotent_function_isnt_hedged(self):
+        service = kyoto.client.Service(self.address, ":dummy", idempotent=[":slow_once"])
+        self.assertEqual(service.call(":echo", ["hello"]), "hello?")
+        self.assertEqual(service.hedging.metrics["calls"], 0)
+
+    def test_metrics(self):
+        self.service.call(":echo", ["hello"])
+        with self.assertRaises(ValueError):
+            self.service.call(":echo_with_exception", ["hello"])
+        service = kyoto.client.Service(self.address, ":kyoto_metrics")
+        snapshot = service.call(":snapshot", [])
+        self.assertTrue(snapshot["connections"] >= 1)
+        echo = snapshot["functions"]["dummy.echo"]
+        self.assertTrue(echo["calls"] >= 1)
+        self.assertTrue(echo["bytes_in"] > 0 and echo["bytes_out"] > 0)
+        self.assertTrue(echo["execution"]["count"] >= 1)
+        self.assertTrue(snapshot["functions"]["dummy.echo_with_exception"]["errors"]["ValueError"] >= 1)
+        self.assertTrue("kyoto_calls_total{function=\"dummy.echo\"}" in service.call(":dump", []))
+
     def test_async_stream_request(self):
         response = self.service.cast(":streaming_echo_length", [], stream=self.stream())
         self.assertEqual(response, None)
@@ -39,3 +208,160 @@ class ServiceTestCase(unittest.TestCase):
 
     def tearDown(self):
         self.server.stop()
+
+
+class PipelinedServiceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.address = ('localhost', 1337)
+        self.server = kyoto.server.BertRPCServer([kyoto.tests.dummy])
+        self.server.start()
+        self.service = kyoto.client.Service(self.address, ":dummy", pipeline=True)
+
+    def test_sync_request(self):
+        response = self.service.call(":echo", ["hello"])
+        self.assertEqual(response, "hello?")
+
+    def test_async_request(self):
+        response = self.service.cast(":echo", ["hello"])
+        self.assertEqual(response, None)
+
+    def test_sync_stream_request(self):
+        response = self.service.call(":streaming_echo_length", [], stream=self.stream())
+        self.assertEqual(response, 5 * 10)
+
+    def test_concurrent_requests(self):
+        jobs = [gevent.spawn(self.service.call, ":echo", [str(x)]) for x in range(100)]
+        gevent.joinall(jobs)
+        self.assertEqual([job.value for job in jobs], ["{0}?".format(x) for x in range(100)])
+        connection = self.service.pipeline.connection
+        self.service.call(":echo", ["hello"])
+        self.assertTrue(self.service.pipeline.connection is connection)
+
+    def test_lazy_streaming_response(self):
+        reply, chunks = self.service.call(":streaming_echo_response", ["hello"], stream_response=True)
+        self.assertEqual(reply, {"count": 10})
+        self.assertEqual(next(chunks), b"hello?")
+        chunks.close()
+        reply, chunks = self.service.call(":streaming_echo_response", ["hello"])
+        self.assertEqual(chunks, [b"hello?"] * 10)
+        self.assertEqual(self.service.call(":echo", ["hello"]), "hello?")
+
+    def test_error_response(self):
+        with self.assertRaises(ValueError):
+            self.service.call(":echo_with_exception", ["hello"])
+        response = self.service.call(":echo", ["hello"])
+        self.assertEqual(response, "hello?")
+
+    def test_reconnect(self):
+        self.service.call(":echo", ["hello"])
+        self.service.pipeline.connection.close()
+        gevent.sleep(0.01)
+        response = self.service.call(":echo", ["hello"])
+        self.assertEqual(response, "hello?")
+
+    def stream(self):
+        for x in range(10):
+            yield "hello"
+
+    def test_cached_response(self):
+        jobs = [gevent.spawn(self.service.call, ":cached_echo", ["cached"]) for _ in range(10)]
+        gevent.joinall(jobs)
+        self.assertEqual([job.value for job in jobs], ["cached?"] * 10)
+
+    def test_tagged_requests(self):
+        kyoto.conf.settings.SERVER_CONCURRENCY = 4
+        self.server.stop()
+        self.server = kyoto.server.BertRPCServer([kyoto.tests.dummy])
+        self.server.start()
+        try:
+            service = kyoto.client.Service(self.address, ":dummy", pipeline=True)
+            service.pipeline.tagged = True
+            slow = gevent.spawn(service.call, ":sleep_echo", ["slow", 0.2])
+            fast = gevent.spawn(service.call, ":sleep_echo", ["fast", 0.05])
+            fast.join()
+            self.assertEqual(fast.value, "fast?")
+            self.assertFalse(slow.ready())
+            self.assertEqual(slow.get(), "slow?")
+            reply, chunks = service.call(":streaming_echo_response", ["hello"])
+            self.assertEqual(chunks, [b"hello?"] * 10)
+        finally:
+            kyoto.conf.settings.SERVER_CONCURRENCY = 1
+
+    def tearDown(self):
+        self.service.pipeline.clear()
+        self.server.stop()
+
+
+class ClusterServiceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.addresses = [("localhost", 1337), ("localhost", 1338)]
+        self.servers = [kyoto.server.BertRPCServer([kyoto.tests.dummy], address) for address in self.addresses]
+        for server in self.servers:
+            server.start()
+        self.max_failures = kyoto.conf.settings.CLUSTER_MAX_FAILURES
+        kyoto.conf.settings.CLUSTER_MAX_FAILURES = 1
+
+    def test_round_robin(self):
+        service = kyoto.client.ClusterService(self.addresses, ":dummy")
+        self.assertEqual([service.call(":echo", ["hello"]) for _ in range(4)], ["hello?"] * 4)
+        self.assertTrue(all(node.latency > 0 for node in service.nodes))
+        self.assertEqual(service.cast(":echo", ["hello"]), None)
+
+    def test_consistent_hash(self):
+        service = kyoto.client.ClusterService(self.addresses, ":dummy", policy="consistent_hash")
+        for _ in range(5):
+            self.assertEqual(service.call(":echo", ["key"]), "key?")
+        self.assertEqual(len([node for node in service.nodes if node.latency > 0]), 1)
+
+    def test_failed_node_is_ejected(self):
+        addresses = self.addresses + [("localhost", 1339)]
+        service = kyoto.client.ClusterService(addresses, ":dummy")
+        failures = 0
+        for _ in range(6):
+            try:
+                self.assertEqual(service.call(":echo", ["hello"]), "hello?")
+            except gevent.socket.error:
+                failures += 1
+        self.assertEqual(failures, 1)
+        self.assertFalse(service.nodes[2].is_available())
+
+    def test_error_response_does_not_eject(self):
+        service = kyoto.client.ClusterService(self.addresses[:1], ":dummy")
+        with self.assertRaises(ValueError):
+            service.call(":echo_with_exception", ["hello"])
+        self.assertTrue(service.nodes[0].is_available())
+        self.assertEqual(service.nodes[0].outstanding, 0)
+
+    def test_deadline_does_not_eject(self):
+        service = kyoto.client.ClusterService(self.addresses[:1], ":dummy")
+        for _ in range(3):
+            with self.assertRaises(gevent.socket.timeout):
+                service.call(":sleep_echo", ["hello", 0.2], timeout=0.05)
+        self.assertEqual(service.nodes[0].failures, 0)
+        self.assertTrue(service.nodes[0].is_available())
+        self.assertEqual(service.nodes[0].outstanding, 0)
+
+    def test_saturated_pool_does_not_eject(self):
+        service = kyoto.client.ClusterService(self.addresses[:1], ":dummy")
+        connections = kyoto.network.connection.PooledConnectionManager(self.addresses[0])
+        connections.semaphore = gevent.coros.BoundedSemaphore(1)
+        connections.acquire_timeout = 0.01
+        service.nodes[0].service.connections = connections
+        connection = connections.acquire()  # pool is busy with another caller
+        try:
+            for _ in range(3):
+                with self.assertRaises(kyoto.network.connection.AcquireTimeout):
+                    service.call(":echo", ["hello"])
+        finally:
+            connections.release(connection)
+        self.assertEqual(service.nodes[0].failures, 0)
+        self.assertTrue(service.nodes[0].is_available())
+        self.assertEqual(service.nodes[0].outstanding, 0)
+        self.assertEqual(service.call(":echo", ["hello"]), "hello?")
+
+    def tearDown(self):
+        kyoto.conf.settings.CLUSTER_MAX_FAILURES = self.max_failures
+        for server in self.servers:
+            server.stop()
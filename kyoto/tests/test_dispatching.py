@@ -1,10 +1,16 @@
+import os
 import time
 import unittest
+import beretta
 import threading
+import gevent
 import gevent.queue
 
 import kyoto
+import kyoto.conf
 import kyoto.dispatch
+import kyoto.utils.codec
+import kyoto.utils.executor
 import kyoto.tests.dummy
 
 
@@ -58,6 +64,17 @@ class DispatcherTestCase(unittest.TestCase):
         self.assertEqual(next(response), (":reply", {"count": 10}))
         self.assertEqual(next(response), "hello?")
 
+    def test_streaming_response_execution_measured_when_exhausted(self):
+        request = (":call", ":dummy", ":streaming_echo_response", ["hello"])
+        entry = self.dispatcher.table.get(":dummy", ":streaming_echo_response")
+        count = entry.metrics.execution.count
+        response = self.dispatcher.handle(request, entry=entry)
+        self.assertEqual(next(response), (":info", ":stream", []))
+        self.assertEqual(next(response), (":reply", {"count": 10}))
+        self.assertEqual(entry.metrics.execution.count, count)
+        self.assertEqual(list(response), ["hello?" for _ in range(10)])
+        self.assertEqual(entry.metrics.execution.count, count + 1)
+
     def test_async_call_with_streaming_response(self):
         request = (":cast", ":dummy", ":streaming_echo_response", ["hello"])
         response = self.dispatcher.handle(request)
@@ -97,3 +114,145 @@ class DispatcherTestCase(unittest.TestCase):
         response = self.dispatcher.handle(
             (":call", ":dummy", ":lambda_echo", ["hello"]))
         self.assertEqual(next(response), (":reply", "hello?"))
+
+    def test_call_private_function(self):
+        response = self.dispatcher.handle(
+            (":call", ":dummy", ":private_echo", ["hello"]))
+        self.assertEqual(next(response), (':error', (':server', 2, 'NameError', "No such function: ':private_echo'", [])))
+
+    def test_cpu_bound_call(self):
+        response = next(self.dispatcher.handle((":call", ":dummy", ":cpu_bound_pid", [])))
+        self.assertEqual(response[0], ":reply")
+        self.assertNotEqual(response[1], os.getpid())
+
+    def test_cpu_bound_call_with_large_binary(self):
+        data = b"abc" * kyoto.conf.settings.CPU_SHARED_MEMORY_SIZE
+        response = next(self.dispatcher.handle((":call", ":dummy", ":cpu_bound_reverse", [data])))
+        self.assertEqual(response[0], ":reply")
+        self.assertEqual(response[1][:], data[::-1])  # result is mapped, not copied
+        self.assertEqual(kyoto.utils.codec.encode_response(response), beretta.encode((":reply", data[::-1])))
+
+    def test_cpu_bound_call_exception(self):
+        response = next(self.dispatcher.handle((":call", ":dummy", ":cpu_bound_exception", ["hello"])))
+        self.assertEqual(response[1][:4], (":user", 500, "ValueError", "This is exception with your text: hello"))
+        self.assertEqual(response[1][4][0], "Traceback (most recent call last):")
+
+    def test_cpu_bound_cast(self):
+        response = self.dispatcher.handle((":cast", ":dummy", ":cpu_bound_pid", []))
+        self.assertEqual(next(response), (":noreply", ))
+
+    def test_cacheable_call(self):
+        del kyoto.tests.dummy.cached_calls[:]
+        request = (":call", ":dummy", ":cached_echo", ["hello"])
+        for _ in range(3):
+            response = self.dispatcher.handle(request)
+            info = next(response)
+            self.assertEqual(info[:2], (":info", ":cache"))
+            self.assertEqual(info[2][0], ":ttl")
+            self.assertTrue(0 < info[2][1] <= 60)
+            self.assertEqual(next(response), beretta.encode((":reply", "hello?")))
+        self.assertEqual(kyoto.tests.dummy.cached_calls, ["hello"])
+
+    def test_cacheable_call_shared_by_dispatchers(self):
+        del kyoto.tests.dummy.cached_calls[:]
+        table = kyoto.dispatch.Table(self.modules)
+        request = (":call", ":dummy", ":cached_echo", ["world"])
+        for address in (("localhost", 1337), ("localhost", 1338)):
+            dispatcher = kyoto.dispatch.Dispatcher(self.modules, address, table)
+            list(dispatcher.handle(request))
+        self.assertEqual(kyoto.tests.dummy.cached_calls, ["world"])
+
+    def test_cacheable_cast(self):
+        response = self.dispatcher.handle((":cast", ":dummy", ":cached_echo", ["hello"]))
+        self.assertEqual(next(response), (":noreply", ))
+
+    def test_single_flight_call(self):
+        del kyoto.tests.dummy.flight_calls[:]
+        request = (":call", ":dummy", ":slow_lookup", ["key"])
+        jobs = [gevent.spawn(lambda: next(self.dispatcher.handle(request))) for _ in range(10)]
+        jobs.append(gevent.spawn(lambda: next(self.dispatcher.handle((":call", ":dummy", ":slow_lookup", ["other"])))))
+        gevent.joinall(jobs)
+        self.assertEqual([job.value for job in jobs], [(":reply", "key?")] * 10 + [(":reply", "other?")])
+        self.assertEqual(sorted(kyoto.tests.dummy.flight_calls), ["key", "other"])
+        self.assertEqual(next(self.dispatcher.handle(request)), (":reply", "key?"))
+        self.assertEqual(len(kyoto.tests.dummy.flight_calls), 3)
+
+    def test_single_flight_call_with_deadline(self):
+        del kyoto.tests.dummy.flight_calls[:]
+        request = (":call", ":dummy", ":slow_lookup", ["key"])
+        leader = gevent.spawn(lambda: next(self.dispatcher.handle(request, time.time() + 0.01)))
+        gevent.sleep(0)
+        followers = [gevent.spawn(lambda: next(self.dispatcher.handle(request))) for _ in range(3)]
+        gevent.joinall([leader] + followers)
+        self.assertEqual(leader.value, (":error", (":server", 5, "TimeoutError", "Deadline exceeded", [])))
+        self.assertEqual([job.value for job in followers], [(":reply", "key?")] * 3)
+        self.assertEqual(kyoto.tests.dummy.flight_calls, ["key", "key"])
+
+    def test_cached_call_with_deadline(self):
+        request = (":call", ":dummy", ":cached_echo", ["deadline"])
+        response = self.dispatcher.handle(request, time.time() + 1)
+        self.assertEqual(next(response), (":info", ":cache", [":ttl", 60]))
+        self.assertEqual(next(response), beretta.encode((":reply", "deadline?")))
+        calls = len(kyoto.tests.dummy.cached_calls)
+        response = self.dispatcher.handle(request, time.time() + 1)
+        self.assertEqual(next(response)[:2], (":info", ":cache"))
+        self.assertEqual(len(kyoto.tests.dummy.cached_calls), calls)
+
+    def test_call_with_expired_deadline(self):
+        response = self.dispatcher.handle((":call", ":dummy", ":echo", ["hello"]), time.time() - 1)
+        self.assertEqual(next(response), (":error", (":server", 5, "TimeoutError", "Deadline exceeded", [])))
+
+    def test_call_killed_at_deadline(self):
+        start = time.time()
+        response = self.dispatcher.handle((":call", ":dummy", ":sleep_echo", ["hello", 10]), time.time() + 0.1)
+        self.assertEqual(next(response), (":error", (":server", 5, "TimeoutError", "Deadline exceeded", [])))
+        self.assertTrue(time.time() - start < 1)
+
+    def test_call_within_deadline(self):
+        response = self.dispatcher.handle((":call", ":dummy", ":sleep_echo", ["hello", 0.01]), time.time() + 1)
+        self.assertEqual(next(response), (":reply", "hello?"))
+
+    def test_expired_blocking_call_dropped(self):
+        response = self.dispatcher.handle_blocking(kyoto.tests.dummy.echo, ["hello"], time.time() - 1)
+        self.assertEqual(response, (":error", (":server", 5, "TimeoutError", "Deadline exceeded", [])))
+
+    def test_blocking_call_within_deadline(self):
+        request = (":call", ":dummy", ":blocking_echo", [])
+        response = next(self.dispatcher.handle(request, time.time() + 1))
+        self.assertEqual(response[0], ":reply")
+
+
+    def test_cast_rejected_by_full_queue(self):
+        executor = kyoto.utils.executor.Executor(workers=1, size=1, policy="reject")
+        dispatcher = kyoto.dispatch.Dispatcher(self.modules, self.address, executor=executor)
+        request = (":cast", ":dummy", ":echo", ["hello"])
+        self.assertEqual(next(dispatcher.handle(request)), (":noreply", ))
+        self.assertEqual(next(dispatcher.handle(request)), (":error", (":server", 6, "OverloadError", "Cast queue is full", [])))
+        executor.stop()
+
+
+class TableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.table = kyoto.dispatch.Table([kyoto.tests.dummy])
+
+    def test_entry_flags(self):
+        entry = self.table.get(":dummy", ":blocking_echo")
+        self.assertEqual(entry.function, kyoto.tests.dummy.blocking_echo)
+        self.assertTrue(entry.blocking)
+        self.assertFalse(entry.private)
+        self.assertFalse(entry.streaming)
+        self.assertTrue(self.table.get(":dummy", ":private_echo").private)
+        self.assertTrue(self.table.get(":dummy", ":streaming_echo_response").streaming)
+        self.assertEqual(self.table.get(":dummy", ":slow_streaming_echo_length").stream_window, 2)
+
+    def test_unknown_function(self):
+        self.assertEqual(self.table.get(":dummy", ":kittens"), None)
+        self.assertEqual(self.table.get(":Kittens", ":echo"), None)
+        self.assertEqual(self.table.modules, frozenset([":dummy"]))
+
+    def test_shared_table(self):
+        first = kyoto.dispatch.Dispatcher([kyoto.tests.dummy], ("localhost", 1337), self.table)
+        second = kyoto.dispatch.Dispatcher([kyoto.tests.dummy], ("localhost", 1338), self.table)
+        self.assertTrue(first.table is second.table)
+        self.assertEqual(next(second.handle((":call", ":dummy", ":echo", ["hello"]))), (":reply", "hello?"))
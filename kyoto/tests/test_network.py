@@ -1,11 +1,18 @@
+import time
 import beretta
 import unittest
+import gevent
+import gevent.coros
+import gevent.select
 import gevent.socket
 
+import kyoto.conf
 import kyoto.server
 import kyoto.tests.dummy
 import kyoto.utils.berp
 import kyoto.network.stream
+import kyoto.network.hedging
+import kyoto.network.balancing
 import kyoto.network.connection
 
 
@@ -81,6 +88,21 @@ class SharedConnectionManagerTestCase(unittest.TestCase):
         self.assertEqual(beretta.decode(next(response)), (":reply", "hello?"))
         self.connections.release(connection)
 
+    def test_busy_connection_isnt_checked(self):
+        connection = self.connections.acquire()
+        message = kyoto.utils.berp.pack(beretta.encode((":call", ":dummy", ":echo", ["hello"])))
+        connection.sendall(message)
+        gevent.select.select([connection], [], [], 1)  # reply is readable, but belongs to this caller
+        waiter = gevent.spawn(self.connections.acquire)
+        gevent.sleep(0.01)
+        self.assertFalse(waiter.ready())
+        response = kyoto.network.stream.receive(connection)
+        self.assertEqual(beretta.decode(next(response)), (":reply", "hello?"))
+        self.connections.release(connection)
+        self.assertTrue(waiter.get(timeout=1) is connection)
+        self.assertFalse(connection.closed)
+        self.connections.release(connection)
+
     def test_release_connection(self):
         self.assertFalse(self.connections.semaphore.locked())
         connection = self.connections.acquire()
@@ -94,9 +116,150 @@ class SharedConnectionManagerTestCase(unittest.TestCase):
         self.server.stop()
         self.connections.clear()
 
+class PooledConnectionManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.address = ('localhost', 1337)
+        self.server = kyoto.server.BertRPCServer([kyoto.tests.dummy])
+        self.server.start()
+        self.connections = kyoto.network.connection.PooledConnectionManager(self.address)
+
+    def test_use_connection(self):
+        connection = self.connections.acquire()
+        message = kyoto.utils.berp.pack(beretta.encode((":call", ":dummy", ":echo", ["hello"])))
+        connection.sendall(message)
+        response = kyoto.network.stream.receive(connection)
+        self.assertEqual(beretta.decode(next(response)), (":reply", "hello?"))
+        self.connections.release(connection)
+
+    def test_reuse_connection(self):
+        connection = self.connections.acquire()
+        self.connections.release(connection)
+        self.assertFalse(connection.closed)
+        self.assertTrue(self.connections.acquire() is connection)
+        self.assertEqual(self.connections.metrics["created"], 1)
+        self.assertEqual(self.connections.metrics["acquired"], 2)
+
+    def test_reopen_dead_connection(self):
+        connection = self.connections.acquire()
+        self.connections.release(connection)
+        connection.close()
+        self.assertFalse(self.connections.is_alive(connection))
+        self.assertFalse(self.connections.acquire() is connection)
+        self.assertEqual(self.connections.size, 1)
+
+    def test_acquire_timeout(self):
+        self.connections.semaphore = gevent.coros.BoundedSemaphore(1)
+        self.connections.acquire_timeout = 0.01
+        connection = self.connections.acquire()
+        with self.assertRaises(gevent.socket.timeout):
+            self.connections.acquire()
+        self.assertEqual(self.connections.metrics["timeouts"], 1)
+        self.connections.release(connection)
+        self.assertTrue(self.connections.acquire() is connection)
+
+    def test_idle_eviction(self):
+        self.connections.max_idle_time = 0
+        connection = self.connections.acquire()
+        self.connections.release(connection)
+        gevent.sleep(0.01)
+        self.assertFalse(self.connections.acquire() is connection)
+        self.assertTrue(connection.closed)
+
+    def test_max_lifetime(self):
+        self.connections.max_lifetime = 0
+        connection = self.connections.acquire()
+        gevent.sleep(0.01)
+        self.connections.release(connection)
+        self.assertTrue(connection.closed)
+        self.assertEqual(self.connections.size, 0)
+
+    def test_min_size(self):
+        self.connections.min_size = 2
+        self.connections.max_idle_time = 0
+        connection = self.connections.acquire()
+        self.connections.release(connection)
+        gevent.sleep(0.01)
+        self.connections.release(self.connections.acquire())
+        self.assertEqual(self.connections.size, 2)
+
+    def tearDown(self):
+        self.server.stop()
+        self.connections.clear()
+
+
+class BalancingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.max_failures = kyoto.conf.settings.CLUSTER_MAX_FAILURES
+        kyoto.conf.settings.CLUSTER_MAX_FAILURES = 1
+        self.nodes = [kyoto.network.balancing.Node(("localhost", port), None) for port in (1337, 1338, 1339)]
+
+    def test_round_robin(self):
+        policy = kyoto.network.balancing.RoundRobin(self.nodes)
+        selected = [policy.select(":echo", []) for _ in range(6)]
+        self.assertEqual(selected, self.nodes * 2)
+
+    def test_least_outstanding(self):
+        policy = kyoto.network.balancing.LeastOutstanding(self.nodes)
+        self.nodes[0].acquire()
+        self.nodes[2].acquire()
+        self.assertTrue(policy.select(":echo", []) is self.nodes[1])
+
+    def test_power_of_two_choices(self):
+        policy = kyoto.network.balancing.PowerOfTwoChoices(self.nodes)
+        for node, latency in zip(self.nodes, (0.3, 0.01, 0.2)):
+            node.acquire()
+            node.succeed(latency)
+        selected = [policy.select(":echo", []) for _ in range(50)]
+        self.assertFalse(self.nodes[0] in selected)  # slowest node never wins a pair
+
+    def test_consistent_hash(self):
+        policy = kyoto.network.balancing.ConsistentHash(self.nodes)
+        keys = ["key-{0}".format(x) for x in range(100)]
+        selected = [policy.select(":get", [key]) for key in keys]
+        self.assertEqual(selected, [policy.select(":get", [key]) for key in keys])
+        self.assertEqual(set(selected), set(self.nodes))
+        ejected = selected[0]
+        ejected.acquire()
+        ejected.fail()
+        moved = [policy.select(":get", [key]) for key in keys]
+        self.assertFalse(ejected in moved)
+        self.assertEqual([a for a, b in zip(selected, moved) if a is not b], [n for n in selected if n is ejected])
+
+    def test_ejection_and_probe(self):
+        policy = kyoto.network.balancing.RoundRobin(self.nodes)
+        node = self.nodes[0]
+        node.acquire()
+        node.fail()
+        self.assertFalse(node.is_available())
+        self.assertFalse(node in [policy.select(":echo", []) for _ in range(4)])
+        node.ejected_until = time.time() - 1  # ejection expired
+        self.assertTrue(node.is_available())
+        node.acquire()  # probe
+        self.assertFalse(node.is_available())
+        node.succeed(0.01)
+        self.assertTrue(node.is_available())
+        self.assertEqual(node.ejections, 0)
+
+    def test_all_nodes_ejected(self):
+        policy = kyoto.network.balancing.RoundRobin(self.nodes)
+        for node in self.nodes:
+            node.acquire()
+            node.fail()
+        self.assertTrue(policy.select(":echo", []) is min(self.nodes, key=lambda node: node.ejected_until))
+
+    def tearDown(self):
+        kyoto.conf.settings.CLUSTER_MAX_FAILURES = self.max_failures
+
+
 class StreamTestCase(unittest.TestCase):
 
     def setUp(self):
+        self.max_berp_size = kyoto.conf.settings.MAX_BERP_SIZE
+        self.fragment_size = kyoto.conf.settings.FRAGMENT_SIZE
+        self.max_fragmented_size = kyoto.conf.settings.MAX_FRAGMENTED_SIZE
+        self.file_chunk_size = kyoto.conf.settings.FILE_CHUNK_SIZE
         self.address = ('localhost', 1337)
         self.server = kyoto.server.BertRPCServer([kyoto.tests.dummy])
         self.server.start()
@@ -109,14 +272,56 @@ class StreamTestCase(unittest.TestCase):
         self.assertEqual(beretta.decode(next(response)), (":reply", "hello?"))
 
     def test_receive_large_stream(self):
-        message = kyoto.utils.berp.pack(beretta.encode((":call", ":dummy", ":large_echo", ["hello"])))
-        self.connection.sendall(message)
-        response = kyoto.network.stream.receive(self.connection)
-        message = beretta.decode(next(response))
+        kyoto.conf.settings.MAX_FRAGMENTED_SIZE = kyoto.conf.settings.MAX_BERP_SIZE
+        try:
+            message = kyoto.utils.berp.pack(beretta.encode((":call", ":dummy", ":large_echo", ["hello"])))
+            self.connection.sendall(message)
+            response = kyoto.network.stream.receive(self.connection)
+            message = beretta.decode(next(response))
+        finally:
+            kyoto.conf.settings.MAX_FRAGMENTED_SIZE = self.max_fragmented_size
         self.assertEqual(message[0], ":error")
         self.assertEqual(message[1][0], ":user")
         self.assertEqual(message[1][2], "MaxBERPSizeError")
 
+    def test_receive_fragmented_stream(self):
+        message = kyoto.utils.berp.pack(beretta.encode((":call", ":dummy", ":large_echo", ["hello"])))
+        kyoto.conf.settings.MAX_BERP_SIZE = 1024
+        kyoto.conf.settings.FRAGMENT_SIZE = 1000
+        try:
+            self.connection.sendall(message)
+            stream = kyoto.network.stream.receive(self.connection)
+            info = beretta.decode(next(stream))
+            self.assertEqual(info[:2], (":info", ":fragment"))
+            fragments = []
+            for fragment in stream:
+                if not fragment:
+                    break
+                fragments.append(fragment)
+            self.assertEqual(len(fragments[0]), 1000)
+            self.assertEqual(sum(len(fragment) for fragment in fragments), info[2][0])
+            self.connection.sendall(message)
+            response = list(kyoto.network.stream.response(stream))
+        finally:
+            kyoto.conf.settings.MAX_BERP_SIZE = self.max_berp_size
+            kyoto.conf.settings.FRAGMENT_SIZE = self.fragment_size
+        self.assertEqual(len(response), 1)
+        self.assertEqual(beretta.decode(response[0]), (":reply", "hello" * 1024))
+
+    def test_send_fragmented_request(self):
+        kyoto.conf.settings.MAX_BERP_SIZE = 1024
+        try:
+            writer = kyoto.network.stream.Writer(self.connection)
+            message = beretta.encode((":call", ":dummy", ":echo", ["hello" * 1000]))
+            for frame in kyoto.network.stream.fragment(message):
+                writer.write(frame)
+            writer.flush()
+            stream = kyoto.network.stream.receive(self.connection)
+            response = list(kyoto.network.stream.response(stream))
+        finally:
+            kyoto.conf.settings.MAX_BERP_SIZE = self.max_berp_size
+        self.assertEqual(beretta.decode(response[0]), (":reply", "hello" * 1000 + "?"))
+
     def test_send_file_stream(self):
         info = kyoto.utils.berp.pack(beretta.encode((":info", ":stream", [])))
         self.connection.sendall(info)
@@ -145,6 +350,66 @@ class StreamTestCase(unittest.TestCase):
         reply, length = beretta.decode(next(response))
         self.assertEqual(length, 50)
 
+    def test_writer_coalesces_frames(self):
+        writer = kyoto.network.stream.Writer(self.connection)
+        writer.write(beretta.encode((":call", ":dummy", ":echo", ["hello"])))
+        writer.write(beretta.encode((":call", ":dummy", ":echo", ["world"])))
+        self.assertEqual(len(writer.buffers), 4)
+        writer.flush()
+        self.assertEqual(writer.buffers, [])
+        response = kyoto.network.stream.receive(self.connection)
+        self.assertEqual(beretta.decode(next(response)), (":reply", "hello?"))
+        self.assertEqual(beretta.decode(next(response)), (":reply", "world?"))
+
+    def test_sendall_partial_writes(self):
+        class Connection(object):
+            def __init__(self):
+                self.data = b""
+            def sendmsg(self, buffers, ancdata=(), flags=0):
+                chunk = b"".join(buffer.tobytes() for buffer in buffers)[:3]
+                self.data += chunk
+                return len(chunk)
+        connection = Connection()
+        kyoto.network.stream.sendall(connection, [b"hello", b"", b"kyoto", b"!"])
+        self.assertEqual(connection.data, b"hellokyoto!")
+
+    def test_send_file_extents(self):
+        kyoto.conf.settings.FILE_CHUNK_SIZE = 100
+        try:
+            with open("/etc/passwd", "rb") as source:
+                data = source.read()
+                source.seek(0)
+                extents = list(kyoto.network.stream.chunks(source))
+        finally:
+            kyoto.conf.settings.FILE_CHUNK_SIZE = self.file_chunk_size
+        self.assertTrue(all(isinstance(e, kyoto.network.stream.FileRange) for e in extents[:-1]))
+        self.assertEqual(extents[-1], b"")
+        self.assertEqual(sum(len(extent) for extent in extents), len(data))
+        info = beretta.encode((":info", ":stream", []))
+        message = beretta.encode((":call", ":dummy", ":streaming_echo_length", []))
+        writer = kyoto.network.stream.Writer(self.connection)
+        writer.write(info)
+        writer.write(message)
+        with open("/etc/passwd", "rb") as source:
+            for extent in kyoto.network.stream.chunks(source):
+                writer.write(extent)
+        writer.flush()
+        response = kyoto.network.stream.receive(self.connection)
+        self.assertEqual(beretta.decode(next(response)), (":reply", len(data)))
+
+    def test_receive_file_response(self):
+        message = kyoto.utils.berp.pack(beretta.encode((":call", ":dummy", ":streaming_file_response", ["/etc/passwd"])))
+        self.connection.sendall(message)
+        response = kyoto.network.stream.receive(self.connection)
+        self.assertEqual(beretta.decode(next(response)), (":info", ":stream", []))
+        self.assertEqual(beretta.decode(next(response)), (":reply", {"name": "/etc/passwd"}))
+        with open("/etc/passwd", "rb") as source:
+            data = source.read()
+        self.assertEqual(next(response), data)  # file
+        self.assertEqual(next(response), data)  # mmap
+        self.assertEqual(next(response), data[1:11])  # file range
+        self.assertEqual(next(response), b"")
+
     def test_send_unsupported_type_stream(self):
         with self.assertRaises(ValueError):
             stream = next(kyoto.network.stream.send(b"hello"))
@@ -152,3 +417,66 @@ class StreamTestCase(unittest.TestCase):
     def tearDown(self):
         self.connection.close()
         self.server.stop()
+
+
+class HedgingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.latencies = kyoto.network.hedging.Latencies(100)
+        for latency in range(1, 101):
+            self.latencies.add(latency / 1000.0)
+        self.budget = kyoto.network.hedging.Budget(0.5, 2)
+        self.hedging = kyoto.network.hedging.Hedging(90, self.latencies, self.budget)
+        self.calls = []
+
+    def call(self, name, delay):
+        def call():
+            self.calls.append(name)
+            gevent.sleep(delay)
+            return name
+        return call
+
+    def test_percentile(self):
+        self.assertEqual(self.latencies.percentile(90), 0.091)
+        self.assertEqual(self.latencies.percentile(100), 0.1)
+        self.assertEqual(kyoto.network.hedging.Latencies(100).percentile(90), None)
+
+    def test_budget(self):
+        budget = kyoto.network.hedging.Budget(0.5, 2)
+        self.assertFalse(budget.withdraw())
+        for _ in range(10):
+            budget.deposit()
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+    def test_fast_call_isnt_hedged(self):
+        self.budget.tokens = 2
+        self.assertEqual(self.hedging.run(self.call("primary", 0), self.call("backup", 0)), "primary")
+        self.assertEqual(self.calls, ["primary"])
+        self.assertEqual(self.hedging.metrics["hedged"], 0)
+
+    def test_late_call_is_hedged(self):
+        self.budget.tokens = 2
+        self.assertEqual(self.hedging.run(self.call("primary", 1), self.call("backup", 0)), "backup")
+        self.assertEqual(self.calls, ["primary", "backup"])
+        self.assertEqual(self.hedging.metrics, {"calls": 1, "hedged": 1, "won": 1, "throttled": 0})
+
+    def test_failed_backup(self):
+        self.budget.tokens = 2
+        def backup():
+            raise ValueError("backup")
+        self.assertEqual(self.hedging.run(self.call("primary", 0.2), backup), "primary")
+        self.assertEqual(self.hedging.metrics["won"], 0)
+
+    def test_latencies_per_key(self):
+        self.budget.tokens = 2
+        self.assertEqual(self.hedging.run(self.call("primary", 0.2), self.call("backup", 0), ":slow"), "primary")
+        self.assertEqual(self.calls, ["primary"])  # fast calls of other key don't apply
+        self.assertEqual(len(self.hedging.latencies(":slow")), 1)
+        self.assertEqual(len(self.hedging.latencies()), 100)
+
+    def test_hedge_throttled_by_budget(self):
+        self.assertEqual(self.hedging.run(self.call("primary", 0.2), self.call("backup", 0)), "primary")
+        self.assertEqual(self.calls, ["primary"])
+        self.assertEqual(self.hedging.metrics, {"calls": 1, "hedged": 0, "won": 0, "throttled": 1})
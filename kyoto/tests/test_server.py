@@ -1,14 +1,21 @@
+import os
+import time
+import signal
 import struct
 import beretta
 import unittest
+import gevent
 import gevent.queue
 import gevent.socket
 
 import kyoto.conf
+import kyoto.client
 import kyoto.server
 import kyoto.utils.berp
 import kyoto.tests.dummy
+import kyoto.utils.compression
 import kyoto.network.stream
+import kyoto.utils.metrics
 
 
 class AgentTestCase(unittest.TestCase):
@@ -27,6 +34,52 @@ class AgentTestCase(unittest.TestCase):
         response = self.agent.handle(beretta.encode((":call", ":dummy", ":kittens", ["hello"])))
         self.assertEqual(beretta.decode(next(response)), (':error', (':server', 2, 'NameError', "No such function: ':kittens'", [])))
 
+    def test_unknown_function_arguments_not_decoded(self):
+        message = beretta.encode((":call", ":dummy", ":kittens", ["hello"]))[:-4]  # arguments are corrupt
+        response = self.agent.handle(message)
+        self.assertEqual(beretta.decode(next(response)), (':error', (':server', 2, 'NameError', "No such function: ':kittens'", [])))
+        response = self.agent.handle(beretta.encode((":call", ":dummy", ":echo", ["hello"]))[:-4])
+        self.assertEqual(beretta.decode(next(response))[1][:3], (":server", 3, "ValueError"))
+
+    def test_zero_copy_binary(self):
+        kyoto.conf.settings.DECODE_ZERO_COPY_SIZE = 16
+        try:
+            for data, name in ((b"x" * 16, "memoryview"), (b"x" * 15, type(u"").__name__)):
+                response = self.agent.handle(beretta.encode((":call", ":dummy", ":binary_type", [data])))
+                self.assertEqual(beretta.decode(next(response)), (":reply", name))
+            response = self.agent.handle(beretta.encode((":call", ":dummy", ":cpu_bound_reverse", [b"ab" * 16])))
+            self.assertEqual(beretta.decode(next(response)), (":reply", "ba" * 16))
+            response = self.agent.handle(beretta.encode((":call", ":dummy", ":cached_echo", ["z" * 16])))
+            self.assertEqual(beretta.decode(next(response))[:2], (":info", ":cache"))
+            self.assertEqual(beretta.decode(next(response)), (":reply", "z" * 16 + "?"))
+        finally:
+            kyoto.conf.settings.DECODE_ZERO_COPY_SIZE = 0
+
+    def test_invalid_fragment_header(self):
+        for length in (-1, "1024", None):
+            info = beretta.encode((":info", ":fragment", [length] if length is not None else []))
+            self.assertEqual(list(self.agent.handle(info)), [])
+            self.assertEqual(list(self.agent.handle(b"garbage")), [])
+            response = beretta.decode(next(self.agent.handle(b"")))
+            self.assertEqual(response[1][:3], (":server", 3, "ValueError"))
+        response = self.agent.handle(beretta.encode((":call", ":dummy", ":echo", ["hello"])))
+        self.assertEqual(next(response), beretta.encode((":reply", "hello?")))
+
+    def test_too_large_fragmented_term(self):
+        info = beretta.encode((":info", ":fragment", [kyoto.conf.settings.MAX_FRAGMENTED_SIZE + 1]))
+        self.assertEqual(list(self.agent.handle(info)), [])
+        self.assertEqual(len(self.agent.state["fragment"].buffer), 0)
+        self.assertEqual(list(self.agent.handle(b"x" * 1024)), [])
+        self.assertEqual(len(self.agent.state["fragment"].buffer), 0)
+        response = beretta.decode(next(self.agent.handle(b"")))
+        self.assertEqual(response[1][:3], (":protocol", 3, "MaxBERPSizeError"))
+
+    def test_overflowing_fragment(self):
+        self.assertEqual(list(self.agent.handle(beretta.encode((":info", ":fragment", [4])))), [])
+        self.assertEqual(list(self.agent.handle(b"12345")), [])
+        response = beretta.decode(next(self.agent.handle(b"")))
+        self.assertEqual(response[1][:3], (":server", 3, "ValueError"))
+
     def test_invalid_mfa(self):
         response = self.agent.handle(beretta.encode((":call", ":dummy", ":kittens")))
         response = beretta.decode(next(response))
@@ -40,6 +93,13 @@ class AgentTestCase(unittest.TestCase):
         response = self.agent.handle(message)
         self.assertEqual(next(response), beretta.encode((":reply", "hello?")))
 
+    def test_cached_request(self):
+        message = beretta.encode((":call", ":dummy", ":cached_echo", ["agent"]))
+        for _ in range(2):
+            response = self.agent.handle(message)
+            self.assertEqual(beretta.decode(next(response))[:2], (":info", ":cache"))
+            self.assertEqual(next(response), beretta.encode((":reply", "agent?")))
+
     def test_async_request(self):
         message = beretta.encode((":cast", ":dummy", ":echo", ["hello"]))
         response = self.agent.handle(message)
@@ -70,6 +130,52 @@ class AgentTestCase(unittest.TestCase):
         self.assertEqual(self.agent.state['stream']['on'], False)
         self.assertEqual(self.agent.state['stream']['request'], None)
 
+    def test_streaming_request_backpressure(self):
+        with self.assertRaises(StopIteration):
+            next(self.agent.handle(beretta.encode((":info", ":stream", []))))
+        request = beretta.encode((":call", ":dummy", ":slow_streaming_echo_length", []))
+        with self.assertRaises(StopIteration):
+            next(self.agent.handle(request))
+        self.assertEqual(self.agent.state["stream"]["queue"].maxsize, 2)
+        for message in [b"hello" for _ in range(10)]:
+            with self.assertRaises(StopIteration):
+                next(self.agent.handle(message))
+            self.assertTrue(self.agent.state["stream"]["queue"].qsize() <= 2)
+        response = self.agent.handle(b"")
+        self.assertEqual(beretta.decode(next(response)), (":reply", 50))
+        self.assertTrue(self.agent.state["stream"]["stalls"] > 0)
+        self.assertTrue(kyoto.utils.metrics.registry.stream_stalls >= self.agent.state["stream"]["stalls"])
+
+    def test_streamed_response_is_bounded(self):
+        with self.assertRaises(StopIteration):
+            next(self.agent.handle(beretta.encode((":info", ":stream", []))))
+        with self.assertRaises(StopIteration):
+            next(self.agent.handle(beretta.encode((":call", ":dummy", ":streaming_echo_request", []))))
+        window = kyoto.conf.settings.STREAM_WINDOW
+        frames = []
+        for _ in range(window * 4):
+            frames.extend(self.agent.handle(b"hello"))
+            self.assertTrue(self.agent.state["stream"]["outbox"].qsize() <= window + 2)
+        self.assertTrue(frames)  # response is written, while request is streamed
+        frames.extend(self.agent.handle(b""))
+        self.assertEqual(beretta.decode(frames[0]), (":info", ":stream", []))
+        self.assertEqual(beretta.decode(frames[1]), (":noreply", ))
+        self.assertEqual(frames[2:], [b"hello"] * window * 4 + [b""])
+        response = self.agent.handle(beretta.encode((":call", ":dummy", ":echo", ["hello"])))
+        self.assertEqual(next(response), beretta.encode((":reply", "hello?")))
+
+    def test_streaming_request_without_consumer(self):
+        with self.assertRaises(StopIteration):
+            next(self.agent.handle(beretta.encode((":info", ":stream", []))))
+        request = beretta.encode((":call", ":dummy", ":streaming_ignore", []))
+        with self.assertRaises(StopIteration):
+            next(self.agent.handle(request))
+        for message in [b"hello" for _ in range(10)]:
+            with self.assertRaises(StopIteration):
+                next(self.agent.handle(message))
+        response = self.agent.handle(b"")
+        self.assertEqual(beretta.decode(next(response)), (":noreply",))
+
     def test_sync_call_with_streaming_response(self):
         request = beretta.encode((":call", ":dummy", ":streaming_echo_response", ["hello"]))
         response = self.agent.handle(request)
@@ -124,6 +230,57 @@ class AgentTestCase(unittest.TestCase):
         self.assertEqual(self.agent.state['stream']['request'], None)
 
 
+class CompressionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        kyoto.conf.settings.COMPRESS_RESPONSE = True
+        self.agent = kyoto.server.Agent([kyoto.tests.dummy], ('localhost', 1337))
+
+    def negotiate(self):
+        info = beretta.encode((":info", ":compress", [":zlib"]))
+        self.assertEqual(beretta.decode(next(self.agent.handle(info))), (":info", ":compress", [":zlib"]))
+        self.assertEqual(self.agent.state["compress"], kyoto.conf.settings.COMPRESS_LEVEL)
+
+    def test_refused(self):
+        info = beretta.encode((":info", ":compress", [":lz4"]))
+        self.assertEqual(beretta.decode(next(self.agent.handle(info))), (":info", ":compress", []))
+        self.assertEqual(self.agent.state["compress"], None)
+
+    def test_not_negotiated(self):
+        request = beretta.encode((":call", ":dummy", ":echo", ["hello" * 1000]))
+        response = next(self.agent.handle(request))
+        self.assertEqual(response, beretta.encode((":reply", "hello" * 1000 + "?")))
+
+    def test_small_reply(self):
+        self.negotiate()
+        request = beretta.encode((":call", ":dummy", ":echo", ["hello"]))
+        response = next(self.agent.handle(request))
+        self.assertEqual(response, beretta.encode((":reply", "hello?")))
+
+    def test_large_reply(self):
+        self.negotiate()
+        request = beretta.encode((":call", ":dummy", ":echo", ["hello" * 1000]))
+        response = next(self.agent.handle(request))
+        self.assertEqual(response[:2], b"\x83P")
+        self.assertTrue(len(response) < 1000)
+        self.assertEqual(beretta.decode(response), (":reply", "hello" * 1000 + "?"))
+
+    def test_streaming_response(self):
+        self.negotiate()
+        request = beretta.encode((":call", ":dummy", ":streaming_echo_response", ["hello" * 1000]))
+        response = self.agent.handle(request)
+        self.assertEqual(beretta.decode(next(response)), (":info", ":stream", [":zlib"]))
+        self.assertEqual(beretta.decode(next(response)), (":reply", {"count": 10}))
+        for _ in range(10):
+            chunk = next(response)
+            self.assertEqual(chunk[:1], kyoto.utils.compression.ZLIB_CHUNK)
+            self.assertEqual(kyoto.utils.compression.decompress_chunk(chunk), b"hello" * 1000 + b"?")
+        self.assertEqual(next(response), b"")
+
+    def tearDown(self):
+        kyoto.conf.settings.COMPRESS_RESPONSE = False
+
+
 class ServerTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -172,6 +329,38 @@ class ServerTestCase(unittest.TestCase):
             self.assertEqual(next(response), b"hello")
         self.assertEqual(next(response), b"")
 
+    def test_sync_with_long_streaming_request(self):
+        message = kyoto.utils.berp.pack(beretta.encode((":info", ":stream", [])))
+        status = self.connection.sendall(message)
+        message = kyoto.utils.berp.pack(beretta.encode((":call", ":dummy", ":streaming_echo_request", [])))
+        status = self.connection.sendall(message)
+        for message in [b"hello" for _ in range(100)]:
+            status = self.connection.sendall(kyoto.utils.berp.pack(message))
+        status = self.connection.sendall(kyoto.utils.berp.pack(b""))
+        response = kyoto.network.stream.receive(self.connection)
+        self.assertEqual(beretta.decode(next(response)), (":info", ":stream", []))
+        self.assertEqual(beretta.decode(next(response)), (":noreply", ))
+        for _ in range(100):
+            self.assertEqual(next(response), b"hello")
+        self.assertEqual(next(response), b"")
+
+    def test_async_with_streaming_request(self):
+        del kyoto.tests.dummy.collected_chunks[:]
+        message = kyoto.utils.berp.pack(beretta.encode((":info", ":stream", [])))
+        status = self.connection.sendall(message)
+        message = kyoto.utils.berp.pack(beretta.encode((":cast", ":dummy", ":streaming_collect", [])))
+        status = self.connection.sendall(message)
+        chunks = [str(x).encode("ascii") for x in range(20)]
+        for message in chunks:
+            status = self.connection.sendall(kyoto.utils.berp.pack(message))
+        status = self.connection.sendall(kyoto.utils.berp.pack(b""))
+        response = kyoto.network.stream.receive(self.connection)
+        self.assertEqual(beretta.decode(next(response)), (":noreply", ))
+        with gevent.Timeout(1):
+            while kyoto.tests.dummy.collected_chunks[-1:] != [None]:
+                gevent.sleep(0.01)
+        self.assertEqual(kyoto.tests.dummy.collected_chunks, chunks + [None])
+
     def test_sync_call_with_streaming_response(self):
         message = kyoto.utils.berp.pack(beretta.encode((":call", ":dummy", ":streaming_echo_response", ["hello"])))
         status = self.connection.sendall(message)
@@ -233,6 +422,26 @@ class ServerTestCase(unittest.TestCase):
         response = kyoto.network.stream.receive(self.connection)
         self.assertEqual(beretta.decode(next(response)), (":error", (":server", 3, "ValueError", "Corrupt request data", [])))
 
+    def test_pipelined_reply_isnt_held_by_slow_request(self):
+        first = kyoto.utils.berp.pack(beretta.encode((":call", ":dummy", ":echo", ["hello"])))
+        second = kyoto.utils.berp.pack(beretta.encode((":call", ":dummy", ":sleep_echo", ["world", 1])))
+        self.connection.sendall(first + second)
+        response = kyoto.network.stream.receive(self.connection)
+        with gevent.Timeout(0.5):
+            self.assertEqual(beretta.decode(next(response)), (":reply", "hello?"))
+        self.assertEqual(beretta.decode(next(response)), (":reply", "world?"))
+
+    def test_chunk_isnt_held_by_slow_stream(self):
+        message = kyoto.utils.berp.pack(beretta.encode((":call", ":dummy", ":slow_streaming_echo_response", ["hello", 1])))
+        self.connection.sendall(message)
+        response = kyoto.network.stream.receive(self.connection)
+        with gevent.Timeout(0.5):
+            self.assertEqual(beretta.decode(next(response)), (":info", ":stream", []))
+            self.assertEqual(beretta.decode(next(response)), (":reply", {"count": 2}))
+            self.assertEqual(next(response), b"hello?")
+        self.assertEqual(next(response), b"hello?")
+        self.assertEqual(next(response), b"")
+
     def test_large_berp(self):
         packet_size = kyoto.conf.settings.MAX_BERP_SIZE + 1024
         message = struct.pack('>I', packet_size) + b"message"
@@ -243,3 +452,125 @@ class ServerTestCase(unittest.TestCase):
     def tearDown(self):
         self.connection.close()
         self.server.stop()
+
+
+class ConcurrentServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.address = ('localhost', 1337)
+        kyoto.conf.settings.SERVER_CONCURRENCY = 4
+        self.server = kyoto.server.BertRPCServer([kyoto.tests.dummy])
+        self.server.start()
+        self.connection = gevent.socket.create_connection(self.address)
+
+    def send(self, *messages):
+        self.connection.sendall(b"".join(kyoto.utils.berp.pack(beretta.encode(m)) for m in messages))
+
+    def test_replies_in_order(self):
+        start = time.time()
+        self.send((":call", ":dummy", ":sleep_echo", ["slow", 0.2]),
+                  (":call", ":dummy", ":sleep_echo", ["fast", 0.1]),
+                  (":call", ":dummy", ":echo", ["hello"]))
+        response = kyoto.network.stream.receive(self.connection)
+        self.assertEqual(beretta.decode(next(response)), (":reply", "slow?"))
+        self.assertEqual(beretta.decode(next(response)), (":reply", "fast?"))
+        self.assertEqual(beretta.decode(next(response)), (":reply", "hello?"))
+        self.assertTrue(time.time() - start < 0.3)
+
+    def test_tagged_replies_out_of_order(self):
+        self.send((":info", ":tag", [1]), (":call", ":dummy", ":sleep_echo", ["slow", 0.2]),
+                  (":info", ":tag", [2]), (":call", ":dummy", ":echo", ["fast"]))
+        response = kyoto.network.stream.receive(self.connection)
+        self.assertEqual(beretta.decode(next(response)), (":info", ":tag", [2]))
+        self.assertEqual(beretta.decode(next(response)), (":reply", "fast?"))
+        self.assertEqual(beretta.decode(next(response)), (":info", ":tag", [1]))
+        self.assertEqual(beretta.decode(next(response)), (":reply", "slow?"))
+
+    def test_request_killed_at_deadline(self):
+        start = time.time()
+        self.send((":info", ":deadline", [0.1]), (":call", ":dummy", ":sleep_echo", ["slow", 10]),
+                  (":call", ":dummy", ":echo", ["hello"]))
+        response = kyoto.network.stream.receive(self.connection)
+        self.assertEqual(beretta.decode(next(response)), (":error", (":server", 5, "TimeoutError", "Deadline exceeded", [])))
+        self.assertEqual(beretta.decode(next(response)), (":reply", "hello?"))
+        self.assertTrue(time.time() - start < 1)
+
+    def test_stream_request_after_concurrent_requests(self):
+        self.send((":call", ":dummy", ":sleep_echo", ["slow", 0.1]),
+                  (":info", ":stream", []),
+                  (":call", ":dummy", ":streaming_echo_length", []))
+        self.connection.sendall(kyoto.utils.berp.pack(b"hello") + kyoto.utils.berp.pack(b""))
+        response = kyoto.network.stream.receive(self.connection)
+        self.assertEqual(beretta.decode(next(response)), (":reply", "slow?"))
+        self.assertEqual(beretta.decode(next(response)), (":reply", 5))
+
+    def tearDown(self):
+        kyoto.conf.settings.SERVER_CONCURRENCY = 1
+        self.connection.close()
+        self.server.stop()
+
+
+class SupervisorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.address = kyoto.conf.settings.BIND_ADDRESS
+        self.pid = None
+
+    def start(self, **kwargs):
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                gevent.reinit()
+                kyoto.server.Supervisor([kyoto.tests.dummy], **kwargs).serve_forever()
+            finally:
+                os._exit(0)
+
+    def call(self, function=":echo", timeout=5):
+        deadline = time.time() + timeout
+        while True:
+            service = kyoto.client.Service(self.address, ":dummy")
+            try:
+                return service.call(function, [] if function == ":pid" else ["hello"])
+            except gevent.socket.error:
+                if time.time() > deadline:
+                    raise
+                gevent.sleep(0.05)
+
+    def test_load_modules(self):
+        modules = kyoto.server.load_modules(["kyoto.tests.dummy", kyoto.tests.dummy])
+        self.assertEqual(modules, [kyoto.tests.dummy, kyoto.tests.dummy])
+
+    def test_listen_with_reuse_port(self):
+        if not hasattr(gevent.socket, "SO_REUSEPORT"):
+            self.skipTest("SO_REUSEPORT isn't supported")
+        address = ("localhost", 1338)
+        first = kyoto.server.listen(address, reuse_port=True)
+        second = kyoto.server.listen(address, reuse_port=True)
+        first.close()
+        second.close()
+
+    def test_prefork(self):
+        self.start(workers=2)
+        self.assertEqual(self.call(), "hello?")
+
+    def test_restart_dead_worker(self):
+        restart_delay = kyoto.conf.settings.SERVER_RESTART_DELAY
+        kyoto.conf.settings.SERVER_RESTART_DELAY = 0
+        try:
+            self.start(workers=1)
+            pid = self.call(":pid")
+            os.kill(pid, signal.SIGKILL)
+            self.assertNotEqual(self.call(":pid"), pid)
+        finally:
+            kyoto.conf.settings.SERVER_RESTART_DELAY = restart_delay
+
+    def test_prefork_with_reuse_port(self):
+        if not hasattr(gevent.socket, "SO_REUSEPORT"):
+            self.skipTest("SO_REUSEPORT isn't supported")
+        self.start(workers=2, reuse_port=True)
+        self.assertEqual(self.call(), "hello?")
+
+    def tearDown(self):
+        if self.pid:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
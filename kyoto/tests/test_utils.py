@@ -1,10 +1,27 @@
+import os
+import mmap
+import pickle
 import random
+import time
+import struct
+import logging
 import unittest
+import multiprocessing
 
+import gevent
+import gevent.event
 import beretta
+import kyoto.conf
 import kyoto.tests.dummy
 import kyoto.utils.berp
+import kyoto.utils.access
+import kyoto.utils.cache
+import kyoto.utils.codec
+import kyoto.utils.metrics
 import kyoto.utils.modules
+import kyoto.utils.executor
+import kyoto.utils.processes
+import kyoto.utils.singleflight
 import kyoto.utils.validation
 
 
@@ -40,6 +57,44 @@ class BERPTestCase(unittest.TestCase):
     #     length, body, tail = kyoto.utils.berp.unpack(message)
 
 
+class FramerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.framer = kyoto.utils.berp.Framer(size=16)
+
+    def feed(self, data, size=5):
+        offset = 0
+        while offset < len(data):
+            buffer = self.framer.writable()
+            chunk = data[offset:offset + min(size, len(buffer))]
+            buffer[:len(chunk)] = chunk
+            self.framer.commit(len(chunk))
+            offset += len(chunk)
+            for message in self.framer:
+                yield message
+
+    def test_small_frames(self):
+        messages = [b"hello", b"", b"kyoto" * 3, b"world"]
+        data = b"".join(kyoto.utils.berp.pack(m) for m in messages)
+        self.assertEqual(list(self.feed(data)), messages)
+
+    def test_large_frame(self):
+        message = b"x" * 100000
+        data = kyoto.utils.berp.pack(message) + kyoto.utils.berp.pack(b"tail")
+        self.assertEqual(list(self.feed(data, 4096)), [message, b"tail"])
+        self.assertEqual(len(self.framer.writable()), 16)
+
+    def test_incomplete_frame(self):
+        data = kyoto.utils.berp.pack(b"hello")[:-1]
+        self.assertEqual(list(self.feed(data)), [])
+        self.assertEqual(self.framer.pop(), None)
+
+    def test_max_berp_size(self):
+        data = struct.pack(">I", kyoto.conf.settings.MAX_BERP_SIZE + 1)
+        with self.assertRaises(kyoto.utils.berp.MaxBERPSizeError):
+            list(self.feed(data))
+
+
 class ValidationTestCase(unittest.TestCase):
 
     def test_not_tuple(self):
@@ -94,3 +149,386 @@ class ModulesTestCase(unittest.TestCase):
     def test_get_module_name(self):
         name = kyoto.utils.modules.get_module_name(kyoto.utils.modules)
         self.assertEqual(name, "modules")
+
+
+class ProcessesTestCase(unittest.TestCase):
+
+    def test_share_small_binary(self):
+        self.assertEqual(kyoto.utils.processes.share(b"hello"), b"hello")
+
+    def test_share_large_binary(self):
+        data = os.urandom(kyoto.conf.settings.CPU_SHARED_MEMORY_SIZE)
+        shared = kyoto.utils.processes.share(data)
+        self.assertTrue(isinstance(shared, kyoto.utils.processes.SharedBinary))
+        message = pickle.dumps(shared)
+        self.assertTrue(len(message) < 1024)
+        loaded = pickle.loads(message)
+        self.assertTrue(isinstance(loaded, mmap.mmap))
+        self.assertEqual(loaded[:], data)
+        self.assertTrue(os.path.exists(shared.path))  # argument is removed by sender
+        kyoto.utils.processes.release([shared.path])
+        self.assertFalse(os.path.exists(shared.path))
+        shared = kyoto.utils.processes.share(data, remove=True)
+        self.assertEqual(pickle.loads(pickle.dumps(shared))[:], data)
+        self.assertFalse(os.path.exists(shared.path))
+
+    def test_shared_arguments_removed(self):
+        data = os.urandom(kyoto.conf.settings.CPU_SHARED_MEMORY_SIZE)
+        result = kyoto.utils.processes.submit(kyoto.tests.dummy.cpu_bound_reverse, [data])
+        self.assertEqual(result.get(10)[:], data[::-1])
+        self.assertFalse(kyoto.utils.processes.pending)
+
+    def test_shared_arguments_removed_after_failure(self):
+        data = os.urandom(kyoto.conf.settings.CPU_SHARED_MEMORY_SIZE)
+        result = kyoto.utils.processes.submit(kyoto.tests.dummy.cpu_bound_unpicklable, [data])
+        with self.assertRaises(Exception):
+            kyoto.utils.processes.wait(result, 10)
+        self.assertFalse(kyoto.utils.processes.pending)
+
+    def test_wait_doesnt_hold_thread(self):
+        threadpool = gevent.get_hub().threadpool
+        for _ in range(threadpool.maxsize):
+            threadpool.spawn(time.sleep, 0.5)
+        result = kyoto.utils.processes.submit(kyoto.tests.dummy.cpu_bound_sleep, [0.3])
+        start = time.time()
+        with self.assertRaises(multiprocessing.TimeoutError):
+            kyoto.utils.processes.wait(result, 0.05)
+        self.assertTrue(time.time() - start < 0.3)
+        self.assertEqual(kyoto.utils.processes.wait(result, 10), None)
+
+    def test_call_with_expired_deadline(self):
+        response = kyoto.utils.processes.call(kyoto.tests.dummy.echo, ["hello"], deadline=time.time() - 1)
+        self.assertEqual(response, (":error", (":server", 5, "TimeoutError", "Deadline exceeded", [])))
+        response = kyoto.utils.processes.call(kyoto.tests.dummy.echo, ["hello"], deadline=time.time() + 1)
+        self.assertEqual(response, "hello?")
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def test_get(self):
+        cache = kyoto.utils.cache.Cache(60, 10)
+        self.assertEqual(cache.get("key"), None)
+        cache.set("key", "value")
+        value, ttl = cache.get("key")
+        self.assertEqual(value, "value")
+        self.assertTrue(0 < ttl <= 60)
+
+    def test_expiration(self):
+        cache = kyoto.utils.cache.Cache(60, 10)
+        cache.set("key", "value", ttl=-1)
+        self.assertEqual(cache.get("key"), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_eviction(self):
+        cache = kyoto.utils.cache.Cache(60, 2)
+        cache.set("first", 1)
+        cache.set("second", 2)
+        cache.get("first")
+        cache.set("third", 3)
+        self.assertEqual(cache.get("second"), None)
+        self.assertEqual(cache.get("first")[0], 1)
+        self.assertEqual(cache.get("third")[0], 3)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = kyoto.utils.singleflight.SingleFlight()
+        self.calls = []
+
+    def slow(self, value):
+        self.calls.append(value)
+        gevent.sleep(0.05)
+        if value is None:
+            raise ValueError("Empty value")
+        return value
+
+    def test_coalesced_calls(self):
+        jobs = [gevent.spawn(self.flights.do, "key", self.slow, x) for x in range(5)]
+        gevent.joinall(jobs)
+        self.assertEqual([job.value for job in jobs], [0] * 5)
+        self.assertEqual(self.calls, [0])
+        self.assertEqual(len(self.flights), 0)
+
+    def test_coalesced_exception(self):
+        jobs = [gevent.spawn(self.flights.do, "key", self.slow, None) for _ in range(3)]
+        gevent.joinall(jobs)
+        self.assertTrue(all(isinstance(job.exception, ValueError) for job in jobs))
+        self.assertEqual(self.calls, [None])
+
+    def test_killed_leader(self):
+        leader = gevent.spawn(self.flights.do, "key", self.slow, 0)
+        gevent.sleep(0)
+        followers = [gevent.spawn(self.flights.do, "key", self.slow, x) for x in range(1, 3)]
+        gevent.sleep(0.01)
+        leader.kill()
+        gevent.joinall(followers)
+        self.assertEqual([job.value for job in followers], [1, 1])
+        self.assertEqual(self.calls, [0, 1])
+        self.assertEqual(len(self.flights), 0)
+
+    def test_leader_timeout(self):
+        def call():
+            with gevent.Timeout(0.01):
+                return self.flights.do("key", self.slow, 0)
+        leader = gevent.spawn(call)
+        gevent.sleep(0)
+        follower = gevent.spawn(self.flights.do, "key", self.slow, 1)
+        gevent.joinall([leader, follower])
+        self.assertTrue(isinstance(leader.exception, gevent.Timeout))
+        self.assertEqual(follower.value, 1)
+
+
+class ExecutorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def call(self, name):
+        self.calls.append(name)
+
+    def test_submit(self):
+        executor = kyoto.utils.executor.Executor(workers=2, size=10)
+        for name in range(5):
+            self.assertTrue(executor.submit(self.call, [name]))
+        gevent.sleep(0.01)
+        self.assertEqual(sorted(self.calls), list(range(5)))
+        self.assertEqual(executor.metrics["executed"], 5)
+        self.assertEqual(executor.depth(), 0)
+        executor.stop()
+
+    def test_priorities(self):
+        executor = kyoto.utils.executor.Executor(workers=1, size=10)
+        executor.submit(self.call, ["low"], priority=1)
+        executor.submit(self.call, ["high"], priority=-1)
+        executor.submit(self.call, ["default"])
+        self.assertEqual(executor.depth(), 3)
+        gevent.sleep(0.01)
+        self.assertEqual(self.calls, ["high", "default", "low"])
+        executor.stop()
+
+    def test_drop_policy(self):
+        executor = kyoto.utils.executor.Executor(workers=1, size=2, policy="drop")
+        accepted = [executor.submit(self.call, [name]) for name in range(3)]
+        self.assertEqual(accepted, [True, True, False])
+        self.assertEqual(executor.metrics["dropped"], 1)
+        self.assertEqual(executor.metrics["max_depth"], 2)
+        executor.stop()
+
+    def test_reject_policy(self):
+        executor = kyoto.utils.executor.Executor(workers=1, size=1, policy="reject")
+        self.assertTrue(executor.submit(self.call, [1]))
+        self.assertFalse(executor.submit(self.call, [2]))
+        self.assertEqual(executor.metrics["rejected"], 1)
+        executor.stop()
+
+    def test_block_policy(self):
+        executor = kyoto.utils.executor.Executor(workers=1, size=1, policy="block")
+        for name in range(3):
+            self.assertTrue(executor.submit(self.call, [name]))  # waits for worker
+        gevent.sleep(0.01)
+        self.assertEqual(self.calls, [0, 1, 2])
+        executor.stop()
+
+    def test_done_event(self):
+        executor = kyoto.utils.executor.Executor(workers=1, size=1, policy="drop")
+        executed, dropped = gevent.event.Event(), gevent.event.Event()
+        self.assertTrue(executor.submit(self.call, [1], done=executed))
+        self.assertFalse(executor.submit(self.call, [2], done=dropped))
+        self.assertTrue(dropped.is_set())
+        self.assertTrue(executed.wait(1))
+        self.assertEqual(self.calls, [1])
+        executor.stop()
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            kyoto.utils.executor.Executor(policy="kittens")
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = kyoto.utils.metrics.Histogram()
+        for microseconds in range(1, 1001):
+            histogram.record(microseconds / 1000000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertEqual(histogram.max, 0.001)
+        for percent in (10, 50, 90, 99):
+            expected = percent / 100000.0
+            self.assertTrue(expected <= histogram.percentile(percent) <= expected * 1.125)
+        self.assertEqual(histogram.percentile(100), 0.001)
+        self.assertEqual(kyoto.utils.metrics.Histogram().percentile(99), 0.0)
+
+    def test_histogram_memory_is_bounded(self):
+        histogram = kyoto.utils.metrics.Histogram()
+        for _ in range(10000):
+            histogram.record(random.random() * 10)
+        self.assertTrue(len(histogram.counts) < 200)
+
+    def test_function_errors(self):
+        metrics = kyoto.utils.metrics.FunctionMetrics()
+        metrics.count((":reply", "hello"))
+        metrics.count((":error", (":user", 500, "ValueError", "message", [])))
+        metrics.count((":error", (":user", 500, "ValueError", "message", [])))
+        self.assertEqual(metrics.calls, 3)
+        self.assertEqual(metrics.errors, {"ValueError": 2})
+
+    def test_dump(self):
+        registry = kyoto.utils.metrics.Registry()
+        metrics = registry.function(":dummy", ":echo")
+        metrics.count((":reply", "hello"))
+        metrics.execution.record(0.001)
+        registry.function(":dummy", ":idle")
+        dump = registry.dump()
+        self.assertTrue('kyoto_calls_total{function="dummy.echo"} 1\n' in dump)
+        self.assertTrue('kyoto_execution_seconds_max{function="dummy.echo"} 0.001000\n' in dump)
+        self.assertFalse("dummy.idle" in dump)
+
+
+class AccessLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.records = []
+        self.handler = logging.Handler()
+        self.handler.emit = self.records.append
+        self.access_log = kyoto.utils.access.AccessLog("kyoto.tests.access")
+        self.access_log.logger.addHandler(self.handler)
+        self.access_log.logger.setLevel(logging.INFO)
+        self.access_log.logger.propagate = False
+        self.sample_rate = kyoto.conf.settings.ACCESS_LOG_SAMPLE_RATE
+        self.queue_size = kyoto.conf.settings.ACCESS_LOG_QUEUE_SIZE
+        self.request = (":call", ":dummy", ":echo", ["hello"])
+
+    def test_log(self):
+        kyoto.conf.settings.ACCESS_LOG_SAMPLE_RATE = 1.0
+        self.access_log.log(("localhost", 1337), self.request)
+        self.access_log.close()
+        self.assertEqual(len(self.records), 1)
+        record = self.records[0]
+        self.assertEqual(record.getMessage(), "localhost:1337 ~> :call :dummy :echo ['hello']")
+        self.assertEqual((record.peer, record.rtype, record.service, record.function),
+                         (("localhost", 1337), ":call", ":dummy", ":echo"))
+
+    def test_disabled(self):
+        kyoto.conf.settings.ACCESS_LOG_SAMPLE_RATE = 0
+        self.access_log.log(("localhost", 1337), self.request)
+        self.assertEqual(len(self.access_log.entries), 0)
+
+    def test_sampling(self):
+        kyoto.conf.settings.ACCESS_LOG_SAMPLE_RATE = 0.1
+        self.access_log.pid = os.getpid()  # writer isn't started, entries stay in queue
+        for _ in range(1000):
+            self.access_log.log(("localhost", 1337), self.request)
+        self.assertTrue(30 < len(self.access_log.entries) < 300)
+
+    def test_full_queue(self):
+        kyoto.conf.settings.ACCESS_LOG_SAMPLE_RATE = 1.0
+        kyoto.conf.settings.ACCESS_LOG_QUEUE_SIZE = 2
+        self.access_log.pid = os.getpid()  # writer isn't started, entries stay in queue
+        for _ in range(5):
+            self.access_log.log(("localhost", 1337), self.request)
+        self.assertEqual(len(self.access_log.entries), 2)
+        self.assertEqual(self.access_log.dropped, 3)
+
+    def test_queued_arguments_are_summarized(self):
+        kyoto.conf.settings.ACCESS_LOG_SAMPLE_RATE = 1.0
+        self.access_log.pid = os.getpid()  # writer isn't started, entries stay in queue
+        frame = b"x" * 1048576
+        args = [memoryview(frame), "y" * 1048576, {"key": list(range(1000))}]
+        self.access_log.log(("localhost", 1337), (":call", ":dummy", ":echo", args))
+        entry = self.access_log.entries[0]
+        self.assertEqual(entry[2:5], (":call", ":dummy", ":echo"))
+        binary, text, mapping = entry[5].args
+        self.assertTrue(isinstance(binary, bytes))
+        limit = kyoto.conf.settings.ACCESS_LOG_MAX_ARGS_LENGTH
+        self.assertEqual((len(binary), len(text), len(mapping["key"])), (limit, limit, 7))
+
+    def test_truncated_arguments(self):
+        max_length = kyoto.conf.settings.ACCESS_LOG_MAX_ARGS_LENGTH
+        kyoto.conf.settings.ACCESS_LOG_MAX_ARGS_LENGTH = 20
+        try:
+            text = str(kyoto.utils.access.Arguments(["hello" * 100, list(range(100))]))
+        finally:
+            kyoto.conf.settings.ACCESS_LOG_MAX_ARGS_LENGTH = max_length
+        self.assertEqual(len(text), 23)
+        self.assertTrue(text.startswith("['hello"))
+
+    def tearDown(self):
+        kyoto.conf.settings.ACCESS_LOG_SAMPLE_RATE = self.sample_rate
+        kyoto.conf.settings.ACCESS_LOG_QUEUE_SIZE = self.queue_size
+        self.access_log.entries.clear()
+        self.access_log.close()
+        self.access_log.logger.removeHandler(self.handler)
+
+
+class CountingCodec(kyoto.utils.codec.BerettaCodec):
+
+    calls = []
+
+    def decode(self, data):
+        self.calls.append(data)
+        return super(CountingCodec, self).decode(data)
+
+
+class CodecTestCase(unittest.TestCase):
+
+    def test_prefix(self):
+        self.assertEqual(kyoto.utils.codec.prefix(":reply"), beretta.encode((":reply", 1))[:-2])
+        self.assertEqual(kyoto.utils.codec.prefix(":info", ":tag"), beretta.encode((":info", ":tag", 1))[:-2])
+
+    def test_encode_reply(self):
+        for value in ("hello", {"key": [1, 2.5]}, None, True, [], b"binary", (":atom", 2 ** 40)):
+            response = (":reply", value)
+            self.assertEqual(kyoto.utils.codec.encode_response(response), beretta.encode(response))
+
+    def test_encode_buffer_reply(self):
+        self.assertEqual(kyoto.utils.codec.encode_response((":reply", memoryview(b"binary"))),
+                         beretta.encode((":reply", b"binary")))
+
+    def test_encode_constant(self):
+        term = kyoto.utils.codec.constant((":error", (":server", 7, "Error", "Constant", [])))
+        encoded = kyoto.utils.codec.encode_response(term)
+        self.assertEqual(encoded, beretta.encode(term))
+        self.assertTrue(kyoto.utils.codec.encode_response(term) is encoded)
+        self.assertTrue(kyoto.utils.codec.encode_response(kyoto.utils.codec.NOREPLY) is
+                        kyoto.utils.codec.encode_response((":noreply",)))
+        response = (":error", (":server", 7, "Error", "Constant", []))  # equal, but not registered
+        self.assertEqual(kyoto.utils.codec.encode_response(response), encoded)
+
+    def test_decode_header(self):
+        message = beretta.encode((":cast", ":dummy", ":echo", ["hello", 1]))
+        rtype, module, function, offset = kyoto.utils.codec.decode_header(message)
+        self.assertEqual((rtype, module, function), (":cast", ":dummy", ":echo"))
+        self.assertEqual(kyoto.utils.codec.decode_args(message, offset), ["hello", 1])
+        for term in ((":info", ":stream", []), (":reply", ":dummy", ":echo", []), (":call", ":dummy", "echo", [])):
+            self.assertEqual(kyoto.utils.codec.decode_header(beretta.encode(term)), None)
+        self.assertEqual(kyoto.utils.codec.decode_header(message[:8]), None)
+
+    def test_decode_args(self):
+        args = [0, -1, 300, 2 ** 40, -2 ** 70, 2.5, "text", b"binary", None, True, [], ["list", (1, ":atom")], {"key": "value"}]
+        message = beretta.encode((":call", ":dummy", ":echo", args))
+        offset = kyoto.utils.codec.decode_header(message)[3]
+        self.assertEqual(kyoto.utils.codec.decode_args(message, offset), beretta.decode(message)[3])
+        with self.assertRaises(ValueError):
+            kyoto.utils.codec.decode_args(message[:-12], offset)
+
+    def test_decode_args_zero_copy(self):
+        message = beretta.encode((":call", ":dummy", ":echo", [b"large" * 10, b"small"]))
+        offset = kyoto.utils.codec.decode_header(message)[3]
+        large, small = kyoto.utils.codec.decode_args(message, offset, 50)
+        self.assertTrue(isinstance(large, memoryview))
+        self.assertEqual(large.tobytes(), b"large" * 10)
+        self.assertEqual(small, "small")
+        with self.assertRaises(ValueError):
+            kyoto.utils.codec.decode_args(message[:-20], offset, 50)
+
+    def test_codec_class(self):
+        codec_class = kyoto.conf.settings.CODEC_CLASS
+        kyoto.conf.settings.CODEC_CLASS = CountingCodec
+        try:
+            message = beretta.encode((":call", ":dummy", ":echo", ["hello"]))
+            self.assertEqual(kyoto.utils.codec.decode(message), (":call", ":dummy", ":echo", ["hello"]))
+        finally:
+            kyoto.conf.settings.CODEC_CLASS = codec_class
+        self.assertEqual(CountingCodec.calls, [message])
+        self.assertTrue(isinstance(kyoto.utils.codec.get_codec(), codec_class or kyoto.utils.codec.BerettaCodec))
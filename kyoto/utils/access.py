@@ -0,0 +1,148 @@
+import os
+import mmap
+import time
+import atexit
+import random
+import logging
+import itertools
+import threading
+import collections
+
+try:
+    # Python 3.x
+    import reprlib
+except ImportError:
+    # Python 2.x
+    import repr as reprlib
+
+import kyoto.conf
+
+
+def summarize(value, limit, depth=3):
+    """
+    Returns copy of arguments, which is enough to format them: strings and
+    binaries are cut to limit, containers are cut to one more item than
+    reprlib shows. Memoryviews are copied, so they don't keep request alive
+    """
+    if isinstance(value, (memoryview, mmap.mmap)):
+        value = value[:limit]
+        return value.tobytes() if isinstance(value, memoryview) else value
+    elif isinstance(value, (bytes, bytearray, type(u""))):
+        return value[:limit] if len(value) > limit else value
+    elif isinstance(value, (list, tuple)):
+        if not depth:
+            return "..."
+        items = [summarize(item, limit, depth - 1) for item in value[:7]]
+        return items if isinstance(value, list) else tuple(items)
+    elif isinstance(value, dict):
+        if not depth:
+            return "..."
+        return dict((summarize(key, limit, depth - 1), summarize(item, limit, depth - 1))
+                    for key, item in itertools.islice(value.items(), 5))
+    return value
+
+
+class Arguments(object):
+
+    """
+    Arguments of request, which are formatted only when record is written
+    and truncated to ACCESS_LOG_MAX_ARGS_LENGTH characters. Only their summary
+    is kept, so queued requests don't hold large arguments in memory
+    """
+
+    __slots__ = ("args",)
+
+    def __init__(self, args):
+        self.args = summarize(args, kyoto.conf.settings.ACCESS_LOG_MAX_ARGS_LENGTH)
+
+    def __str__(self):
+        limit = kyoto.conf.settings.ACCESS_LOG_MAX_ARGS_LENGTH
+        formatter = reprlib.Repr()
+        formatter.maxstring = formatter.maxother = limit
+        text = formatter.repr(self.args)
+        if len(text) > limit:
+            return text[:limit] + "..."
+        return text
+
+class AccessLog(object):
+
+    """
+    Atoms and summary of arguments of sampled requests are appended to bounded
+    queue, log records are made, formatted and written by handlers of
+    "kyoto.access" logger in background thread. Requests are dropped,
+    while queue is full
+    """
+
+    def __init__(self, name="kyoto.access", interval=0.05):
+        self.logger = logging.getLogger(name)
+        self.entries = collections.deque()  # (time, address, rtype, module, function, args), appends don't need locks
+        self.interval = interval  # in seconds, writer sleeps while queue is empty
+        self.dropped = 0
+        self.writer = None
+        self.pid = None
+        self.closed = threading.Event()
+        atexit.register(self.close)
+
+    def log(self, address, request):
+        """
+        Queues request, if it's sampled and logger is enabled
+        """
+        rate = kyoto.conf.settings.ACCESS_LOG_SAMPLE_RATE
+        if rate < 1 and (rate <= 0 or random.random() >= rate):
+            return
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        if len(self.entries) >= kyoto.conf.settings.ACCESS_LOG_QUEUE_SIZE:
+            self.dropped += 1
+            return
+        if self.pid != os.getpid():
+            self.start()  # again in forked process, threads don't survive fork
+        rtype, module, function, args = request
+        self.entries.append((time.time(), address, rtype, module, function, Arguments(args)))
+
+    def start(self):
+        self.pid = os.getpid()
+        self.entries.clear()
+        self.closed.clear()
+        self.writer = threading.Thread(target=self.write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def write(self):
+        while not self.closed.is_set():
+            self.closed.wait(self.interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Writes queued requests: "127.0.0.1:50312 ~> :call :dummy :echo ['hello']".
+        Peer address and atoms of request are attached to record as attributes
+        """
+        while True:
+            try:
+                created, address, rtype, module, function, args = self.entries.popleft()
+            except IndexError:
+                break
+            extra = {
+                "peer": address,
+                "rtype": rtype,
+                "service": module,
+                "function": function,
+            }
+            record = self.logger.makeRecord(self.logger.name, logging.INFO, __file__, 0,
+                                            "%s:%s ~> %s %s %s %s",
+                                            (address[0], address[1], rtype, module, function, args),
+                                            None, extra=extra)
+            record.created = created
+            record.msecs = (created - int(created)) * 1000
+            self.logger.handle(record)
+
+    def close(self):
+        if self.writer is not None and self.pid == os.getpid() and self.writer.is_alive():
+            self.closed.set()
+            self.writer.join()
+        self.flush()
+
+
+access_log = AccessLog()
+log = access_log.log
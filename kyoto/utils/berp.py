@@ -1,21 +1,28 @@
 import struct
 import kyoto.conf
 
+HEAD = struct.Struct(">I")
+
 
 class MaxBERPSizeError(Exception):
     pass
 
 
-def pack(message):
-    length = len(message)
+def header(length):
+    """
+    Returns BERP header for message of given length
+    """
     if length > kyoto.conf.settings.MAX_BERP_SIZE:
         message = "Invalid BERP length: {0}/{1}"
         raise MaxBERPSizeError(
             message.format(kyoto.conf.settings.MAX_BERP_SIZE, length)
         )
+    return HEAD.pack(length)
+
+def pack(message):
     if not isinstance(message, bytes):
         message = message.encode("utf-8")
-    return struct.pack(">I", length) + message
+    return header(len(message)) + message
 
 def unpack(message):
     head, tail = message[:4], message[4:]
@@ -34,3 +41,90 @@ def unpack(message):
         message = "Incomplete BERP body: received {0} of {1} bytes"
         raise ValueError(message.format(len(body), length))
     return length, body, tail
+
+
+class Framer(object):
+
+    """
+    Incremental BERP parser on top of preallocated buffer.
+    Socket data is received straight into buffer with recv_into,
+    complete frames are sliced out without copying of unconsumed bytes
+    """
+
+    __slots__ = ("size", "buffer", "view", "start", "end", "pending")
+
+    def __init__(self, size=None):
+        self.size = size or kyoto.conf.settings.READ_CHUNK_SIZE
+        self.buffer = bytearray(self.size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.pending = 4
+
+    def writable(self):
+        """
+        Returns writable view of free buffer space, which fits at least
+        the rest of incomplete frame or one more read chunk
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.size:
+                self.buffer = bytearray(self.size)
+                self.view = memoryview(self.buffer)
+        received = self.end - self.start
+        required = received + max(self.pending - received, self.size)
+        if self.start + required > len(self.buffer):
+            if required > len(self.buffer):
+                buffer = bytearray(required)
+                buffer[:received] = self.view[self.start:self.end]
+                self.buffer = buffer
+                self.view = memoryview(self.buffer)
+            else:
+                self.view[:received] = self.view[self.start:self.end]
+            self.start, self.end = 0, received
+        return self.view[self.end:]
+
+    def commit(self, size):
+        """
+        Marks @size bytes of writable view as received
+        """
+        self.end += size
+
+    def ready(self):
+        """
+        Checks that next complete frame is already received
+        """
+        received = self.end - self.start
+        if received < 4:
+            return False
+        length, = HEAD.unpack_from(self.buffer, self.start)
+        return received >= length + 4
+
+    def pop(self):
+        """
+        Returns next complete frame or None, if it's not received yet
+        """
+        received = self.end - self.start
+        if received < 4:
+            self.pending = 4
+            return None
+        length, = HEAD.unpack_from(self.buffer, self.start)
+        if length > kyoto.conf.settings.MAX_BERP_SIZE:
+            message = "Invalid BERP length: {0}/{1}"
+            raise MaxBERPSizeError(
+                message.format(kyoto.conf.settings.MAX_BERP_SIZE, length)
+            )
+        self.pending = length + 4
+        if received < self.pending:
+            return None
+        start = self.start + 4
+        self.start += self.pending
+        self.pending = 4
+        return self.view[start:self.start].tobytes()
+
+    def __iter__(self):
+        while True:
+            message = self.pop()
+            if message is None:
+                break
+            yield message
@@ -0,0 +1,62 @@
+import time
+import collections
+
+
+class Cache(object):
+
+    """
+    LRU cache with expiration of entries after ttl seconds,
+    least recently used entries are evicted above maxsize
+    """
+
+    __slots__ = ("ttl", "maxsize", "entries")
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()  # key -> (expires, value)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Returns (value, remaining ttl) pair or None, if key is missing or expired
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        expires, value = entry
+        remaining = expires - time.time()
+        if remaining <= 0:
+            return None
+        self.entries[key] = entry  # most recently used entries are kept at the end
+        return value, remaining
+
+    def set(self, key, value, ttl=None):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def keys(self):
+        return list(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def get_ttl(info):
+    """
+    Returns seconds, for which reply preceded by given caching hint stays valid:
+    (:info, :cache, [:ttl, Seconds]) or (:info, :cache, [:expiration, Seconds]).
+    Returns None for unknown directives (e.g. validation tokens)
+    """
+    options = info[2]
+    for name, value in zip(options[::2], options[1::2]):
+        if name in (":ttl", ":expiration") and isinstance(value, (int, float)):
+            return value
+    return None
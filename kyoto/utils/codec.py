@@ -0,0 +1,212 @@
+import mmap
+import struct
+import beretta
+
+import kyoto.conf
+
+VERSION = b"\x83"  # first byte of every external term
+
+codec = None
+
+
+class BerettaCodec(object):
+
+    """
+    Default BERT codec. Codec is any class with encode(term), which returns
+    encoded term with version byte, and decode(data); faster implementation
+    is plugged in by CODEC_CLASS setting
+    """
+
+    __slots__ = ()
+
+    def encode(self, term):
+        return beretta.encode(term)
+
+    def decode(self, data):
+        return beretta.decode(data)
+
+
+def get_codec():
+    """
+    Returns instance of CODEC_CLASS, it's created on first use
+    """
+    global codec
+    codec_class = kyoto.conf.settings.CODEC_CLASS or BerettaCodec
+    if codec is None or codec.__class__ is not codec_class:
+        codec = codec_class()
+    return codec
+
+
+def encode(term):
+    return get_codec().encode(term)
+
+
+def decode(data):
+    return get_codec().decode(data)
+
+
+def prefix(*atoms):
+    """
+    Returns encoded head of tuple, which starts with given atoms and ends with one
+    more element: prefix(":reply") + encoded value[1:] == encode((:reply, value))
+    """
+    head = [VERSION, b"h", bytearray([len(atoms) + 1])]
+    head.extend(beretta.encode(atom)[1:] for atom in atoms)
+    return b"".join(bytes(part) for part in head)
+
+
+REPLY_PREFIX = prefix(":reply")
+
+constants = {}  # id(term) -> (term, encoded term)
+
+
+def constant(term):
+    """
+    Registers term, which never changes, so it's encoded once.
+    Term itself is returned, e.g. NOREPLY = constant((":noreply",))
+    """
+    constants[id(term)] = (term, beretta.encode(term))
+    return term
+
+
+NOREPLY = constant((":noreply",))
+
+
+def encode_response(response):
+    """
+    Encodes response term: reply is written as template prefix and encoded value
+    (memoryviews and mmaps are written as binaries),
+    registered constants are taken as they were encoded before
+    """
+    if response[0] == ":reply" and len(response) == 2:
+        if isinstance(response[1], (memoryview, mmap.mmap)):  # shared or zero-copy binary
+            value = memoryview(response[1])
+            return b"".join((REPLY_PREFIX, b"m", uint4.pack(value.nbytes), value))
+        return REPLY_PREFIX + encode(response[1])[1:]
+    if response == NOREPLY:
+        return constants[id(NOREPLY)][1]
+    cached = constants.get(id(response))
+    if cached is not None and cached[0] is response:
+        return cached[1]
+    return encode(response)
+
+
+REQUEST_HEAD = VERSION + b"h\x04"  # tuple of four elements
+
+SMALL_INT, INT, FLOAT, NEW_FLOAT = 97, 98, 99, 70
+ATOM, SMALL_TUPLE, LARGE_TUPLE, NIL = 100, 104, 105, 106
+STRING, LIST, BINARY, SMALL_BIG, LARGE_BIG = 107, 108, 109, 110, 111
+
+uint1 = struct.Struct(">B")
+uint2 = struct.Struct(">H")
+uint4 = struct.Struct(">I")
+int4 = struct.Struct(">i")
+double = struct.Struct(">d")
+
+
+def read(data, offset, length):
+    end = offset + length
+    if end > len(data):
+        raise ValueError("Incomplete term: expected {0} bytes at {1}".format(length, offset))
+    return data[offset:end], end
+
+
+def decode_atom(data, offset):
+    if uint1.unpack_from(data, offset)[0] != ATOM:
+        raise ValueError("Atom expected at {0}".format(offset))
+    length = uint2.unpack_from(data, offset + 1)[0]
+    name, offset = read(data, offset + 3, length)
+    return ":" + name.decode("utf-8"), offset
+
+
+def decode_header(data):
+    """
+    Parses envelope of encoded request (:call|:cast, Module, Function, Args)
+    without touching arguments. Returns (rtype, module, function, offset of args)
+    or None, if data isn't plain encoded request
+    """
+    if data[:len(REQUEST_HEAD)] != REQUEST_HEAD:
+        return None
+    try:
+        rtype, offset = decode_atom(data, len(REQUEST_HEAD))
+        if rtype not in (":call", ":cast"):
+            return None
+        module, offset = decode_atom(data, offset)
+        function, offset = decode_atom(data, offset)
+    except (ValueError, struct.error):
+        return None
+    return rtype, module, function, offset
+
+
+def decode_term(data, offset, size):
+    """
+    Decodes term at given offset the same way as termformat does, but without
+    copying the rest of data on every step. Binaries of given size and larger
+    are returned as memoryviews of data. Returns (term, offset of next term)
+    """
+    tag = uint1.unpack_from(data, offset)[0]
+    offset += 1
+    if tag == SMALL_INT:
+        return uint1.unpack_from(data, offset)[0], offset + 1
+    elif tag == INT:
+        return int4.unpack_from(data, offset)[0], offset + 4
+    elif tag == NEW_FLOAT:
+        return double.unpack_from(data, offset)[0], offset + 8
+    elif tag == FLOAT:
+        body, offset = read(data, offset, 31)
+        return float(body.split(b"\x00")[0]), offset
+    elif tag == ATOM:
+        return decode_atom(data, offset - 1)
+    elif tag == BINARY:
+        length = uint4.unpack_from(data, offset)[0]
+        if size and length >= size:
+            start, offset = offset + 4, offset + 4 + length
+            if offset > len(data):
+                raise ValueError("Incomplete term: expected {0} bytes at {1}".format(length, start))
+            return memoryview(data)[start:offset], offset
+        body, offset = read(data, offset + 4, length)
+        return body.decode("utf-8"), offset
+    elif tag == STRING:
+        length = uint2.unpack_from(data, offset)[0]
+        body, offset = read(data, offset + 2, length)
+        return body.decode("utf-8"), offset
+    elif tag == NIL:
+        return [], offset
+    elif tag in (SMALL_TUPLE, LARGE_TUPLE, LIST):
+        if tag == SMALL_TUPLE:
+            length, offset = uint1.unpack_from(data, offset)[0], offset + 1
+        else:
+            length, offset = uint4.unpack_from(data, offset)[0], offset + 4
+        items = []
+        for _ in range(length):
+            item, offset = decode_term(data, offset, size)
+            items.append(item)
+        if tag != LIST:
+            return tuple(items), offset
+        if offset < len(data) and uint1.unpack_from(data, offset)[0] == NIL:
+            offset += 1
+        return items, offset
+    elif tag in (SMALL_BIG, LARGE_BIG):
+        if tag == SMALL_BIG:
+            length, offset = uint1.unpack_from(data, offset)[0], offset + 1
+        else:
+            length, offset = uint4.unpack_from(data, offset)[0], offset + 4
+        sign = uint1.unpack_from(data, offset)[0]
+        digits, offset = read(data, offset + 1, length)
+        value = 0
+        for digit in reversed(bytearray(digits)):
+            value = (value << 8) | digit
+        return -value if sign else value, offset
+    else:
+        raise ValueError("Invalid term type: {0}".format(tag))
+
+
+def decode_args(data, offset, size=0):
+    """
+    Decodes arguments of request, which header was parsed by decode_header
+    """
+    try:
+        args = decode_term(data, offset, size)[0]
+    except struct.error as exception:
+        raise ValueError("Incomplete term: {0}".format(exception))
+    return beretta.decode_term(args)
@@ -0,0 +1,64 @@
+import zlib
+import struct
+import gevent
+
+import kyoto.conf
+
+RAW_CHUNK = b"\x00"
+ZLIB_CHUNK = b"\x01"
+
+
+def offload(function, data, *args):
+    """
+    Runs (de)compression of large payloads in gevent threadpool,
+    so event loop isn't blocked (zlib releases GIL while working)
+    """
+    if len(data) >= kyoto.conf.settings.COMPRESS_OFFLOAD_SIZE:
+        return gevent.get_hub().threadpool.apply(function, (data,) + args)
+    else:
+        return function(data, *args)
+
+
+def compress_term(message, level):
+    """
+    Compresses encoded BERT term, uses same layout as
+    beretta.encode(term, compressed=level), so any BERT decoder
+    reads compressed term transparently
+    """
+    if len(message) < kyoto.conf.settings.COMPRESS_THRESHOLD:
+        return message
+    body = message[1:]
+    compressed = offload(zlib.compress, body, level)
+    if len(compressed) + 5 <= len(body):
+        return b"\x83P" + struct.pack(">I", len(compressed)) + compressed
+    else:
+        return message
+
+
+def compress_chunk(chunk, level):
+    """
+    Prefixes raw stream chunk with compression flag,
+    chunks above COMPRESS_THRESHOLD are compressed with zlib
+    """
+    if isinstance(chunk, memoryview):
+        chunk = chunk.tobytes()
+    elif not isinstance(chunk, bytes):
+        chunk = chunk.encode("utf-8")
+    if len(chunk) >= kyoto.conf.settings.COMPRESS_THRESHOLD:
+        compressed = offload(zlib.compress, chunk, level)
+        if len(compressed) < len(chunk):
+            return ZLIB_CHUNK + compressed
+    return RAW_CHUNK + chunk
+
+
+def decompress_chunk(chunk):
+    """
+    Reverts compress_chunk
+    """
+    flag, body = chunk[:1], chunk[1:]
+    if flag == ZLIB_CHUNK:
+        return offload(zlib.decompress, body)
+    elif flag == RAW_CHUNK:
+        return body
+    else:
+        raise ValueError("Invalid compression flag: {0}".format(flag))
@@ -0,0 +1,26 @@
+import time
+
+import kyoto.utils.codec
+
+EXCEEDED = kyoto.utils.codec.constant((":error", (":server", 5, "TimeoutError", "Deadline exceeded", [])))
+
+
+def get_deadline(info):
+    """
+    Converts timeout of (:info, :deadline, [Seconds]) to absolute time.
+    Timeout is relative, so clocks of client and server needn't be in sync
+    """
+    return time.time() + info[2][0]
+
+
+def remaining(deadline):
+    """
+    Returns seconds left before deadline, or None, if there is no deadline
+    """
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0)
+
+
+def is_expired(deadline):
+    return deadline is not None and time.time() >= deadline
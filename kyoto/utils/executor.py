@@ -0,0 +1,88 @@
+import time
+import logging
+import itertools
+
+import gevent
+import gevent.pool
+import gevent.queue
+
+import kyoto.conf
+
+policies = ("block", "drop", "reject")
+
+
+class Executor(object):
+
+    """
+    Runs casts in fixed number of greenlets. Casts wait for free worker
+    in bounded priority queue (lower priority goes first), when queue is full
+    new cast blocks its caller, is dropped or rejected, depending on policy
+    """
+
+    def __init__(self, workers=None, size=None, policy=None):
+        self.policy = policy or kyoto.conf.settings.CAST_QUEUE_POLICY
+        if self.policy not in policies:
+            raise ValueError("Unknown cast queue policy: '{0}'".format(self.policy))
+        self.size = workers or kyoto.conf.settings.CAST_WORKERS
+        self.queue = gevent.queue.PriorityQueue(size or kyoto.conf.settings.CAST_QUEUE_SIZE)
+        self.counter = itertools.count()  # keeps order of casts with equal priority
+        self.workers = gevent.pool.Group()
+        self.logger = logging.getLogger("kyoto.utils.executor.Executor")
+        self.metrics = {
+            "queued": 0,
+            "executed": 0,
+            "dropped": 0,
+            "rejected": 0,
+            "max_depth": 0,
+            "wait_time": 0.0,  # in seconds, total time casts spent in queue
+        }
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def submit(self, function, args, kwargs=None, priority=0, done=None):
+        """
+        Queues call of function, returns False if it was dropped or rejected.
+        Given event is set, when call is finished, dropped or discarded.
+        Workers are started on first call
+        """
+        if not self.workers:
+            for _ in range(self.size):
+                self.workers.spawn(self.work)
+        task = (priority, next(self.counter), time.time(), function, args, kwargs or {}, done)
+        if self.policy == "block":
+            self.queue.put(task)
+        else:
+            try:
+                self.queue.put_nowait(task)
+            except gevent.queue.Full:
+                self.metrics["dropped" if self.policy == "drop" else "rejected"] += 1
+                if done is not None:
+                    done.set()
+                return False
+        self.metrics["queued"] += 1
+        self.metrics["max_depth"] = max(self.metrics["max_depth"], self.queue.qsize())
+        return True
+
+    def work(self):
+        while True:
+            _, _, queued, function, args, kwargs, done = self.queue.get()
+            self.metrics["wait_time"] += time.time() - queued
+            try:
+                function(*args, **kwargs)
+            except Exception as exception:
+                self.logger.exception(exception)
+            finally:
+                self.metrics["executed"] += 1
+                if done is not None:
+                    done.set()
+
+    def stop(self):
+        """
+        Kills workers, queued casts are discarded
+        """
+        self.workers.kill()
+        while not self.queue.empty():
+            done = self.queue.get_nowait()[-1]
+            if done is not None:
+                done.set()
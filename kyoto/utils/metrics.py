@@ -0,0 +1,173 @@
+import time
+
+import kyoto.conf
+
+
+class Histogram(object):
+
+    """
+    Log-linear histogram of durations in the spirit of HdrHistogram:
+    microseconds are counted in buckets, which split every power of two
+    into 8 linear steps, so memory is bounded and error stays below 12.5%
+    """
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = {}  # bucket index -> count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        if value < 16:
+            index = value
+        else:
+            shift = value.bit_length() - 4
+            index = (shift << 4) | (value >> shift)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """
+        Returns highest duration of bucket, which holds given percentile
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                break
+        shift, mantissa = index >> 4, index & 15
+        value = ((mantissa + 1) << shift) - 1 if shift else mantissa
+        return min(value / 1000000.0, self.max)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class FunctionMetrics(object):
+
+    """
+    Metrics of one remote function: queue time (in BLOCKING_POOL),
+    execution and reply encoding time, traffic and errors by class
+    """
+
+    __slots__ = ("calls", "errors", "bytes_in", "bytes_out", "queue", "execution", "encode")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = {}  # exception class name -> count
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.queue = Histogram()
+        self.execution = Histogram()
+        self.encode = Histogram()
+
+    def count(self, response):
+        self.calls += 1
+        if isinstance(response, tuple) and response and response[0] == ":error":
+            name = response[1][2]
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "errors": dict(self.errors),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "queue": self.queue.snapshot(),
+            "execution": self.execution.snapshot(),
+            "encode": self.encode.snapshot(),
+        }
+
+
+def get_blocking_queue_depth():
+    queue = getattr(kyoto.conf.settings.BLOCKING_POOL, "_work_queue", None)
+    return queue.qsize() if queue is not None else 0
+
+
+class Registry(object):
+
+    """
+    Metrics of current process: functions by (module, function) atoms,
+    counters and gauges, which are read when snapshot is taken
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.functions = {}
+        self.connections = 0
+        self.streams = set()  # queues of streamed requests in progress
+        self.stream_stalls = 0  # uploads paused, because handler didn't keep up
+        self.stream_stall_time = 0.0
+        self.gauges = {
+            "blocking_queue": get_blocking_queue_depth,
+            "stream_queue": lambda: sum(queue.qsize() for queue in self.streams),
+        }
+
+    def function(self, module, function):
+        """
+        Returns metrics of given function, they are created on first use
+        """
+        key = (module, function)
+        metrics = self.functions.get(key)
+        if metrics is None:
+            metrics = self.functions[key] = FunctionMetrics()
+        return metrics
+
+    def snapshot(self):
+        return {
+            "uptime": time.time() - self.started,
+            "connections": self.connections,
+            "stream_stalls": self.stream_stalls,
+            "stream_stall_time": self.stream_stall_time,
+            "gauges": dict((name, gauge()) for name, gauge in self.gauges.items()),
+            "functions": dict(("{0}.{1}".format(module[1:], function[1:]), metrics.snapshot())
+                              for (module, function), metrics in self.functions.items() if metrics.calls),
+        }
+
+    def dump(self):
+        """
+        Returns metrics in Prometheus text format
+        """
+        snapshot = self.snapshot()
+        lines = [
+            "kyoto_uptime_seconds {0:.3f}".format(snapshot["uptime"]),
+            "kyoto_connections {0}".format(snapshot["connections"]),
+            "kyoto_stream_stalls_total {0}".format(snapshot["stream_stalls"]),
+            "kyoto_stream_stall_seconds_total {0:.6f}".format(snapshot["stream_stall_time"]),
+        ]
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append("kyoto_{0} {1}".format(name, value))
+        for name, metrics in sorted(snapshot["functions"].items()):
+            label = 'function="{0}"'.format(name)
+            lines.append("kyoto_calls_total{{{0}}} {1}".format(label, metrics["calls"]))
+            lines.append("kyoto_received_bytes_total{{{0}}} {1}".format(label, metrics["bytes_in"]))
+            lines.append("kyoto_sent_bytes_total{{{0}}} {1}".format(label, metrics["bytes_out"]))
+            for error, count in sorted(metrics["errors"].items()):
+                lines.append('kyoto_errors_total{{{0},error="{1}"}} {2}'.format(label, error, count))
+            for phase in ("queue", "execution", "encode"):
+                histogram = metrics[phase]
+                for quantile in ("p50", "p90", "p99"):
+                    line = 'kyoto_{0}_seconds{{{1},quantile="0.{2}"}} {3:.6f}'
+                    lines.append(line.format(phase, label, quantile[1:], histogram[quantile]))
+                lines.append("kyoto_{0}_seconds_count{{{1}}} {2}".format(phase, label, histogram["count"]))
+                lines.append("kyoto_{0}_seconds_max{{{1}}} {2:.6f}".format(phase, label, histogram["max"]))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
@@ -0,0 +1,178 @@
+import os
+import mmap
+import atexit
+import tempfile
+import traceback
+import multiprocessing
+
+import gevent
+import gevent.event
+
+import kyoto.conf
+import kyoto.utils.deadlines
+
+pool = None
+pool_pid = None
+pending = set()  # files of shared arguments, which are removed, when their call is completed
+
+
+class SharedBinary(object):
+
+    """
+    Large binary, which crosses process boundary through file in shared
+    memory (CPU_SHARED_MEMORY_PATH) instead of being pickled into pipe.
+    File of argument is removed by parent, when call is completed,
+    file of result is removed by parent, when result is loaded
+    """
+
+    __slots__ = ("path", "size", "remove")
+
+    def __init__(self, data, remove=False):
+        directory = kyoto.conf.settings.CPU_SHARED_MEMORY_PATH
+        if not os.path.isdir(directory):
+            directory = None
+        descriptor, self.path = tempfile.mkstemp(prefix="kyoto-", dir=directory)
+        with os.fdopen(descriptor, "wb") as target:
+            target.write(data)
+        self.size = len(data)
+        self.remove = remove
+
+    def __reduce__(self):
+        return (load, (self.path, self.size, self.remove))
+
+
+def load(path, size, remove=False):
+    """
+    Maps binary shared by SharedBinary into memory, read-only mmap is returned
+    instead of copy: its slices are bytes, it's encoded as BERT binary
+    """
+    try:
+        with open(path, "rb") as source:
+            if not size:
+                return b""
+            return mmap.mmap(source.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        if remove:
+            os.unlink(path)
+
+
+def share(value, remove=False):
+    """
+    Replaces large binary with SharedBinary, other values are pickled as usual.
+    Memoryviews of request frame and mmaps can't be pickled, so small ones are copied
+    """
+    if isinstance(value, (memoryview, mmap.mmap)) and len(value) < kyoto.conf.settings.CPU_SHARED_MEMORY_SIZE:
+        return value.tobytes() if isinstance(value, memoryview) else value[:]
+    if isinstance(value, (bytes, bytearray, memoryview, mmap.mmap)) \
+            and len(value) >= kyoto.conf.settings.CPU_SHARED_MEMORY_SIZE:
+        return SharedBinary(value, remove)
+    return value
+
+
+def release(paths):
+    """
+    Removes files of shared arguments
+    """
+    for path in paths:
+        pending.discard(path)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def call(function, args, shared=True, deadline=None):
+    """
+    Runs function in worker process, exceptions are transformed
+    to BERT error terms here, so traceback isn't lost.
+    Calls, which waited in queue past their deadline, are dropped
+    """
+    if kyoto.utils.deadlines.is_expired(deadline):
+        return kyoto.utils.deadlines.EXCEEDED
+    try:
+        response = function(*args)
+    except Exception as exception:
+        name = exception.__class__.__name__
+        message = str(exception)
+        trace = traceback.format_exc().splitlines()
+        return (":error", (":user", 500, name, message, trace))
+    else:
+        return share(response, remove=True) if shared else response
+
+
+def get_pool():
+    """
+    Returns process pool of current process, it's created on first use
+    (and again in forked server workers)
+    """
+    global pool, pool_pid
+    if pool is None or pool_pid != os.getpid():
+        pool = multiprocessing.Pool(kyoto.conf.settings.CPU_POOL_SIZE,
+                                    maxtasksperchild=kyoto.conf.settings.CPU_POOL_MAX_TASKS)
+        pool_pid = os.getpid()
+    return pool
+
+
+def submit(function, args, shared=True, deadline=None):
+    """
+    Sends call of function to process pool, returns gevent.event.AsyncResult.
+    Result is handed from result thread of pool to event loop by async watcher,
+    there files of shared arguments are removed, when call is completed or failed
+    """
+    args = [share(arg) for arg in args]
+    paths = [arg.path for arg in args if isinstance(arg, SharedBinary)]
+    pending.update(paths)
+    result = gevent.event.AsyncResult()
+    outcome = []
+    loop = gevent.get_hub().loop
+    watcher = (getattr(loop, "async_", None) or getattr(loop, "async"))()  # renamed in gevent 1.3
+
+    def complete():
+        watcher.stop()
+        release(paths)
+        value, exception = outcome[0]
+        if exception is None:
+            result.set(value)
+        else:
+            result.set_exception(exception)
+
+    def notify(value, exception=None):
+        outcome.append((value, exception))  # runs in result thread of pool
+        watcher.send()
+
+    watcher.start(complete)
+    try:
+        get_pool().apply_async(call, (function, args, shared, deadline), callback=notify,
+                               error_callback=lambda exception: notify(None, exception))
+    except TypeError:
+        # Python 2.x, failed call isn't reported, files are removed at exit
+        get_pool().apply_async(call, (function, args, shared, deadline), callback=notify)
+    return result
+
+
+def wait(result, timeout=None):
+    """
+    Waits for result of process pool, event loop isn't blocked and no thread is held.
+    Raises multiprocessing.TimeoutError, if result isn't ready in given number of seconds
+    """
+    result.wait(timeout)
+    if not result.ready():
+        raise multiprocessing.TimeoutError("Result isn't ready in {0} seconds".format(timeout))
+    return result.get()
+
+
+def shutdown():
+    """
+    Stops process pool of current process, files of arguments,
+    which weren't processed, are removed
+    """
+    global pool, pool_pid
+    if pool is not None and pool_pid == os.getpid():
+        pool.terminate()
+        pool.join()
+        release(list(pending))
+    pool = None
+    pool_pid = None
+
+
+atexit.register(shutdown)
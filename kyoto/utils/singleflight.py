@@ -0,0 +1,42 @@
+import gevent.event
+
+RETRY = object()  # leader was interrupted, one of followers calls function again
+
+
+class SingleFlight(object):
+
+    """
+    Coalesces concurrent calls with equal keys: only first caller runs
+    function, the rest wait for its result (or exception). When leader is
+    killed or its own timeout expires, followers aren't affected and retry
+    """
+
+    __slots__ = ("calls",)
+
+    def __init__(self):
+        self.calls = {}  # key -> gevent.event.AsyncResult
+
+    def __len__(self):
+        return len(self.calls)
+
+    def do(self, key, function, *args, **kwargs):
+        result = self.calls.get(key)
+        while result is not None:
+            value = result.get()
+            if value is not RETRY:
+                return value
+            result = self.calls.get(key)
+        result = self.calls[key] = gevent.event.AsyncResult()
+        try:
+            value = function(*args, **kwargs)
+        except Exception as exception:
+            result.set_exception(exception)
+            raise
+        except BaseException:
+            result.set(RETRY)  # e.g. GreenletExit or gevent.Timeout belong to leader only
+            raise
+        else:
+            result.set(value)
+            return value
+        finally:
+            del self.calls[key]
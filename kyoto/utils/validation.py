@@ -5,7 +5,8 @@ def is_valid_info(request):
     if isinstance(request, tuple):
         if len(request) == 3:
             if request[0] == ":info":
-                if request[1] in (":stream", ":callback", ":cache"):
+                if request[1] in (":stream", ":callback", ":cache", ":compress", ":fragment", ":tag",
+                                  ":deadline"):
                     if isinstance(request[2], list):
                         return True
     return False